@@ -1,7 +1,8 @@
 import os
 import struct
+import hashlib
 import pickle
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Dict
 
 CACHE_DURATION = 3600
@@ -13,8 +14,9 @@ LISTFILE = (os.path.join(os.getcwd(),"listfiles","wow-82.txt"),"82")
 
 TACT_KEYS = {} # dict of name:key, populated automatically for some games.
 
-from PyCASC.utils.blizzutils import var_int,have_cached,get_cdn_url,hashlittle2,parse_build_config,parse_config,prefix_hash,hexkey_to_bytes,byteskey_to_hex
-from PyCASC.utils.CASCUtils import parse_encoding_file,parse_install_file,parse_download_file,parse_root_file,r_cascfile,cascfile_size, NAMED_FILE,SNO_FILE,SNO_INDEXED_FILE,WOW_HASHED_FILE,WOW_DATAID_FILE
+from PyCASC.utils.blizzutils import have_cached,get_cdn_url,hashlittle2,parse_build_config,parse_config,prefix_hash,hexkey_to_bytes,byteskey_to_hex
+from PyCASC.utils.bufferreader import BufferReader
+from PyCASC.utils.CASCUtils import short_ekey,parse_encoding_file,parse_install_file,parse_download_file,parse_size_file,parse_root_file,r_cascfile,r_cascfile_range,iter_cascfile,cascfile_blteheader,read_blteheader,decode_blte_chunks,blte_chunk_span,TranslateTable, NAMED_FILE,SNO_FILE,SNO_INDEXED_FILE,WOW_HASHED_FILE,WOW_DATAID_FILE
 
 
 def prep_6x_listfile(fp):
@@ -27,7 +29,7 @@ def prep_6x_listfile(fp):
             x=x.upper()
             x=x.replace("/","\\")
             hsha,hshb = hashlittle2(x)
-            names[hsha<<20 | hshb]=x
+            names[hsha<<32 | hshb]=x
     pickle.dump(names, open(fp+".pkl",'wb+'))
     return names
 
@@ -50,36 +52,38 @@ class FileInfo:
     name:str
     extras:dict
     
+_idx_header = struct.Struct("<IIH6BQQII")
+
 def r_idx(fp):
     ents=[]
     with open(fp,'rb') as f:
-        hl,hh,u_0,bi,u_1,ess,eos,eks,afhb,atsm,_,elen,eh=struct.unpack("IIH6BQQII",f.read(0x28))
-        esize = ess+eos+eks
-        for x in range(0x28,0x28+elen,esize):
-            ek=var_int(f,eks,False)
-            eo=var_int(f,eos,False)
-            es=var_int(f,ess)
-            e=FileInfo()
-            e.data_file=eo>>30
-            e.offset=eo&(2**30-1)
-            e.compressed_size=es
-            e.ekey=ek
-            ents.append(e)
+        r=BufferReader(f.read())
+    hl,hh,u_0,bi,u_1,ess,eos,eks,afhb,atsm,_,elen,eh=r.unpack(_idx_header)
+    entry=struct.Struct(f"<{eks}s{eos}s{ess}s")
+    for ek,eo,es in r.iter_unpack(entry,elen//entry.size):
+        eo=int.from_bytes(eo,'big')
+        e=FileInfo()
+        e.data_file=eo>>30
+        e.offset=eo&(2**30-1)
+        e.compressed_size=int.from_bytes(es,'little')
+        e.ekey=int.from_bytes(ek,'big')
+        ents.append(e)
     return ents
 
 def r_cidx(df): 
-    d = BytesIO(df)
+    """ Parses a cdn archive .index file, straight from the buffer it was given (bytes, or a memoryview over the cache) """
+    r = BufferReader(df)
+    d = r.view
 
     curchksz=0x10
     tocCHK, vrsn,u2,u1, bs, eos, ess, eks, chksz, numel, ftCHK = (None,)*11
     validFooter = False
     while not validFooter and curchksz>0:
-        ftrsize = curchksz*2 + 12
-        d.seek(-ftrsize,2)
+        ftrpos = len(d) - (curchksz*2 + 12)
 
-        tocCHK = d.read(curchksz)
-        vrsn,u2,u1,bs,eos,ess,eks,chksz,numel = struct.unpack(f"8bI", d.read(12))
-        ftCHK = d.read(curchksz)
+        tocCHK = d[ftrpos:ftrpos+curchksz]
+        vrsn,u2,u1,bs,eos,ess,eks,chksz,numel = struct.unpack_from(f"8bI", d, ftrpos+curchksz)
+        ftCHK = d[ftrpos+curchksz+12:ftrpos+curchksz*2+12]
 
         # a valid footer has version 1 (that i know of), and the length of the CHKs == chksz.
         validFooter = len(tocCHK) == chksz and vrsn == 1 
@@ -92,20 +96,21 @@ def r_cidx(df):
 
     dupe=0
 
-    blk_cnt = len(df) // (bs*1024)
-    max_el_per_blk = (bs*1024) // 0x18
+    blk_size = bs*1024
+    blk_cnt = len(d) // blk_size
+    max_el_per_blk = blk_size // 0x18
+    entry = struct.Struct(f">{eks}s{ess}s{eos}s")
     for x in range(blk_cnt):
-        d.seek(x*bs*1024)
-        for _ in range(max_el_per_blk):
-            ek=var_int(d,eks,False)
+        r.seek(x*blk_size)
+        for ek,es,eo in r.iter_unpack(entry,max_el_per_blk):
+            ek=int.from_bytes(ek,'big')
+            es=int.from_bytes(es,'big')
+            eo=int.from_bytes(eo,'big')
             if ek in ents:
                 dupe+=1
                 continue
-
-            es=var_int(d,ess,False)
             if ek == 0 or es == 0:
                 break
-            eo=var_int(d,eos,False)
 
             e=FileInfo()
             e.offset=eo
@@ -118,17 +123,23 @@ def r_cidx(df):
 
     return ents
 
+class LoadCancelled(Exception):
+    """ Raised from on_progress to abort whatever the reader is doing (loading, listing files) """
+    pass
+
 class CASCReader:
     ckey_map:Dict[int,int]
     listed_files:Dict[int,bytes]
     file_table:Dict[int,FileInfo]
-    file_translate_table:Dict[int,tuple]
+    file_translate_table:TranslateTable
+    EKEY_SIZE:int # the width of the ekeys in ckey_map and file_table, in bytes
 
     def __init__(self, read_install_file=True):
         if read_install_file:
-            ine = parse_install_file(self.get_file_by_ckey(self.install_ckey))
-            for x in ine:
-                self.file_translate_table.append((NAMED_FILE,x.name,f"{x.md5:x}"))
+            self.on_progress("install",0)
+            ine = self.get_install_manifest()
+            self.file_translate_table.add_named(ine.names,ine.ckeys)
+            self.on_progress("install",100)
 
         for ckey in self.ckey_map:
             first_ekey = self.ckey_map[ckey]
@@ -136,23 +147,174 @@ class CASCReader:
                 fi = self.file_table[first_ekey]
                 fi.ckey = ckey
 
-        for x in self.file_translate_table:
-            if isinstance(x[2],bytes):
-                ckey = int.from_bytes(x[2],byteorder='big')
-            else:
-                ckey = int(x[2],16)
+        self._apply_translate_table()
+
+    def _apply_translate_table(self):
+        """ Names the files listed in the file_translate_table """
+        listed_files = getattr(self,"listed_files",None)
+        total = max(len(self.file_translate_table),1)
+        for i,(ftype,fid,ckey) in enumerate(self.file_translate_table):
+            if i & 0xffff == 0:
+                self.on_progress("names",100*i/total)
             fi = self.get_file_info_by_ckey(ckey)
             if fi is None:
                 continue
-            if x[0] is NAMED_FILE:
-                fi.name=x[1]
-            elif x[0] is WOW_DATAID_FILE:
-                fi.extras = {"data_id": x[1]}
-                if self.listed_files is not None:
-                    if x[1] in self.listed_files:
-                        fi.name = self.listed_files[x[1]] 
+            if ftype == NAMED_FILE:
+                fi.name=fid
+            elif ftype == WOW_DATAID_FILE:
+                fi.extras = {"data_id": fid}
+                if listed_files is not None:
+                    if fid in listed_files:
+                        fi.name = listed_files[fid] 
                     else:
-                        fi.name = "FILE_BY_ID/"+str(x[1])
+                        fi.name = "FILE_BY_ID/"+str(fid)
+        self.on_progress("names",100)
+
+    def set_root_view(self, view):
+        """ Switches which locales and content of a wow root this reader exposes (see rootfiles.wow.WOWROOT_View). 
+        The translate table, file names and listings are rebuilt from the already parsed root. """
+        if getattr(self,"wow_root",None) is None:
+            raise Exception("This storage's root has no locale or content flags to view")
+        self.root_view = view
+        for fi in self.file_table.values():
+            if hasattr(fi,"name"):
+                del fi.name
+            if hasattr(fi,"extras"):
+                del fi.extras
+        self.name_index = None
+        self.hidden_ckeys = None
+        named = self.file_translate_table.select(NAMED_FILE) # the system and install files
+        self.file_translate_table = self.wow_root.translate(view)
+        self.file_translate_table.extend(named)
+        self._apply_translate_table()
+
+    def iter_translate_table(self):
+        """ Yields (type, id, ckey) for every entry of the file_translate_table, with the ckey as an int,
+        then the names the root resolves itself (see iter_root_names) """
+        yield from self.file_translate_table
+        for name,ckey in self.iter_root_names():
+            yield NAMED_FILE,name,ckey
+
+    def get_hidden_ckeys(self):
+        """ The ckeys listings leave out: files a wow root only lists outside the reader's root view, which would
+        otherwise show up as unnamed files """
+        if getattr(self,"hidden_ckeys",None) is None:
+            wow_root = getattr(self,"wow_root",None)
+            self.hidden_ckeys = set() if wow_root is None else wow_root.hidden_ckeys(getattr(self,"root_view",None))
+        return self.hidden_ckeys
+
+    def iter_root_names(self):
+        """ Yields (name, ckey) for the files a root names outside of the file_translate_table: Heroes/StarCraft II names,
+        which are walked out of the root's tries only when they're listed, never while loading """
+        mndx_root = getattr(self,"mndx_root",None)
+        if mndx_root is not None:
+            for name,ckey,_ in mndx_root.iter_files():
+                yield name,int.from_bytes(ckey,'big')
+
+    def get_ckey_by_path(self, path):
+        """ Resolves a path to its ckey, or None. 
+        WoW paths are looked up by the root's name hashes (no listfile needed), Heroes/StarCraft II paths in the root's name tries,
+        other storages by their root/install names. """
+        if getattr(self,"wow_root",None) is not None:
+            row = self.wow_root.lookup_path(path,getattr(self,"root_view",None))
+            if row is not None:
+                return int.from_bytes(self.wow_root.ckey(row),'big')
+        if getattr(self,"mndx_root",None) is not None:
+            ent = self.mndx_root.lookup(path)
+            if ent is not None:
+                return int.from_bytes(ent[0],'big')
+
+        if getattr(self,"path_index",None) is None:
+            self.path_index = {}
+            for ftype,fid,ckey in self.file_translate_table: # the root's own names were looked up above
+                if ftype == NAMED_FILE:
+                    self.path_index[fid.replace("\\","/").lower()] = ckey
+        return self.path_index.get(path.strip().replace("\\","/").lower())
+
+    def open_by_path(self, path, max_size=-1):
+        """ Reads a file by its path, see get_ckey_by_path """
+        ckey = self.get_ckey_by_path(path)
+        return None if ckey is None else self.get_file_by_ckey(ckey,max_size)
+
+    def get_install_manifest(self):
+        """ The build's parsed install manifest (see CASCUtils.InstallManifest) """
+        if getattr(self,"install_manifest",None) is None:
+            self.install_manifest = parse_install_file(self.get_file_by_ckey(self.install_ckey))
+        return self.install_manifest
+
+    def get_download_manifest(self):
+        """ The build's parsed download manifest (see CASCUtils.DownloadManifest) """
+        if getattr(self,"download_manifest",None) is None:
+            self.download_manifest = parse_download_file(self.get_file_by_ckey(self.build_config['download'].split()[0]))
+        return self.download_manifest
+
+    def get_size_manifest(self):
+        """ The build's parsed size manifest (see CASCUtils.SizeManifest) """
+        if getattr(self,"size_manifest",None) is None:
+            self.size_manifest = parse_size_file(self.get_file_by_ckey(self.size_ckey))
+        return self.size_manifest
+
+    def get_content_size(self, ckey):
+        """ A file's decoded size as the encoding table lists it, or None. Never touches the file. """
+        if isinstance(ckey,str):
+            ckey=int(ckey,16)
+        return getattr(self,"ckey_sizes",{}).get(ckey)
+
+    def get_encoded_size_by_ckey(self, ckey):
+        """ A file's encoded (stored) size as the size manifest lists it, or None. Only the size manifest is ever read. """
+        if isinstance(ckey,str):
+            ckey=int(ckey,16)
+        if ckey not in self.ckey_map:
+            return None
+        sm = self.get_size_manifest()
+        width = min(sm.ekey_size,self.EKEY_SIZE) # the manifest's keys are cut to its own width, ours to EKEY_SIZE
+        return sm.size_of((self.ckey_map[ckey]>>8*(self.EKEY_SIZE-width)).to_bytes(width,'big'))
+
+    def get_chunk_table_by_ckey(self, ckey):
+        """ A file's blte header (size, flags, chunk count, [(compressed size, decompressed size, checksum)]), or None.
+        Served from the chunk table cache (see utils.chunktable) once the file's header has been read, in any process. """
+        finfo = self.get_file_info_by_ckey(ckey)
+        if finfo is None:
+            return None
+        ekey = short_ekey(finfo.ekey,self.EKEY_SIZE)
+        blte_header = open_chunk_cache().get(ekey)
+        if blte_header is None:
+            blte_header = self._read_blte_header(finfo)
+            self._remember_blte_header(finfo,blte_header)
+        return blte_header
+
+    def _remember_blte_header(self, finfo, blte_header):
+        try:
+            open_chunk_cache().put(short_ekey(finfo.ekey,self.EKEY_SIZE),blte_header)
+        except OSError: # an unwritable cache directory only costs us the header reads
+            pass
+
+    def _read_blte_header(self, finfo):
+        raise NotImplementedError()
+
+    def ckey_by_ekey(self, ekey):
+        """ Maps an ekey (bytes, at least 9 long) back to its ckey, or None if the encoding table doesn't list it """
+        if getattr(self,"ekey_ckeys",None) is None:
+            self.ekey_ckeys = {short_ekey(ek,self.EKEY_SIZE):ck for ck,ek in self.ckey_map.items()}
+        return self.ekey_ckeys.get(int.from_bytes(ekey[:9],'big'))
+
+    def ckeys_by_ekeys(self, ekeys):
+        """ Maps ekeys back to ckeys, leaving out the ones the encoding table doesn't list """
+        ckeys = map(self.ckey_by_ekey,ekeys)
+        return [ck for ck in ckeys if ck is not None]
+
+    def ckeys_by_tags(self, *tags, exclude=(), manifest="install"):
+        """ Returns the ckeys of the files tagged with every one of tags and none of exclude, in the install (or download) manifest.
+        e.g. ckeys_by_tags("Windows","enUS","x86_64"), which can go straight to fetch_files_by_ckeys or an export. """
+        if manifest == "install":
+            im = self.get_install_manifest()
+            return [im.ckey(i) for i in im.select(*tags,exclude=exclude)]
+        dm = self.get_download_manifest()
+        return self.ckeys_by_ekeys(dm.ekey(i) for i in dm.select(*tags,exclude=exclude))
+
+    def _is_indexed(self, ekey):
+        """ Whether an ekey is present in this storage's file table """
+        return ekey in self.file_table
 
     def get_name(self,ckey):
         fi = self.get_file_info_by_ckey(ckey)
@@ -162,26 +324,69 @@ class CASCReader:
 
     def list_files(self):
         """Returns a list of tuples, each tuple of format (FileName, CKey)"""
-        files = []
+        files = [(name,ckey) for name,ckey in self.iter_root_names() if ckey in self.ckey_map and self._is_indexed(self.ckey_map[ckey])]
         for x in self.ckey_map:
             first_ekey = self.ckey_map[x]
-            if first_ekey in self.file_table: # check if the ckey_map entry is inside the file.
+            if self._is_indexed(first_ekey): # check if the ckey_map entry is inside the file.
                 finfo = self.get_file_info_by_ckey(x)
                 if finfo is not None and hasattr(finfo,'name'):
                     files.append((finfo.name,x))
         return files
     
+    def get_name_index(self):
+        """ A NameIndex over list_files(), for substring, extension and fuzzy searches of the file names (see PyCASC.nameindex).
+        It's built on first use and kept in the cache directory, under the build and whatever else decides the names
+        (the root view, the install file, a wow listfile). """
+        if getattr(self,"name_index",None) is None:
+            view = getattr(self,"root_view",None)
+            view = "" if view is None else f"{view.locales:x}.{view.exclude_flags:x}.{view.platform_flags:x}"
+            names = f"{self.build_config_hash}|{view}|{len(self.file_translate_table)}|{len(getattr(self,'listed_files',None) or ())}"
+            self.name_index = load_name_index(hashlib.sha1(names.encode()).hexdigest(),self.list_files)
+        return self.name_index
+
     def list_unnamed_files(self):
         """Returns a list of tuples, each tuple of format (Ckey,Ckey) (to match with named files list)"""
         files = []
+        left_out = {ckey for _,ckey in self.iter_root_names()} # listed by name, or not at all
+        left_out.update(self.get_hidden_ckeys())
         for ckey in self.ckey_map:
             first_ekey = self.ckey_map[ckey]
-            if first_ekey in self.file_table:
+            if self._is_indexed(first_ekey):
                 finfo = self.get_file_info_by_ckey(ckey)
-                if finfo is not None and not hasattr(finfo,'name'):
+                if finfo is not None and not hasattr(finfo,'name') and ckey not in left_out:
                     files.append((ckey,ckey))
         return files
 
+    def iter_files(self, batch_size=4096):
+        """ list_files and list_unnamed_files in one pass, in batches: yields (named, unnamed) lists of at most batch_size files 
+        between them, in the same formats. Reports "listing" progress, so a viewer can show files as they're resolved. """
+        named,unnamed = [],[]
+        left_out = set() # listed by name, or not at all
+        for name,ckey in self.iter_root_names():
+            left_out.add(ckey)
+            if ckey in self.ckey_map and self._is_indexed(self.ckey_map[ckey]):
+                named.append((name,ckey))
+                if len(named) >= batch_size:
+                    self.on_progress("listing",0)
+                    yield named,[]
+                    named = []
+        left_out.update(self.get_hidden_ckeys())
+        total = max(len(self.ckey_map),1)
+        for i,ckey in enumerate(list(self.ckey_map)):
+            if self._is_indexed(self.ckey_map[ckey]):
+                finfo = self.get_file_info_by_ckey(ckey)
+                if finfo is not None:
+                    if hasattr(finfo,'name'):
+                        named.append((finfo.name,ckey))
+                    elif ckey not in left_out:
+                        unnamed.append((ckey,ckey))
+            if len(named)+len(unnamed) >= batch_size:
+                self.on_progress("listing",100*i/total)
+                yield named,unnamed
+                named,unnamed = [],[]
+        self.on_progress("listing",100)
+        yield named,unnamed
+
     def get_file_size_by_ckey(self,ckey):
         raise NotImplementedError()
 
@@ -191,70 +396,125 @@ class CASCReader:
     def get_file_by_ckey(self,ckey,max_size=-1):
         raise NotImplementedError()
 
+    def iter_file_chunks_by_ckey(self,ckey,start_chunk=0):
+        """ Yields a file's decoded chunks one at a time as (chunk info, data) (see CASCUtils.iter_blte), for writing big files
+        without holding them in memory. start_chunk skips the chunks before it. """
+        raise NotImplementedError()
+
+    def read_range_by_ckey(self,ckey,offset,size):
+        """ Bytes [offset, offset+size) of a file's contents, reading and decoding only the chunks they fall in 
+        (found with the file's chunk table, see get_chunk_table_by_ckey). Returns None if there's no such file. """
+        finfo = self.get_file_info_by_ckey(ckey)
+        if finfo is None:
+            return None
+        blte_header = self.get_chunk_table_by_ckey(ckey)
+        if blte_header[0] == 0: # a single chunk and no table, the whole file it is
+            return bytes(self.get_file_by_ckey(ckey)[offset:offset+size])
+        chunks,enc_start,dec_start = blte_chunk_span(blte_header,offset,size)
+        if len(chunks) == 0:
+            return b''
+        raw = self._read_encoded_range(finfo,enc_start,sum(c[0] for c in chunks))
+        data = b''.join(decode_blte_chunks(raw,chunks))
+        return data[offset-dec_start:offset-dec_start+size]
+
+    def _read_encoded_range(self,finfo,start,size):
+        """ size bytes of a file's blte data, starting start bytes into it """
+        raise NotImplementedError()
+
     def get_file_info_by_ckey(self,ckey: Union[int,str]):
         raise NotImplementedError()
 
+    def fetch_files_by_ckeys(self,ckeys,workers=4):
+        """ Fetches many files at once, yielding (ckey, data) for each one that exists. Readers that can batch reads override this. """
+        ckeys = [x for x in ckeys if self.get_file_info_by_ckey(x) is not None]
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            yield from zip(ckeys,ex.map(self.get_file_by_ckey,ckeys))
+
     def is_file_fetchable(self,ckey,include_cdn=True):
         raise NotImplementedError()
 
+    def warm_cache(self,ckeys,workers=4):
+        """ Makes sure every file of ckeys can be read without the network, returns how many bytes that took fetching.
+        Local storages have nothing to fetch. """
+        return 0
+
     def on_progress(self,step,pct):
-        """ Override me! 
-        This function receives progress update events for anything that takes time in the program.
-        **Not implemented yet** """
+        """ Override me! (or pass on_progress= to a reader)
+        This function receives progress update events for anything that takes time in the program: loading steps 
+        ("config","indexes","encoding","root","install","names") as they go from 0 to 100 pct, and "listing" from iter_files. 
+        Called on whichever thread is doing the work. Raise LoadCancelled from it to abort that work. """
         pass
 
-from PyCASC.launcher import getProductCDNFile, getProductVersions, isCDNFileCached
+from PyCASC.sources import CDNSource, MirrorSource
+from PyCASC.prefetch import Prefetcher
 from PyCASC.utils.blizzutils import parse_build_config
-from PyCASC.utils.CASCUtils import parse_blte
+from PyCASC.utils.CASCUtils import parse_blte, iter_blte
+from PyCASC.utils.archivegroup import load_archive_group
+from PyCASC.utils.chunktable import open_chunk_cache, blte_sizes
+from PyCASC.nameindex import load_name_index
+from PyCASC.fetchplan import plan_ranges, execute_plan, DEFAULT_MAX_GAP
 class CDNCASCReader(CASCReader):
-    def __init__(self, product, region="us", read_install_file=False):
+    EKEY_SIZE = 16
+    def __init__(self, product, region="us", read_install_file=False, source=None, root_view=None, on_progress=None):
+        """ source is where versions and cdn files come from, by default Blizzard's cdn (CDNSource). 
+        Pass a MirrorSource to read a local copy of the cdn instead. 
+        root_view limits a wow reader to some locales/content (see rootfiles.wow.WOWROOT_View) 
+        on_progress replaces the reader's on_progress hook, and already receives the loading steps. """
+        if on_progress is not None:
+            self.on_progress = on_progress
+        self.on_progress("config",0)
         self.product = product
+        self.region = region
+        self.root_view = root_view
+        self.source = source if source is not None else CDNSource(product,region)
 
-        vrs = [x for x in getProductVersions(product) if x['Region']==region]
+        vrs = [x for x in self.source.versions() if x['Region']==region]
         if len(vrs)==0:
             raise Exception(f"Product {product} or Region {region} invalid. Cannot load CASC data")
 
         vr = vrs[0]
         bc = vr['BuildConfig']
-        bc_f = getProductCDNFile(product,bc,region,ftype="config",enc="utf-8")
+        self.build_config_hash = bc
+        self.cdn_config_hash = vr['CDNConfig']
+        bc_f = self.source.get_file(bc,ftype="config",enc="utf-8")
         self.build_config = parse_build_config(bc_f)
 
-        cdn_f = parse_build_config(getProductCDNFile(product,vr['CDNConfig'],region,ftype="config",enc="utf-8"))
+        cdn_f = parse_build_config(self.source.get_file(vr['CDNConfig'],ftype="config",enc="utf-8"))
         archives = cdn_f['archives'].split()
-        self.file_table={} # ckey -> fileinfo, populated over time instead of all at once, unlike DirCASCReader
-
-        for a in archives:
-            i = getProductCDNFile(product,a,region,ftype="data",index=True,cache_dur=-1)
-            try:
-                ed=r_cidx(i)
-                for xi in ed:
-                    if xi in self.file_table:
-                        continue
-                    x=ed[xi]
-                    x.data_file=a
-                    self.file_table[xi] = x
-            except AssertionError as e:
-                print("archive index file " + a + " did not match assertions, ignoring this for now since it only causes minor issues.")
-                # raise e
+        self.on_progress("config",100)
+        fetched = [0]
+        def get_index(a):
+            self.on_progress("indexes",100*fetched[0]/len(archives))
+            fetched[0]+=1
+            return self.source.get_file(a,index=True,cache_dur=-1)
+        # every archive index merged into one sorted table on disk, built once per cdn config.
+        self.archive_group = load_archive_group(vr['CDNConfig'],archives,get_index)
+        self.on_progress("indexes",100)
+        self.file_table={} # ekey -> fileinfo, populated over time from the archive group instead of all at once, unlike DirCASCReader
                 
-        print(f"[ETBL] {len(self.file_table)}")
+        print(f"[ETBL] {len(self.archive_group)}")
 
         self.uid = self.build_config['build-uid']
         root_ckey = self.build_config['root']
         enc_hash1,enc_ekey = self.build_config['encoding'].split()
         self.install_ckey,_ = self.build_config['install'].split()
         download_hash1,_ = self.build_config['download'].split()
-        size_hash1,_ = self.build_config['size'].split()
+        self.size_ckey,_ = self.build_config['size'].split()
 
-        encfile = getProductCDNFile(product,enc_ekey,region,ftype="data",cache_dur=-1) # enc files never change. not that i know of
+        self.on_progress("encoding",0)
+        encfile = self.source.get_file(enc_ekey,cache_dur=-1) # enc files never change. not that i know of
         encfile = parse_blte(encfile)[1]
 
-        self.ckey_map = parse_encoding_file(encfile,whole_key=True)
+        self.ckey_sizes = {} # ckey -> content size, so sizes never need the file itself
+        self.ckey_map = parse_encoding_file(encfile,whole_key=True,sizes=self.ckey_sizes)
         print(f"[CTBL] {len(self.ckey_map)}")
+        self.on_progress("encoding",100)
 
+        self.on_progress("root",0)
         root_file = self.get_file_by_ckey(root_ckey)
         self.file_translate_table = parse_root_file(self.uid,root_file,self) # maps some ID(can be filedataid, path, whatever) -> ckey
         print(f"[FTTBL] {len(self.file_translate_table)}")
+        self.on_progress("root",100)
 
         self.file_translate_table.append((NAMED_FILE,"_ROOT",root_ckey))
         
@@ -262,9 +522,9 @@ class CDNCASCReader(CASCReader):
         self.file_translate_table.append((NAMED_FILE,"_ENCODING",enc_hash1))
         self.file_translate_table.append((NAMED_FILE,"_INSTALL",self.install_ckey))
         self.file_translate_table.append((NAMED_FILE,"_DOWNLOAD",download_hash1))
-        self.file_translate_table.append((NAMED_FILE,"_SIZE",size_hash1))
+        self.file_translate_table.append((NAMED_FILE,"_SIZE",self.size_ckey))
 
-        if product == "wow":
+        if product == "wow" and os.path.exists(LISTFILE[0]): # without one, files are unnamed but still open_by_path-able
             if LISTFILE[1] == "82":
                 self.listed_files = prep_82_listfile(LISTFILE[0])
             else:
@@ -275,7 +535,7 @@ class CDNCASCReader(CASCReader):
         if product == "wow":
             tk_list = []
             tk_lookup = []
-            for x in self.listed_files:
+            for x in getattr(self,"listed_files",{}):
                 if self.listed_files[x].lower() == "dbfilesclient/tactkey.db2":
                     pass
                 elif self.listed_files[x].lower() == "dbfilesclient/tactkeylookup.db2":
@@ -294,36 +554,49 @@ class CDNCASCReader(CASCReader):
                 finfo.ckey = ckey
             return finfo
         else:
-            if ckey not in self.ckey_map:
-                return None
             fi = FileInfo()
             fi.ckey = ckey
             fi.ekey = self.ckey_map[ckey]
+            archived = self.archive_group.lookup(fi.ekey)
+            if archived is not None:
+                fi.data_file,fi.offset,fi.compressed_size = archived
             self.file_table[fi.ekey]=fi
             return fi
 
-    def _get_file_blte(self,finfo,with_data=True,max_size=-1):
-        from requests.exceptions import HTTPError
+    def _is_indexed(self, ekey):
+        return ekey in self.file_table or ekey in self.archive_group
+
+    def _get_encoded_file(self,finfo,max_size=-1):
+        """ Returns a file's raw BLTE data, as stored on the cdn """
         if hasattr(finfo,"data_file") and finfo.data_file is not None:
             # archives never expire
-            archive_file = getProductCDNFile(self.product,finfo.data_file,cache_dur=-1,offset=finfo.offset,size=finfo.compressed_size)
-            return parse_blte(archive_file) #[finfo.offset:finfo.offset+finfo.compressed_size]
+            return self.source.get_file(finfo.data_file,cache_dur=-1,offset=finfo.offset,size=finfo.compressed_size)
         else:
             ekey = f"{finfo.ekey:032x}"
             # print(ekey,f"{finfo.ckey:032x}")
             # These files should also never expire, since if they did their ckey would be different. 
             #  but for sanity i'll keep for 10 days
-            return parse_blte(getProductCDNFile(self.product,ekey,max_size=max_size,cache_dur=3600*24*10),read_data=with_data)
+            return self.source.get_file(ekey,max_size=max_size,cache_dur=3600*24*10)
+
+    def _get_file_blte(self,finfo,with_data=True,max_size=-1):
+        blte = parse_blte(self._get_encoded_file(finfo,max_size),read_data=with_data)
+        self._remember_blte_header(finfo,blte[0])
+        return blte
+
+    def _read_blte_header(self,finfo):
+        if self.is_file_fetchable(finfo.ckey,include_cdn=False):
+            return self._get_file_blte(finfo,with_data=False)[0]
+        # not cached, only download the header: its preamble, then its chunk table
+        return read_blteheader(lambda start,size:self._read_encoded_range(finfo,start,size))
 
     def _populate_file_info_sizes(self,finfo):
-        blte_header,_ = self._get_file_blte(finfo,with_data=False)
-        finfo.chunk_count=len(blte_header[3])
-        finfo.uncompressed_size=0
-        for c in blte_header[3]: # for each chunk
-            finfo.uncompressed_size+=c[1]
+        finfo.uncompressed_size, finfo.chunk_count = blte_sizes(self.get_chunk_table_by_ckey(finfo.ckey))
 
     def get_file_size_by_ckey(self, ckey):
-        try:
+        size = self.get_content_size(ckey)
+        if size is not None:
+            return size
+        try: # only files the encoding table doesn't list (the encoding file itself) need their BLTE header read
             finfo = self.get_file_info_by_ckey(ckey)
             if finfo == None:
                 return None
@@ -349,7 +622,71 @@ class CDNCASCReader(CASCReader):
         if finfo is None:
             return None
         return self._get_file_blte(finfo,max_size=max_size)[1]
+
+    def iter_file_chunks_by_ckey(self,ckey,start_chunk=0):
+        finfo = self.get_file_info_by_ckey(ckey)
+        if finfo is None:
+            return
+        yield from iter_blte(self._get_encoded_file(finfo),start_chunk)
+
+    def _read_encoded_range(self,finfo,start,size):
+        if self.is_file_fetchable(finfo.ckey,include_cdn=False):
+            return self._get_encoded_file(finfo)[start:start+size]
+        # not cached, only download the bytes we're after
+        if hasattr(finfo,"data_file") and finfo.data_file is not None:
+            return self.source.fetch_range(finfo.data_file,finfo.offset+start,size,cache=False)
+        return self.source.fetch_range(f"{finfo.ekey:032x}",start,size,cache=False)
     
+    def fetch_files_by_ckeys(self,ckeys,workers=4,max_gap=DEFAULT_MAX_GAP,raw=False):
+        """ Fetches many files at once, yielding (ckey, data) as each one arrives. 
+        Archived files are planned into as few ranged requests per archive as possible (see fetchplan.plan_ranges), 
+        and each file's bytes are stored in the cache so later reads of it don't touch the network. 
+        With raw, data is the file's encoded BLTE data instead of its contents. """
+        locations, other = [], []
+        for ckey in ckeys:
+            finfo = self.get_file_info_by_ckey(ckey)
+            if finfo is None:
+                continue
+            if hasattr(finfo,"data_file") and finfo.data_file is not None and not self.is_file_fetchable(ckey,include_cdn=False):
+                locations.append((ckey,finfo.data_file,finfo.offset,finfo.compressed_size))
+            else: # loose, or already cached
+                other.append(ckey)
+
+        fetch = lambda archive,offset,size: self.source.fetch_range(archive,offset,size,cache=False)
+        for (ckey,archive,offset,size),blte in execute_plan(plan_ranges(locations,max_gap),fetch,workers):
+            self.source.put_range(archive,offset,size,blte) # cached per file, which is how get_file_by_ckey will look for it
+            yield ckey,blte if raw else parse_blte(blte)[1]
+
+        get = (lambda c:self._get_encoded_file(self.get_file_info_by_ckey(c))) if raw else self.get_file_by_ckey
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            yield from zip(other,ex.map(get,other))
+
+    def warm_cache(self,ckeys,workers=4,max_gap=DEFAULT_MAX_GAP):
+        """ Downloads the files of ckeys that aren't cached yet, the archived ones in as few ranged requests as possible. """
+        locations, loose = [], []
+        for ckey in ckeys:
+            finfo = self.get_file_info_by_ckey(ckey)
+            if finfo is None or self.is_file_fetchable(ckey,include_cdn=False):
+                continue
+            if hasattr(finfo,"data_file") and finfo.data_file is not None:
+                locations.append((ckey,finfo.data_file,finfo.offset,finfo.compressed_size))
+            else:
+                loose.append(finfo)
+
+        fetched = 0
+        fetch = lambda archive,offset,size: self.source.fetch_range(archive,offset,size,cache=False)
+        for (ckey,archive,offset,size),blte in execute_plan(plan_ranges(locations,max_gap),fetch,workers):
+            self.source.put_range(archive,offset,size,blte)
+            fetched += len(blte)
+        with ThreadPoolExecutor(max_workers=workers) as ex: # get_file caches them
+            fetched += sum(len(x) for x in ex.map(self._get_encoded_file,loose))
+        return fetched
+
+    def prefetch(self, tags=(), exclude=(), budget=-1, workers=8, per_host=4, bandwidth=None):
+        """ Starts warming the cache in the background with the files the download manifest tags with tags, 
+        most needed first, up to budget bytes. Returns the running Prefetcher (see prefetch.Prefetcher). """
+        return Prefetcher(self,tags,exclude,budget,workers,per_host,bandwidth).start()
+
     def is_file_fetchable(self, ckey, include_cdn=True):
         if include_cdn:
             return self.get_file_info_by_ckey(ckey) is not None
@@ -358,25 +695,33 @@ class CDNCASCReader(CASCReader):
             if finfo is None:
                 return False
             if hasattr(finfo,"data_file") and finfo.data_file is not None:
-                return isCDNFileCached(self.product,finfo.data_file,cache_dur=-1)
+                return self.source.is_cached(finfo.data_file,cache_dur=-1) or self.source.is_cached(finfo.data_file,cache_dur=-1,offset=finfo.offset,size=finfo.compressed_size)
             else:
                 ekey = f"{finfo.ekey:032x}"
-                return isCDNFileCached(self.product,ekey,cache_dur=3600*24*10)
+                return self.source.is_cached(ekey,cache_dur=3600*24*10)
 
 class DirCASCReader(CASCReader):
-    def __init__(self,path,read_install_file=True):
+    EKEY_SIZE = 9 # local indexes only keep the first 9 bytes
+    def __init__(self,path,read_install_file=True,root_view=None,on_progress=None):
+        """ on_progress replaces the reader's on_progress hook, and already receives the loading steps. """
+        if on_progress is not None:
+            self.on_progress = on_progress
+        self.on_progress("config",0)
         if not os.path.exists(path+"/.build.info") or not os.path.exists(path+"/Data/data"):
             raise Exception("Not a valid CASC datapath")
         self.path = path
+        self.root_view = root_view
         self.build_path = self.path+"/.build.info"
         self.data_path = self.path+"/Data/data/"
 
         build_file,self.build_config=None,None
         with open(self.build_path,"r") as b:
             build_file = parse_config(b.read())[0]
+        self.build_config_hash = build_file['Build Key']
         with open(path+"/Data/config/"+prefix_hash(build_file['Build Key']),"r") as b:
             self.build_config = parse_build_config(b.read())
         print("[BF]")
+        self.on_progress("config",100)
 
         assert build_file is not None and self.build_config is not None
 
@@ -385,31 +730,38 @@ class DirCASCReader(CASCReader):
         enc_hash1,enc_hash2 = self.build_config['encoding'].split()
         self.install_ckey,_ = self.build_config['install'].split()
         download_hash1,_ = self.build_config['download'].split()
-        size_hash1,_ = self.build_config['size'].split()
+        self.size_ckey,_ = self.build_config['size'].split()
 
         self.file_table = {} # maps ekey -> fileinfo (size, datafile, offset)
-        files = os.listdir(self.data_path)
-        for x in files:
-            if x[-4:]==".idx":
-                # i,v=x[:2],x[2:-4]
-                ents=r_idx(self.data_path+x)
-                for e in ents:
-                    if e.ekey not in self.file_table: # since apparently duplicates exist and are wrong.... YAY!
-                        self.file_table[e.ekey]=e
+        files = [x for x in os.listdir(self.data_path) if x[-4:]==".idx"]
+        for i,x in enumerate(files):
+            self.on_progress("indexes",100*i/len(files))
+            # i,v=x[:2],x[2:-4]
+            ents=r_idx(self.data_path+x)
+            for e in ents:
+                if e.ekey not in self.file_table: # since apparently duplicates exist and are wrong.... YAY!
+                    self.file_table[e.ekey]=e
 
         print(f"[ETBL] {len(self.file_table)}")
+        self.on_progress("indexes",100)
 
+        self.on_progress("encoding",0)
         enc_info = self.file_table[int(enc_hash2[:18],16)]
         enc_file = r_cascfile(self.data_path,enc_info.data_file,enc_info.offset)
         
         # Load the CKEY MAP from the encoding file.
-        self.ckey_map = parse_encoding_file(enc_file) # maps ckey(hexstr) -> ekey(int of first 9 bytes)
+        self.ckey_sizes = {} # ckey -> content size, so sizes never need the data files
+        self.ckey_map = parse_encoding_file(enc_file,sizes=self.ckey_sizes) # maps ckey(hexstr) -> ekey(int of first 9 bytes)
         print(f"[CTBL] {len(self.ckey_map)}")
+        self.on_progress("encoding",100)
+
+        self.on_progress("root",0)
 
         # print(root_ckey,self.ckey_map[int(root_ckey,16)],self.file_table[self.ckey_map[int(root_ckey,16)]])
         root_file = self.get_file_by_ckey(root_ckey)
         self.file_translate_table = parse_root_file(self.uid,root_file,self) # maps some ID(can be filedataid, path, whatever) -> ckey
         print(f"[FTTBL] {len(self.file_translate_table)}")
+        self.on_progress("root",100)
 
         self.file_translate_table.append((NAMED_FILE,"_ROOT",root_ckey))
         
@@ -417,7 +769,7 @@ class DirCASCReader(CASCReader):
         self.file_translate_table.append((NAMED_FILE,"_ENCODING",enc_hash1))
         self.file_translate_table.append((NAMED_FILE,"_INSTALL",self.install_ckey))
         self.file_translate_table.append((NAMED_FILE,"_DOWNLOAD",download_hash1))
-        self.file_translate_table.append((NAMED_FILE,"_SIZE",size_hash1))
+        self.file_translate_table.append((NAMED_FILE,"_SIZE",self.size_ckey))
 
         CASCReader.__init__(self, read_install_file)
         
@@ -425,8 +777,11 @@ class DirCASCReader(CASCReader):
         finfo = self.get_file_info_by_ckey(ckey)
         if finfo == None:
             return None
+        size = self.get_content_size(ckey)
+        if size is not None:
+            return size
         if not hasattr(finfo,"uncompressed_size") or finfo.uncompressed_size is None:
-            finfo.uncompressed_size, finfo.chunk_count = cascfile_size(self.data_path,finfo.data_file,finfo.offset)
+            finfo.uncompressed_size, finfo.chunk_count = blte_sizes(self.get_chunk_table_by_ckey(ckey))
         return finfo.uncompressed_size
 
     def get_chunk_count_by_ckey(self,ckey):
@@ -434,14 +789,26 @@ class DirCASCReader(CASCReader):
         if finfo == None:
             return None
         if not hasattr(finfo,"chunk_count") or finfo.chunk_count is None:
-            finfo.uncompressed_size, finfo.chunk_count = cascfile_size(self.data_path,finfo.data_file,finfo.offset)
+            finfo.uncompressed_size, finfo.chunk_count = blte_sizes(self.get_chunk_table_by_ckey(ckey))
         return finfo.chunk_count
 
+    def _read_blte_header(self,finfo):
+        return cascfile_blteheader(self.data_path,finfo.data_file,finfo.offset)
+
     def get_file_by_ckey(self,ckey,max_size=-1):
         finfo = self.get_file_info_by_ckey(ckey)
         if finfo is None:
             return None
         return r_cascfile(self.data_path,finfo.data_file,finfo.offset,max_size)
+
+    def iter_file_chunks_by_ckey(self,ckey,start_chunk=0):
+        finfo = self.get_file_info_by_ckey(ckey)
+        if finfo is None:
+            return
+        yield from iter_cascfile(self.data_path,finfo.data_file,finfo.offset,start_chunk)
+
+    def _read_encoded_range(self,finfo,start,size):
+        return r_cascfile_range(self.data_path,finfo.data_file,finfo.offset,start,size)
     
     def get_file_info_by_ckey(self, ckey):
         """Takes ckey in either int form or hex form"""
@@ -457,6 +824,8 @@ class DirCASCReader(CASCReader):
         finfo = self.get_file_info_by_ckey(ckey)
         return finfo is not None
 
+from PyCASC.diff import diff_builds, BuildDiff
+
 if __name__ == '__main__':
     import cProfile, io
     from pstats import SortKey,Stats
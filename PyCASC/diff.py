@@ -0,0 +1,81 @@
+from typing import List, Set
+from PyCASC.utils.CASCUtils import short_ekey, WOW_DATAID_FILE
+from PyCASC.rootfiles.wow import WOWROOT_View
+
+class BuildDiff:
+    """ The differences between two builds of a product, see diff_builds.
+    Files are identified by their root/install id (a path, FileDataID, SNO id, ...), and compared by ckey. 
+    A wow file is listed once per locale and content group of the root it changed in (see _diff_rows). """
+    added:List[tuple] # (id, ckey)
+    removed:List[tuple] # (id, ckey)
+    changed:List[tuple] # (id, old ckey, new ckey)
+    renamed:List[tuple] # (old id, new id, ckey)
+    new_ekeys:Set[int] # ekeys of the new build that the old build doesn't have
+
+    def __init__(self, new_reader):
+        self.new_reader = new_reader
+        self.added = []
+        self.removed = []
+        self.changed = []
+        self.renamed = []
+        self.new_ekeys = set()
+
+    def new_content_ckeys(self):
+        """ The ckeys of added and changed files whose encoded data isn't in the old build at all """
+        ckey_map,ekey_size = self.new_reader.ckey_map,self.new_reader.EKEY_SIZE
+        ckeys = {x[1] for x in self.added} | {x[2] for x in self.changed}
+        return [c for c in ckeys if c in ckey_map and short_ekey(ckey_map[c],ekey_size) in self.new_ekeys]
+
+    def fetch_new_content(self, workers=4):
+        """ Incremental fetch, yields (ckey, data) for just the content that is new in the new build """
+        return self.new_reader.fetch_files_by_ckeys(self.new_content_ckeys(),workers=workers)
+
+    def __repr__(self):
+        return f"<BuildDiff +{len(self.added)} -{len(self.removed)} ~{len(self.changed)} >{len(self.renamed)} ({len(self.new_ekeys)} new ekeys)>"
+
+def _diff_rows(reader):
+    """ {(kind, id, group): ckey} over a reader's translate table. A wow root lists a file data id once per locale and content
+    group, each with a ckey of its own, so those rows are keyed by their (content flags, locale flags) too. Other rows' group is None. """
+    wow_root = getattr(reader,"wow_root",None)
+    rows = {(t,i,None):c for t,i,c in reader.iter_translate_table() if wow_root is None or t != WOW_DATAID_FILE}
+    if wow_root is not None:
+        view = getattr(reader,"root_view",None) or WOWROOT_View()
+        ckeys = wow_root.ckeys
+        for group,ranges in wow_root.groups.items():
+            if not view.matches(*group):
+                continue
+            for start,end in ranges:
+                for row,fdid in enumerate(wow_root.fdids[start:end],start):
+                    rows[(WOW_DATAID_FILE,fdid,group)] = int.from_bytes(ckeys[row*16:row*16+16],'big')
+    return rows
+
+def diff_builds(old_reader, new_reader):
+    """ Compares two readers' encoding and translate tables, returning a BuildDiff of added, removed, changed and renamed files.
+    A file is renamed when its id is gone, and a new id has the exact same ckey. """
+    diff = BuildDiff(new_reader)
+
+    old_ekeys = {short_ekey(x,old_reader.EKEY_SIZE) for x in old_reader.ckey_map.values()}
+    diff.new_ekeys = {short_ekey(x,new_reader.EKEY_SIZE) for x in new_reader.ckey_map.values()} - old_ekeys
+
+    old_files = _diff_rows(old_reader)
+    new_files = _diff_rows(new_reader)
+
+    gone = {}  # ckey -> ids that were removed with that ckey
+    for k in old_files.keys() - new_files.keys():
+        gone.setdefault(old_files[k],[]).append(k)
+
+    for k in new_files.keys() - old_files.keys():
+        ckey = new_files[k]
+        if ckey in gone and len(gone[ckey]):
+            diff.renamed.append((gone[ckey].pop()[1],k[1],ckey))
+        else:
+            diff.added.append((k[1],ckey))
+
+    for ckey in gone:
+        diff.removed.extend((k[1],ckey) for k in gone[ckey])
+
+    for k in old_files.keys() & new_files.keys():
+        if old_files[k] != new_files[k]:
+            diff.changed.append((k[1],old_files[k],new_files[k]))
+
+    return diff
@@ -0,0 +1,435 @@
+import os
+import re
+import sys
+import shutil
+import struct
+import threading
+from array import array
+from time import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+PART_SUFFIX = ".part" # files being written are named path.<ckey>.part until they're complete
+FICLONE = 0x40049409 # linux ioctl making dst share src's extents (btrfs, xfs)
+
+MANIFEST_NAME = ".pycasc-export"
+MANIFEST_MAGIC = b"PCEM"
+MANIFEST_VERSION = 1
+_manifest_header = struct.Struct("<4sII") # magic, version, entry count
+
+def safe_join(dest, path):
+    """ dest/path, with path's separators normalized and anything that would climb out of dest (.., drive letters, leading /) dropped """
+    parts = [p.replace(":","_") for p in path.replace("\\","/").split("/") if p not in ("",".","..")]
+    return os.path.join(dest,*parts)
+
+def part_path(target, ckey):
+    """ Where target is written until it's complete. The ckey in the name keeps a .part from ever being resumed with other content. """
+    return f"{target}.{ckey:032x}{PART_SUFFIX}"
+
+_part_name = re.compile(r"\.[0-9a-f]{32}"+re.escape(PART_SUFFIX)+"$")
+
+def link_file(src, dst):
+    """ Makes dst a copy of src without writing the data again where the filesystem allows: a hard link, else a reflink, 
+    else a plain copy. Returns which one it made: "link", "reflink" or "copy". """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src,dst)
+        return "link"
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(src,"rb") as s, open(dst,"wb") as d:
+            fcntl.ioctl(d.fileno(),FICLONE,s.fileno())
+        return "reflink"
+    except (ImportError,OSError):
+        pass
+    shutil.copyfile(src,dst)
+    return "copy"
+
+def load_manifest(dest):
+    """ The manifest a sync export left in dest, {path: (ckey, size, mtime_ns)}, or {} if there's none.
+    It's stored column-wise (ckeys, sizes, mtimes, then the nul separated paths) so millions of entries load in one read. """
+    path = os.path.join(dest,MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path,"rb") as f:
+        data = f.read()
+    magic,version,count = _manifest_header.unpack_from(data,0)
+    if magic != MANIFEST_MAGIC or version != MANIFEST_VERSION:
+        print(f"Ignoring {path}, it's not an export manifest this version can read")
+        return {}
+    p = _manifest_header.size
+    ckeys = data[p:p+16*count]
+    p += 16*count
+    sizes,mtimes = array('Q'),array('q')
+    sizes.frombytes(data[p:p+8*count])
+    mtimes.frombytes(data[p+8*count:p+16*count])
+    paths = data[p+16*count:].decode("utf-8").split("\0") if count else []
+    ckeys = [int.from_bytes(ckeys[i:i+16],'big') for i in range(0,16*count,16)]
+    return dict(zip(paths,zip(ckeys,sizes,mtimes)))
+
+def save_manifest(dest, entries):
+    """ Writes a manifest of {path: (ckey, size, mtime_ns)} to dest, replacing the old one only once it's complete """
+    paths = list(entries)
+    ckeys = b''.join(entries[x][0].to_bytes(16,'big') for x in paths)
+    sizes = array('Q',(entries[x][1] for x in paths))
+    mtimes = array('q',(entries[x][2] for x in paths))
+    path = os.path.join(dest,MANIFEST_NAME)
+    os.makedirs(dest,exist_ok=True)
+    with open(path+".tmp","wb") as f:
+        f.write(_manifest_header.pack(MANIFEST_MAGIC,MANIFEST_VERSION,len(paths)))
+        f.write(ckeys)
+        f.write(sizes.tobytes())
+        f.write(mtimes.tobytes())
+        f.write("\0".join(paths).encode("utf-8"))
+    os.replace(path+".tmp",path)
+
+class ExportItem:
+    """ One unique file to export: decoded into target (unless source, a complete export of the same content, already exists), 
+    then linked to every (path, target) of links """
+    __slots__ = ("path","ckey","target","size","location","links","source")
+
+    def __init__(self, path, ckey, target, size, location, links=(), source=None):
+        self.path = path
+        self.ckey = ckey
+        self.target = target
+        self.size = size
+        self.location = location
+        self.links = links
+        self.source = source
+
+class Exporter:
+    """ Writes files of a reader to disk. items are (path, ckey), paths being relative to dest.
+    Files are written in the order they're stored in (data file or archive, then offset) by `workers` threads, each decoding
+    one chunk at a time straight into the file. On cdn storages each wave of files is downloaded (see CASCReader.warm_cache)
+    while the previous one is being written. A file is written as path.<ckey>.part and renamed once complete: with resume, files
+    already there at full size are skipped and .part files of the same ckey carry on from their last whole chunk.
+    With dedup, paths sharing a ckey are decoded once and the others made hard links to it (reflinks or copies where links 
+    can't be made, see link_file), bytes_saved counting the bytes that didn't need writing.
+    With sync, dest is kept a mirror of items: a manifest of what was exported (see load_manifest) is kept in dest, paths it
+    lists with the same ckey, size and mtime are left alone without being looked at, changed ones are rewritten, and files of
+    paths no longer in items are deleted.
+    on_progress(exporter) is called from the worker threads as files are written, a few times a second at most.
+
+    start() runs it in a background thread, run() in this one. """
+    WAVE_SIZE = 256
+    PROGRESS_INTERVAL = 0.1
+
+    def __init__(self, cr, items, dest, workers=4, resume=True, on_progress=None, dedup=True, sync=False):
+        self.cr = cr
+        self.items = items
+        self.dest = dest
+        self.workers = workers
+        self.resume = resume
+        self.on_progress = on_progress
+        self.dedup = dedup
+        self.sync = sync
+
+        self.files_total = self.bytes_total = 0
+        self.files_done = self.bytes_done = 0 # including the skipped ones
+        self.files_skipped = 0
+        self.bytes_written = 0
+        self.bytes_saved = 0
+        self.files_removed = 0
+        self.completed = [] # paths written (or linked) by this run
+        self.link_sources = {} # ckey -> a complete export of it outside of items, for dedup
+        self.kept = {} # manifest entries of the paths a sync left alone
+        self.errors = [] # (path, exception)
+        self.start_time = None
+        self.last_report = 0
+        self.thread = None
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+
+    def plan(self):
+        """ Returns the ExportItems still to write, in storage order. Sets files_total and bytes_total, and counts finished files as done. """
+        by_ckey = {}
+        for path,ckey in self.items:
+            key = int(ckey,16) if isinstance(ckey,str) else ckey
+            if self.dedup:
+                by_ckey.setdefault(key,[]).append(path)
+            else:
+                by_ckey[(key,path)] = [path]
+
+        todo = []
+        for key,paths in by_ckey.items():
+            ckey = key[0] if not self.dedup else key
+            finfo = self.cr.get_file_info_by_ckey(ckey)
+            if finfo is None:
+                self.errors.extend((path,Exception(f"{ckey:x} is not in this storage")) for path in paths)
+                continue
+            size = self.cr.get_content_size(ckey)
+            if size is None:
+                size = self.cr.get_file_size_by_ckey(ckey)
+            self.files_total += len(paths)
+            self.bytes_total += (size or 0)*len(paths)
+
+            missing,complete = [],None
+            for path in paths:
+                target = safe_join(self.dest,path)
+                # a sync already knows what's complete, a file it doesn't list could be of another build
+                if self.resume and not self.sync and os.path.isfile(target) and os.path.getsize(target) == size:
+                    self.files_done += 1
+                    self.files_skipped += 1
+                    self.bytes_done += size
+                    complete = target
+                else:
+                    missing.append((path,target))
+            if len(missing) == 0:
+                continue
+            if complete is None and self.dedup:
+                complete = self.link_sources.get(ckey)
+            if getattr(finfo,"data_file",None) is not None:
+                location = (0,finfo.data_file,finfo.offset)
+            else:
+                location = (1,finfo.ekey,0)
+            if complete is not None: # nothing to decode, the rest link to the one already there
+                todo.append(ExportItem(None,ckey,complete,size,location,missing,source=complete))
+            else:
+                todo.append(ExportItem(missing[0][0],ckey,missing[0][1],size,location,missing[1:]))
+        todo.sort(key=lambda x:x.location)
+        return todo
+
+    def _report(self, force=False):
+        if self.on_progress is None:
+            return
+        now = time()
+        if force or now-self.last_report >= self.PROGRESS_INTERVAL:
+            self.last_report = now
+            self.on_progress(self)
+
+    def _transferred(self, nfiles, nbytes, written=True):
+        with self.lock:
+            self.files_done += nfiles
+            self.bytes_done += nbytes
+            if written:
+                self.bytes_written += nbytes
+        self._report()
+
+    def _resume_point(self, item, part):
+        """ (chunks, bytes) of a .part file that are already written, up to its last whole chunk """
+        if not self.resume or not os.path.exists(part):
+            return 0,0
+        have = os.path.getsize(part)
+        blte_header = self.cr.get_chunk_table_by_ckey(item.ckey)
+        if blte_header is None or blte_header[0] == 0: # single chunk files start over
+            return 0,0
+        chunks,pos = 0,0
+        for c in blte_header[3]:
+            if pos+c[1] > have:
+                break
+            pos += c[1]
+            chunks += 1
+        return chunks,pos
+
+    def _export(self, item):
+        if self.cancelled.is_set():
+            return
+        if item.source is None and not self._decode(item):
+            return
+        for path,target in item.links:
+            try:
+                os.makedirs(os.path.dirname(target) or ".",exist_ok=True)
+                kind = link_file(item.target,target)
+                with self.lock:
+                    self.completed.append(path)
+                    if kind != "copy":
+                        self.bytes_saved += item.size or 0
+                self._transferred(1,item.size or 0,written=kind == "copy")
+            except Exception as e:
+                with self.lock:
+                    self.errors.append((path,e))
+
+    def _decode(self, item):
+        """ Writes item.target, returns whether it's complete """
+        part = part_path(item.target,item.ckey)
+        try:
+            os.makedirs(os.path.dirname(item.target) or ".",exist_ok=True)
+            start_chunk,written = self._resume_point(item,part)
+            self._transferred(0,written,written=False)
+            with open(part,"r+b" if written else "wb") as f:
+                f.seek(written)
+                f.truncate()
+                for _,data in self.cr.iter_file_chunks_by_ckey(item.ckey,start_chunk):
+                    f.write(data)
+                    self._transferred(0,len(data))
+                    if self.cancelled.is_set(): # the .part stays, to be resumed
+                        return False
+            os.replace(part,item.target)
+            with self.lock:
+                self.completed.append(item.path)
+            self._transferred(1,0)
+            return True
+        except Exception as e:
+            with self.lock:
+                self.errors.append((item.path,e))
+                self.errors.extend((path,e) for path,_ in item.links)
+            return False
+
+    def _prepare_sync(self):
+        """ Compares items against dest's manifest: deletes removed and changed paths' files, and leaves only the paths to
+        (re)write in self.items """
+        old = load_manifest(self.dest)
+        current = {}
+        for path,ckey in self.items:
+            current[path] = int(ckey,16) if isinstance(ckey,str) else ckey
+
+        todo = []
+        for path,ckey in current.items():
+            target = safe_join(self.dest,path)
+            entry = old.get(path)
+            if entry is not None and entry[0] == ckey:
+                try:
+                    st = os.stat(target)
+                    if st.st_size == entry[1] and st.st_mtime_ns == entry[2]:
+                        self.kept[path] = entry
+                        self.link_sources[ckey] = target
+                        continue
+                except OSError:
+                    pass
+            if entry is not None and os.path.lexists(target): # changed since, or touched by someone else
+                os.remove(target)
+            todo.append((path,ckey))
+
+        # .part files of content no longer wanted there: a cancelled run's, of paths removed or changed since
+        wanted = {part_path(safe_join(self.dest,path),ckey) for path,ckey in todo}
+        for root,_,files in os.walk(self.dest):
+            for f in files:
+                f = os.path.join(root,f)
+                if _part_name.search(f) and f not in wanted:
+                    os.remove(f)
+
+        for path in old:
+            if path not in current:
+                target = safe_join(self.dest,path)
+                if os.path.lexists(target):
+                    os.remove(target)
+                    self.files_removed += 1
+                try: # and the folders it leaves empty
+                    os.removedirs(os.path.dirname(target))
+                except OSError:
+                    pass
+
+        self.files_total = self.files_done = self.files_skipped = len(self.kept)
+        self.bytes_total = self.bytes_done = sum(x[1] for x in self.kept.values())
+        self.items = todo
+
+    def _save_sync(self):
+        """ Writes dest's manifest: the paths left alone, and the ones this run completed """
+        entries = dict(self.kept)
+        current = dict(self.items)
+        for path in self.completed:
+            st = os.stat(safe_join(self.dest,path))
+            ckey = current[path]
+            entries[path] = (int(ckey,16) if isinstance(ckey,str) else ckey,st.st_size,st.st_mtime_ns)
+        save_manifest(self.dest,entries)
+
+    def run(self):
+        """ Exports everything, in this thread """
+        self.start_time = time()
+        if self.sync:
+            self._prepare_sync()
+        todo = self.plan()
+        self._report(True)
+        with ThreadPoolExecutor(max_workers=self.workers) as ex:
+            pending = []
+            for i in range(0,len(todo),self.WAVE_SIZE):
+                if self.cancelled.is_set():
+                    break
+                wave = todo[i:i+self.WAVE_SIZE]
+                try: # downloads while the previous wave is being written
+                    self.cr.warm_cache([x.ckey for x in wave],self.workers)
+                except Exception as e: # each file will try again on its own, and report its error
+                    print(f"Failed to prefetch files for export: {e}")
+                wait(pending)
+                pending = [ex.submit(self._export,x) for x in wave]
+            wait(pending)
+        if self.sync: # after a cancel too, so the next sync picks up where this one stopped
+            self._save_sync()
+        self._report(True)
+
+    def start(self):
+        """ Runs the export in a background thread, returns self """
+        self.thread = threading.Thread(target=self.run,daemon=True,name="PyCASC export")
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        """ Stops writing after the current chunk of every file in progress, leaving their .part files to resume """
+        self.cancelled.set()
+
+    def wait(self, timeout=None):
+        """ Waits for a started export to finish, returns whether it has """
+        if self.thread is not None:
+            self.thread.join(timeout)
+        return self.done()
+
+    def done(self):
+        return self.thread is not None and not self.thread.is_alive()
+
+    def throughput(self):
+        """ Bytes written per second so far, not counting skipped files """
+        if self.start_time is None:
+            return 0
+        return self.bytes_written/max(time()-self.start_time,0.001)
+
+    def __repr__(self):
+        return f"<Exporter {self.files_done}/{self.files_total} files, {self.bytes_done}/{self.bytes_total} bytes ({self.bytes_saved} saved by dedup), {len(self.errors)} errors>"
+
+def select_files(cr, prefixes=(), tags=(), unnamed=False):
+    """ (path, ckey) of a reader's files under any of prefixes (all of them if none), tagged with tags in the install manifest.
+    Unnamed files are only included with unnamed, as !UNNAMED/<ckey>. """
+    prefixes = [p.replace("\\","/").lower() for p in prefixes]
+    tagged = set(cr.ckeys_by_tags(*tags)) if tags else None
+    files = []
+    for named,nameless in cr.iter_files():
+        if unnamed:
+            named = named+[(f"!UNNAMED/{ckey:x}",ckey) for ckey,_ in nameless]
+        for name,ckey in named:
+            if tagged is not None and ckey not in tagged:
+                continue
+            if prefixes and not any(name.replace("\\","/").lower().startswith(p) for p in prefixes):
+                continue
+            files.append((name,ckey))
+    return files
+
+def main(argv=None):
+    import argparse
+    from PyCASC import DirCASCReader, CDNCASCReader, MirrorSource
+    from PyCASC.utils.CASCUtils import beautify_filesize
+
+    parser = argparse.ArgumentParser(prog="python -m PyCASC.export",description="Export files from a CASC storage")
+    parser.add_argument("dest",help="folder to export into")
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument("--dir",help="game folder of a local storage")
+    src.add_argument("--cdn",metavar="PRODUCT",help="product to read from the cdn, e.g. w3")
+    parser.add_argument("--region",default="us")
+    parser.add_argument("--mirror",help="read the cdn product from a local mirror of the cdn at this path")
+    parser.add_argument("--prefix",action="append",default=[],help="only export paths starting with this (repeatable)")
+    parser.add_argument("--tag",action="append",default=[],help="only export files the install manifest tags with this (repeatable)")
+    parser.add_argument("--unnamed",action="store_true",help="also export files without a name, as !UNNAMED/<ckey>")
+    parser.add_argument("--workers",type=int,default=4)
+    parser.add_argument("--no-resume",dest="resume",action="store_false",help="rewrite files that are already exported")
+    parser.add_argument("--no-dedup",dest="dedup",action="store_false",help="decode every path separately instead of hard linking paths with the same content")
+    parser.add_argument("--sync",action="store_true",help="keep dest a mirror of the selected files: rewrite only what changed since the last --sync, delete what's gone")
+    args = parser.parse_args(argv)
+
+    if args.dir:
+        cr = DirCASCReader(args.dir)
+    else:
+        cr = CDNCASCReader(args.cdn,args.region,read_install_file=True,source=MirrorSource(args.mirror,args.cdn,args.region) if args.mirror else None)
+
+    files = select_files(cr,args.prefix,args.tag,args.unnamed)
+    def show(e):
+        sys.stdout.write(f"\r{e.files_done}/{e.files_total} files, {beautify_filesize(e.bytes_done)}/{beautify_filesize(e.bytes_total)}, {beautify_filesize(e.throughput())}/s   ")
+        sys.stdout.flush()
+    ex = Exporter(cr,files,args.dest,args.workers,args.resume,on_progress=show,dedup=args.dedup,sync=args.sync)
+    ex.run()
+    print(f"\nExported {ex.files_done-ex.files_skipped} files ({ex.files_skipped} already there, {beautify_filesize(ex.bytes_saved)} saved by dedup, {ex.files_removed} removed), {len(ex.errors)} errors")
+    for path,e in ex.errors:
+        print(f"  {path}: {e}")
+    return 1 if ex.errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
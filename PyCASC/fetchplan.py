@@ -0,0 +1,63 @@
+from typing import List
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+DEFAULT_MAX_GAP = 64*1024 # bytes of unwanted data we'd rather download than pay for another request
+DEFAULT_MAX_SPAN = 16*1024*1024 # largest single ranged request a plan will make
+
+class RangeRequest:
+    archive:str
+    offset:int
+    size:int
+    parts:List[tuple] # the (key, archive, offset, size) locations served by this request
+
+    def __init__(self, archive, offset, size, parts):
+        self.archive = archive
+        self.offset = offset
+        self.size = size
+        self.parts = parts
+
+def plan_ranges(locations, max_gap=DEFAULT_MAX_GAP, max_span=DEFAULT_MAX_SPAN):
+    """ Plans the requests needed to fetch a set of archived files.
+    locations is an iterable of (key, archive, offset, size). Locations are grouped per archive, sorted by offset,
+    and neighbours less than max_gap bytes apart are merged into one wider request of at most max_span bytes. """
+    by_archive = {}
+    for loc in locations:
+        by_archive.setdefault(loc[1],[]).append(loc)
+
+    plan = []
+    for archive in by_archive:
+        cur = None
+        for loc in sorted(by_archive[archive],key=lambda l:l[2]):
+            _,_,offset,size = loc
+            end = offset+size
+            if cur is not None and offset-(cur.offset+cur.size) <= max_gap and end-cur.offset <= max_span:
+                cur.size = max(cur.size,end-cur.offset)
+                cur.parts.append(loc)
+            else:
+                cur = RangeRequest(archive,offset,size,[loc])
+                plan.append(cur)
+    return plan
+
+def execute_plan(plan, fetch, workers=4):
+    """ Runs a plan with at most `workers` requests in flight, fetch(archive, offset, size) does the actual request.
+    Yields (location, data) for every location in the plan as its request completes, data being a slice of the response. """
+    def run(rr):
+        return rr,memoryview(fetch(rr.archive,rr.offset,rr.size))
+
+    def split(done):
+        for fut in done:
+            rr,data = fut.result()
+            for loc in rr.parts:
+                start = loc[2]-rr.offset
+                yield loc,data[start:start+loc[3]]
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        pending = set()
+        for rr in plan:
+            pending.add(ex.submit(run,rr))
+            if len(pending) >= workers*2: # don't hold more responses in memory than the consumer can keep up with
+                done,pending = wait(pending,return_when=FIRST_COMPLETED)
+                yield from split(done)
+        while pending:
+            done,pending = wait(pending,return_when=FIRST_COMPLETED)
+            yield from split(done)
@@ -2,46 +2,50 @@ import requests, json, os, hashlib, pickle
 from time import time
 from io import BytesIO
 from PyCASC import CACHE_DURATION
-from PyCASC.utils.blizzutils import parse_config, parse_build_config, get_cdn_config, get_cdn_data, get_cached, have_cached, get_cdn_url
+from PyCASC.utils.blizzutils import parse_config, parse_build_config, get_cdn_config, get_cdn_data, get_cached, have_cached, get_cdn_url, get_range_url
 
 memcache = {}
 
-def get_mem_cached(url,cache_dur=CACHE_DURATION):
+def get_mem_cached(url,cache_dur=CACHE_DURATION,enc=None):
     if url in memcache:
         return memcache[url]
     else:
-        dat = get_cached(url,cache_dur)
+        dat = get_cached(url,cache_dur=cache_dur,enc=enc)
         memcache[url] = dat
         return dat
         
 
 def getProductCDNs(product):
-    return parse_config(get_mem_cached(f"http://us.patch.battle.net:1119/{product}/cdns", cache_dur=3600*24))
+    return parse_config(get_mem_cached(f"http://us.patch.battle.net:1119/{product}/cdns", cache_dur=3600*24, enc="utf-8"))
 def getProductVersions(product):
-    return parse_config(get_cached(f"http://us.patch.battle.net:1119/{product}/versions", cache_dur=3600*24))
+    return parse_config(get_cached(f"http://us.patch.battle.net:1119/{product}/versions", cache_dur=3600*24, enc="utf-8"))
 def getProductBlobs(product):
-    return parse_config(get_cached(f"http://us.patch.battle.net:1119/{product}/blobs", cache_dur=3600*24))
+    return parse_config(get_cached(f"http://us.patch.battle.net:1119/{product}/blobs", cache_dur=3600*24, enc="utf-8"))
 def getProductInstallBlob(product):
-    return get_cached(f"http://us.patch.battle.net:1119/{product}/blob/install", cache_dur=3600*24)
+    return get_cached(f"http://us.patch.battle.net:1119/{product}/blob/install", cache_dur=3600*24, enc="utf-8")
 def getProductGameBlob(product):
-    return get_cached(f"http://us.patch.battle.net:1119/{product}/blob/game", cache_dur=3600*24)
+    return get_cached(f"http://us.patch.battle.net:1119/{product}/blob/game", cache_dur=3600*24, enc="utf-8")
 
 def getProductCDNFile(product,file_hash,region="us",ftype="data",cache_dur=CACHE_DURATION,enc=None,max_size=-1,index=False,offset=0,size=-1):
     cdnurl,cdnpath = getCDN(product,region)
     if ftype == "config":
-        d = get_cdn_config(cdnurl,cdnpath,file_hash,parse=False,cache_dur=cache_dur,max_size=max_size, index=index)
+        d = get_cdn_config(cdnurl,cdnpath,file_hash,parse=False,cache_dur=cache_dur,max_size=max_size, index=index, enc=enc)
     else:
-        d = get_cdn_data(cdnurl,cdnpath,file_hash,cache_dur=cache_dur,max_size=max_size, index=index, offset=offset, size=size)
+        d = get_cdn_data(cdnurl,cdnpath,file_hash,cache_dur=cache_dur,max_size=max_size, index=index, offset=offset, size=size, enc=enc)
     return d
 
-def isCDNFileCached(product,file_hash,region="us",ftype="data",cache_dur=CACHE_DURATION,enc=None,max_size=-1,index=False):
+def isCDNFileCached(product,file_hash,region="us",ftype="data",cache_dur=CACHE_DURATION,enc=None,max_size=-1,index=False,offset=0,size=-1):
+    """ Whether a cdn file is cached, when size is given this checks for just that range of it instead (see fetch_range) """
     cdnurl,cdnpath = getCDN(product,region)
-    return have_cached(get_cdn_url(cdnurl,cdnpath,ftype,file_hash,index=index),cache_dur=CACHE_DURATION)
+    url = get_cdn_url(cdnurl,cdnpath,ftype,file_hash,index=index)
+    if size >= 0:
+        url = get_range_url(url,offset,size)
+    return have_cached(url,cache_dur=CACHE_DURATION)
 
 def getCatalogCDNs():
-    return parse_config(get_cached("http://us.patch.battle.net:1119/catalogs/cdns", cache_dur=3600*24))
+    return parse_config(get_cached("http://us.patch.battle.net:1119/catalogs/cdns", cache_dur=3600*24, enc="utf-8"))
 def getCatalogVersions():
-    return parse_config(get_cached("http://us.patch.battle.net:1119/catalogs/versions", cache_dur=3600*24))
+    return parse_config(get_cached("http://us.patch.battle.net:1119/catalogs/versions", cache_dur=3600*24, enc="utf-8"))
 
 def fixStrings(data,locale="enUS",validStrings=None):
     """ Replace all instances of locale strings with the locale provided, validStrings must be None in non-recursive steps
@@ -102,7 +106,7 @@ def getCatalogRoot(region="us",version=None,versions=None):
     bc_hash = r_vrn['BuildConfig']
     bc_data = parse_build_config(get_cdn_config(cdnurl,cdnpath,bc_hash,parse=False,cache_dur=3600*6))
     root_hash = bc_data['root']
-    root_data = json.loads(get_cdn_data(cdnurl,cdnpath,root_hash))
+    root_data = json.loads(get_cdn_data(cdnurl,cdnpath,root_hash,enc="utf-8"))
     return root_data
 
 def getProductData(product,region="us",version=None,locale="enUS",raw=False):
@@ -115,7 +119,7 @@ def getProductData(product,region="us",version=None,locale="enUS",raw=False):
     prod=prods[product]
     cdnurl, cdnpath = getCDN("catalogs",region)
     
-    data = json.loads(get_cdn_data(cdnurl,cdnpath,prod['hash']))
+    data = json.loads(get_cdn_data(cdnurl,cdnpath,prod['hash'],enc="utf-8"))
     if not raw: # do cleanup ourselves
         data = fixStrings(data,locale=locale)
         for x in data['products']:
@@ -0,0 +1,111 @@
+import os
+import struct
+from PyCASC.utils.blizzutils import prefix_hash
+
+MAX_DATA_FILE_SIZE = 1<<30 # .idx entries only have 30 bits for the offset into a data file
+DATA_HEADER_SIZE = 30
+IDX_VERSION = 7
+
+BUILD_INFO_COLUMNS = ["Branch!STRING:0","Active!DEC:1","Build Key!HEX:16","CDN Key!HEX:16","Install Key!HEX:16","IM Size!DEC:4",
+    "CDN Path!STRING:0","CDN Hosts!STRING:0","CDN Servers!STRING:0","Tags!STRING:0","Armadillo!STRING:0","Last Activated!STRING:0",
+    "Version!STRING:0","Product!STRING:0"]
+
+def _idx_bucket(ekey9):
+    """ The .idx file (0x00-0x0f) an ekey is listed in, same as the game clients pick it """
+    b = 0
+    for x in ekey9:
+        b ^= x
+    return (b & 0xf) ^ (b >> 4)
+
+class LocalStorageWriter:
+    """ Writes a local CASC storage (the layout a game install has, and DirCASCReader reads):
+    .build.info, Data/config/ab/cd/<hash>, and the encoded files in Data/data/data.NNN, listed by Data/data/*.idx.
+    Add every encoded (BLTE) file with add(), then call finish() to write the indexes and .build.info. """
+
+    def __init__(self, path):
+        self.path = path
+        self.data_path = os.path.join(path,"Data","data")
+        self.config_path = os.path.join(path,"Data","config")
+        os.makedirs(self.data_path,exist_ok=True)
+        os.makedirs(self.config_path,exist_ok=True)
+
+        self.entries = {} # 9 byte ekey -> (data file, offset, size)
+        self.data_index = -1
+        self.data_file = None
+        self.data_size = 0
+
+    def _next_data_file(self):
+        if self.data_file is not None:
+            self.data_file.close()
+        self.data_index += 1
+        self.data_file = open(os.path.join(self.data_path,f"data.{self.data_index:03d}"),"wb")
+        self.data_size = 0
+
+    def add(self, ekey, blte):
+        """ Stores an encoded file. ekey is the file's full (16 byte) ekey as an int, blte its BLTE data.
+        Returns whether it was written, False if a file with the same (9 byte) ekey already was. """
+        ekey = ekey.to_bytes(16,'big')
+        if ekey[:9] in self.entries:
+            return False
+        size = DATA_HEADER_SIZE+len(blte)
+        if self.data_file is None or self.data_size+size > MAX_DATA_FILE_SIZE:
+            self._next_data_file()
+
+        # header is the reversed ekey, the total size, 2 flag bytes and 2 checksums (which nothing here verifies)
+        self.data_file.write(struct.pack("<16sI2x4x4x",ekey[::-1],size))
+        self.data_file.write(blte)
+        self.entries[ekey[:9]] = (self.data_index,self.data_size,size)
+        self.data_size += size
+        return True
+
+    def add_config(self, config_hash, config):
+        """ Stores a config file (build config, cdn config) under Data/config """
+        fp = os.path.join(self.config_path,prefix_hash(config_hash))
+        os.makedirs(os.path.dirname(fp),exist_ok=True)
+        with open(fp,"w") as f:
+            f.write(config)
+
+    def _write_idx(self, bucket, entries):
+        body = b''.join(ek+((df<<30)|offset).to_bytes(5,'big')+size.to_bytes(4,'little') for ek,(df,offset,size) in entries)
+        hdr = struct.pack("<IIH6BQQII",0x10,0,IDX_VERSION,bucket,0,4,5,9,DATA_HEADER_SIZE,MAX_DATA_FILE_SIZE,0,len(body),0)
+        with open(os.path.join(self.data_path,f"{bucket:02x}{1:08x}.idx"),"wb") as f:
+            f.write(hdr)
+            f.write(body)
+
+    def finish(self, build_config_hash, cdn_config_hash="", product="", version=""):
+        """ Writes the .idx files and .build.info. The build config (and cdn config) should already have been added with add_config. """
+        if self.data_file is not None:
+            self.data_file.close()
+            self.data_file = None
+
+        buckets = {x:[] for x in range(0x10)}
+        for ek in sorted(self.entries):
+            buckets[_idx_bucket(ek)].append((ek,self.entries[ek]))
+        for b in buckets:
+            self._write_idx(b,buckets[b])
+
+        row = {"Branch":"us","Active":"1","Build Key":build_config_hash,"CDN Key":cdn_config_hash,"Version":version,"Product":product}
+        with open(os.path.join(self.path,".build.info"),"w") as f:
+            f.write("|".join(BUILD_INFO_COLUMNS)+"\n")
+            f.write("|".join(row.get(c.split("!")[0],"") for c in BUILD_INFO_COLUMNS)+"\n")
+
+def export_local_storage(cr, path, ckeys=None, workers=4):
+    """ Materializes a CDNCASCReader's build (or just the files in ckeys) as a local storage at path,
+    which DirCASCReader can then open. The build's own system files (encoding, root, install, download, size) are always included.
+    Returns the number of files written. """
+    bc = cr.build_config
+    system = [int(bc['root'],16)] + [int(bc[x].split()[0],16) for x in ['encoding','install','download','size'] if x in bc]
+    if ckeys is None:
+        ckeys = cr.ckey_map.keys()
+    ckeys = list(dict.fromkeys(system+list(ckeys))) # no duplicates, order kept
+
+    w = LocalStorageWriter(path)
+    count = 0
+    for ckey,blte in cr.fetch_files_by_ckeys(ckeys,workers=workers,raw=True):
+        if w.add(cr.ckey_map[ckey],blte):
+            count += 1
+
+    w.add_config(cr.build_config_hash,cr.source.get_file(cr.build_config_hash,ftype="config",enc="utf-8"))
+    w.add_config(cr.cdn_config_hash,cr.source.get_file(cr.cdn_config_hash,ftype="config",enc="utf-8"))
+    w.finish(cr.build_config_hash,cr.cdn_config_hash,product=cr.product,version=bc.get('build-name',""))
+    return count
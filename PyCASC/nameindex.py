@@ -0,0 +1,288 @@
+import os
+import mmap
+import struct
+import tempfile
+from array import array
+from bisect import bisect_right
+from PyCASC import CACHE_DIRECTORY
+
+NAME_INDEX_MAGIC = b"PNIX"
+NAME_INDEX_VERSION = 1
+
+_header = struct.Struct("<4sIII") # magic, version, file count, folder count
+_sections = struct.Struct("<12Q") # the byte length of each section, in the order NameIndex.build writes them
+
+class _Trigrams:
+    """ The trigram posting lists of a blob of "\\n" separated entries: for every 3 bytes appearing in an entry (its separators
+    included, so trigrams at the start or end of an entry are told apart), the ids of the entries having them, ascending. """
+
+    def __init__(self, keys, starts, postings):
+        self.starts = starts
+        self.postings = postings
+        self.lookup = {k:i for i,k in enumerate(keys)}
+
+    def get(self, t):
+        i = self.lookup.get(int.from_bytes(t,'big'))
+        if i is None:
+            return ()
+        return self.postings[self.starts[i]:self.starts[i+1]]
+
+    @staticmethod
+    def build(lower, offsets, count):
+        """ Returns the (keys, starts, postings) arrays for the entries of a lowercased blob """
+        post = {}
+        for i in range(count):
+            s = lower[offsets[i]-1:offsets[i+1]]
+            for t in {s[j:j+3] for j in range(len(s)-2)}:
+                p = post.get(t)
+                if p is None:
+                    p = post[t] = array('I')
+                p.append(i)
+        keys,starts,postings = array('I'),array('I',[0]),array('I')
+        for t in sorted(post):
+            keys.append(int.from_bytes(t,'big'))
+            postings.extend(post[t])
+            starts.append(len(postings))
+        return keys,starts,postings
+
+class InvalidNameIndex(Exception):
+    """ A name index file that isn't one, of another version, or cut short """
+
+def _blob(strings):
+    """ strings encoded and joined as "\\n"+s0+"\\n"+s1+...+"\\n", with the offset of each one (and one past the end) """
+    enc = [s.encode("utf-8") for s in strings]
+    offsets = array('I',[1])
+    for e in enc:
+        offsets.append(offsets[-1]+len(e)+1)
+    return b"\n"+b"\n".join(enc)+b"\n",offsets
+
+def _pad(b):
+    return b+b"\0"*(-len(b)%4)
+
+class NameIndex:
+    """ A searchable index of a storage's file names, in a single file (see load_name_index).
+    Paths are interned: each folder is stored once, each file as its name within its folder, sorted by folder then name,
+    so the files of a folder are a contiguous run of ids. Folders and names each have trigram posting lists, and the
+    file is memory-mapped, so opening it costs next to nothing and a query only touches the posting lists it needs.
+    Matching is case insensitive (for ascii). """
+
+    def __init__(self, path):
+        # checked with a plain read, so nothing is mapped yet if it's invalid (and it can be rebuilt right away, on windows too)
+        with open(path,"rb") as f:
+            head = f.read(_header.size+_sections.size)
+            size = os.fstat(f.fileno()).st_size
+            if len(head) < _header.size+_sections.size:
+                raise InvalidNameIndex(f"{path} is truncated")
+            magic,version,self.file_count,self.folder_count = _header.unpack_from(head,0)
+            if magic != NAME_INDEX_MAGIC or version != NAME_INDEX_VERSION:
+                raise InvalidNameIndex(f"{path} is not a valid name index")
+            lengths = _sections.unpack_from(head,_header.size)
+            if len(head)+sum(ln+(-ln%4) for ln in lengths) != size:
+                raise InvalidNameIndex(f"{path} is truncated")
+            if any(ln%4 for i,ln in enumerate(lengths) if i not in (0,3)) or lengths[5] != 16*self.file_count:
+                raise InvalidNameIndex(f"{path} is not a valid name index")
+            self.map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        mv,p,sections = memoryview(self.map),len(head),[]
+        for ln in lengths:
+            sections.append(mv[p:p+ln])
+            p += ln+(-ln%4)
+        folder_blob,folder_offsets,self.folder_starts,name_blob,name_offsets,self.ckeys = sections[:6]
+        self.folder_offsets = folder_offsets.cast('I')
+        self.name_offsets = name_offsets.cast('I')
+        self.folder_starts = self.folder_starts.cast('I')
+        self.folder_blob,self.name_blob = folder_blob,name_blob
+        self.folder_lower,self.name_lower = bytes(folder_blob).lower(),bytes(name_blob).lower()
+        self.folder_tri = _Trigrams(*[s.cast('I') for s in sections[6:9]])
+        self.name_tri = _Trigrams(*[s.cast('I') for s in sections[9:12]])
+
+    def __len__(self):
+        return self.file_count
+
+    def folder_of(self, fid):
+        return bisect_right(self.folder_starts,fid)-1
+
+    def path(self, fid):
+        """ The full path of a file """
+        f = self.folder_of(fid)
+        folder = bytes(self.folder_blob[self.folder_offsets[f]:self.folder_offsets[f+1]-1]).decode("utf-8")
+        name = bytes(self.name_blob[self.name_offsets[fid]:self.name_offsets[fid+1]-1]).decode("utf-8")
+        return folder+"/"+name if folder else name
+
+    def ckey(self, fid):
+        return int.from_bytes(self.ckeys[fid*16:fid*16+16],'big')
+
+    def entries(self, fids):
+        """ [(path, ckey)] for some file ids, in list_files' format """
+        return [(self.path(i),self.ckey(i)) for i in fids]
+
+    def _find(self, lower, offsets, tri, pat, limit=None, keep=None):
+        """ The ids of the entries of a blob whose text, wrapped in "\\n"s, contains pat (and that keep(id) if given), ascending.
+        Only the first limit of them if given. """
+        if len(pat) < 3: # too short for the trigrams, scan the blob instead
+            ids = []
+            p = lower.find(pat)
+            while p >= 0 and len(ids) != limit:
+                i = bisect_right(offsets,p+(pat[:1] == b"\n"))-1
+                if i+1 == len(offsets): # the blob's last "\n" starts no entry
+                    break
+                end = offsets[i+1]
+                if p+len(pat) <= end and (keep is None or keep(i)):
+                    ids.append(i)
+                p = lower.find(pat,max(p+1,end-1))
+            return ids
+
+        lists = sorted((tri.get(pat[j:j+3]) for j in range(len(pat)-2)),key=len)
+        if len(lists[0]) == 0:
+            return []
+        cand = lists[0]
+        for l in lists[1:]:
+            # intersecting costs a pass over l, checking a candidate costs about as much as a few of l's entries.
+            if len(cand) <= 16 or len(l) > 8*len(cand):
+                break
+            cand = sorted(set(cand).intersection(l))
+        ids = []
+        for i in cand:
+            if pat in lower[offsets[i]-1:offsets[i+1]] and (keep is None or keep(i)):
+                ids.append(i)
+                if len(ids) == limit:
+                    break
+        return ids
+
+    def _find_folders(self, pat, limit=None):
+        return self._find(self.folder_lower,self.folder_offsets,self.folder_tri,pat,limit)
+
+    def _find_names(self, pat, limit=None, keep=None):
+        return self._find(self.name_lower,self.name_offsets,self.name_tri,pat,limit,keep)
+
+    def _files_of(self, folders, limit=None, keep=None):
+        """ The ids of the files in some folders (ascending), that keep(id) if given, up to limit of them """
+        fs,ids = self.folder_starts,[]
+        for f in folders:
+            ids.extend(range(fs[f],fs[f+1]) if keep is None else filter(keep,range(fs[f],fs[f+1])))
+            if limit is not None and len(ids) >= limit:
+                return ids[:limit]
+        return ids
+
+    def _match(self, pat, limit=None):
+        """ The ids of the files whose path, wrapped in "\\n"s, contains pat, ascending (which is path order).
+        Each way a path can match gives its ids ascending, so only the first limit of each are needed for the first limit overall. """
+        fs = self.folder_starts
+        top = fs[1] if self.folder_count and self.folder_offsets[1] == 2 else 0 # files directly in "", it sorts first
+        ids = set()
+        if b"/" not in pat: # inside the name
+            # the start of a name is only the start of a path at the top
+            ids.update(self._find_names(pat,limit,(lambda i:i < top) if pat[:1] == b"\n" else None))
+        if pat[-1:] != b"\n": # inside the folder
+            ids.update(self._files_of(self._find_folders(pat),limit))
+        if b"/" in pat: # across the last "/": the end of a folder, then the start of a name
+            x,y = pat.rsplit(b"/",1)
+            folders = [f for f in self._find_folders(x+b"\n") if not (f == 0 and top)]
+            y = b"\n"+y
+            if len(y) >= 3:
+                folders = set(folders)
+                ids.update(self._find_names(y,limit,lambda i:self.folder_of(i) in folders))
+            else:
+                lower,offsets = self.name_lower,self.name_offsets
+                ids.update(self._files_of(folders,limit,lambda i:lower.startswith(y,offsets[i]-1)))
+        return sorted(ids)[:limit]
+
+    def substring(self, text, limit=None):
+        """ The files whose path contains text, as [(path, ckey)] in path order.
+        A leading ^ or trailing $ anchors text to the start or end of the path. """
+        pat = text.strip().replace("\\","/").encode("utf-8").lower() # the blobs are only lowercased for ascii too
+        if pat[:1] == b"^":
+            pat = b"\n"+pat[1:]
+        if pat[-1:] == b"$":
+            pat = pat[:-1]+b"\n"
+        if pat.strip(b"\n") == b"":
+            return []
+        return self.entries(self._match(pat,limit))
+
+    def extension(self, ext, limit=None):
+        """ The files with an extension, as [(path, ckey)] """
+        return self.substring("."+ext.strip().lstrip("*.")+"$",limit)
+
+    def fuzzy(self, text, limit=100, max_errors=None):
+        """ The files whose name is close to text, best first, as [(path, ckey)]. Names are scored by how many of text's
+        trigrams they share, and have to share all but 3 per error (a typo breaks at most 3 trigrams).
+        By default a query allows an error every 4 characters. Anything before a "/" in text has to be in the folder as is. """
+        folder,_,pat = text.strip().replace("\\","/").encode("utf-8").lower().rpartition(b"/")
+        if len(pat) < 3:
+            return self.substring(text,limit)
+        tris = {pat[j:j+3] for j in range(len(pat)-2)}
+        errors = max(1,len(pat)//4) if max_errors is None else max_errors
+        need = max(1,len(tris)-3*errors)
+        # a name sharing `need` of the trigrams is in at least one of the len(tris)-need+1 shortest posting lists
+        lists = sorted((self.name_tri.get(t) for t in tris),key=len)
+        cand = set()
+        for l in lists[:len(tris)-need+1]:
+            cand.update(l)
+        if folder:
+            folders = set(self._find_folders(folder))
+            cand = [i for i in cand if self.folder_of(i) in folders]
+
+        lower,offsets = self.name_lower,self.name_offsets
+        scored = []
+        for i in cand:
+            s = lower[offsets[i]-1:offsets[i+1]]
+            n = sum(t in s for t in tris)
+            if n >= need:
+                scored.append((-n,len(s),i)) # most trigrams shared, then the shortest name
+        scored.sort()
+        return self.entries([i for _,_,i in scored[:limit]])
+
+    def search(self, query, limit=None):
+        """ One query string, as a search box would take it: "*.ext" for an extension, "~text" for a fuzzy search,
+        anything else for a substring (see substring for its anchors). Returns [(path, ckey)]. """
+        query = query.strip()
+        if query[:2] == "*." and "/" not in query:
+            return self.extension(query[2:],limit)
+        if query[:1] == "~":
+            return self.fuzzy(query[1:],100 if limit is None else limit)
+        return self.substring(query,limit)
+
+    @staticmethod
+    def build(path, files):
+        """ Writes a new name index to path, for files as list_files gives them: (path, ckey) pairs """
+        files = sorted(f.replace("\\","/").rpartition("/")[::2]+(ckey,) for f,ckey in files)
+        folders,folder_starts = [],array('I')
+        for i,(folder,_,_) in enumerate(files):
+            if not folders or folders[-1] != folder:
+                folders.append(folder)
+                folder_starts.append(i)
+        folder_starts.append(len(files))
+
+        folder_blob,folder_offsets = _blob(folders)
+        name_blob,name_offsets = _blob(f[1] for f in files)
+        ckeys = b"".join(f[2].to_bytes(16,'big') for f in files)
+        sections = [folder_blob,folder_offsets,folder_starts,name_blob,name_offsets,ckeys]
+        sections += _Trigrams.build(folder_blob.lower(),folder_offsets,len(folders))
+        sections += _Trigrams.build(name_blob.lower(),name_offsets,len(files))
+        sections = [s.tobytes() if isinstance(s,array) else s for s in sections]
+
+        tfd,tmp_path = tempfile.mkstemp(suffix=".tmp",dir=os.path.dirname(path))
+        try:
+            with open(tfd,"wb") as f:
+                f.write(_header.pack(NAME_INDEX_MAGIC,NAME_INDEX_VERSION,len(files),len(folders)))
+                f.write(_sections.pack(*[len(s) for s in sections]))
+                for s in sections:
+                    f.write(_pad(s))
+            os.replace(tmp_path,path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+def load_name_index(key, list_files, cache_dir=CACHE_DIRECTORY):
+    """ Opens the name index cached under key, building it from list_files() if it isn't cached yet. """
+    path = os.path.join(cache_dir,f"{key}.name-index")
+    if os.path.exists(path):
+        try:
+            return NameIndex(path)
+        except InvalidNameIndex as e: # a torn write or an older version, it's only a cache
+            print(f"[NIDX] {e}, rebuilding it")
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir,exist_ok=True)
+
+    NameIndex.build(path,list_files())
+    return NameIndex(path)
@@ -0,0 +1,91 @@
+UNNAMED_FOLDER = "!UNNAMED"
+
+class PathFolder:
+    """ One folder of a PathIndex: its subfolders' names and its files' ids, each sorted by name when listed """
+    __slots__ = ("path","folders","files","dirty")
+
+    def __init__(self, path):
+        self.path = path
+        self.folders = []
+        self.files = []
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.folders)+len(self.files)
+
+class PathIndex:
+    """ Every file of a storage grouped by folder, for browsing them without a tree of dicts over every file.
+    Files are kept column-wise (name in their folder, ckey) and referred to by id, folders by their "/" separated path ("" is the top).
+    Fill it with add() as files are listed (see CASCReader.iter_files); a folder is only sorted the first time it's listed after a change. """
+
+    def __init__(self):
+        self.names = []
+        self.ckeys = []
+        self.file_folders = [] # the folder of each file
+        self.folders = {"":PathFolder("")}
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, named, unnamed=()):
+        """ Adds files in list_files' (name, ckey) and list_unnamed_files' (ckey, ckey) formats. Unnamed ones go under !UNNAMED by ckey. """
+        for name,ckey in named:
+            self._add(name.replace("\\","/"),ckey)
+        for ckey,_ in unnamed:
+            self._add(f"{UNNAMED_FOLDER}/{ckey:x}",ckey)
+
+    def _add(self, path, ckey):
+        folder,_,name = path.rpartition("/")
+        f = self.folders.get(folder)
+        if f is None:
+            f = self._make_folder(folder)
+        f.files.append(len(self.names))
+        f.dirty = True
+        self.names.append(name)
+        self.ckeys.append(ckey)
+        self.file_folders.append(f)
+
+    def _make_folder(self, path):
+        parent,_,name = path.rpartition("/")
+        p = self.folders.get(parent)
+        if p is None:
+            p = self._make_folder(parent)
+        p.folders.append(name)
+        p.dirty = True
+        f = self.folders[path] = PathFolder(path)
+        return f
+
+    def folder(self, path):
+        """ The PathFolder at path (a "/" separated string, or a list of folder names), sorted, or None """
+        if not isinstance(path,str):
+            path = "/".join(path)
+        f = self.folders.get(path)
+        if f is not None and f.dirty:
+            f.folders.sort()
+            # ids only grow, so a stable sort by name puts a path listed twice right after itself. the last one listed wins, as it did in genFileTree
+            files = sorted(f.files,key=self.names.__getitem__)
+            f.files = [i for n,i in enumerate(files) if n+1 == len(files) or self.names[files[n+1]] != self.names[i]]
+            f.dirty = False
+        return f
+
+    def count(self, path):
+        """ How many entries a folder has, without sorting it """
+        f = self.folders.get(path if isinstance(path,str) else "/".join(path))
+        return 0 if f is None else len(f)
+
+    def path(self, fid):
+        """ The full path of a file """
+        folder = self.file_folders[fid].path
+        return folder+"/"+self.names[fid] if folder else self.names[fid]
+
+    def as_tree(self, path):
+        """ A folder and everything under it as genFileTree used to build it: {'folders':{name:...},'files':{name:(path,ckey)}} """
+        f = self.folder(path)
+        tree = {'folders':{},'files':{}}
+        if f is None:
+            return tree
+        for name in f.folders:
+            tree['folders'][name] = self.as_tree(f.path+"/"+name if f.path else name)
+        for i in f.files:
+            tree['files'][self.names[i]] = (self.path(i),self.ckeys[i])
+        return tree
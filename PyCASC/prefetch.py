@@ -0,0 +1,171 @@
+import threading
+from time import time, sleep
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from PyCASC.fetchplan import plan_ranges, DEFAULT_MAX_GAP
+
+class RateLimiter:
+    """ A token bucket shared by threads, holding them together to bytes_per_sec on average """
+
+    def __init__(self, bytes_per_sec):
+        self.rate = bytes_per_sec
+        self.tokens = bytes_per_sec # allow a second's worth of burst
+        self.stamp = time()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        """ Accounts for n bytes just transferred, sleeping as long as it takes to get back under the rate """
+        with self.lock:
+            now = time()
+            self.tokens = min(self.rate,self.tokens+(now-self.stamp)*self.rate)-n
+            self.stamp = now
+            delay = -self.tokens/self.rate if self.tokens < 0 else 0
+        if delay:
+            sleep(delay)
+
+class HostLimiter:
+    """ Caps how many requests are in flight to each host """
+
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.sems = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, host):
+        with self.lock:
+            if host not in self.sems:
+                self.sems[host] = threading.BoundedSemaphore(self.per_host)
+            return self.sems[host]
+
+class Prefetcher:
+    """ Warms the cache with a CDNCASCReader's files, in the order the download manifest says the game needs them.
+    Files are picked by tags (and exclude), as in CASCReader.ckeys_by_tags, sorted by manifest priority, and cut off once
+    their encoded sizes add up to budget bytes (-1 for no limit). Files already in the cache are skipped.
+    Each priority level's archived files are coalesced into ranged requests (see fetchplan), and everything is fetched
+    by `workers` threads, at most per_host requests to a host at once, and at most bandwidth bytes/s if given.
+
+    start() runs it in a background thread; reads of the same files meanwhile share its downloads. """
+
+    def __init__(self, cr, tags=(), exclude=(), budget=-1, workers=8, per_host=4, bandwidth=None, max_gap=DEFAULT_MAX_GAP):
+        self.cr = cr
+        self.tags = tags
+        self.exclude = exclude
+        self.budget = budget
+        self.workers = workers
+        self.hosts = HostLimiter(per_host)
+        self.rate = RateLimiter(bandwidth) if bandwidth else None
+        self.max_gap = max_gap
+
+        self.files_total = self.bytes_total = 0
+        self.files_done = self.bytes_done = 0
+        self.errors = [] # (ckey, exception). ckey is None when the prefetch itself failed (see start)
+        self.host = None
+        self.thread = None
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+
+    def plan(self):
+        """ Returns [(priority, [ckey])], highest priority (lowest number) first, of the files to fetch. Sets files_total and bytes_total. """
+        dm = self.cr.get_download_manifest()
+        picked = sorted(dm.select(*self.tags,exclude=self.exclude),key=dm.priorities.__getitem__)
+        waves = []
+        full = False
+        for priority,idxs in groupby(picked,key=dm.priorities.__getitem__):
+            ckeys = []
+            for i in idxs:
+                ckey = self.cr.ckey_by_ekey(dm.ekey(i))
+                if ckey is None or self.cr.is_file_fetchable(ckey,include_cdn=False):
+                    continue # only what is actually fetched counts against the budget
+                if self.budget >= 0 and self.bytes_total+dm.sizes[i] > self.budget:
+                    full = True
+                    break
+                ckeys.append(ckey)
+                self.files_total += 1
+                self.bytes_total += dm.sizes[i]
+            if ckeys:
+                waves.append((priority,ckeys))
+            if full:
+                break
+        return waves
+
+    def _transferred(self, nfiles, nbytes):
+        if self.rate is not None:
+            self.rate.consume(nbytes)
+        with self.lock:
+            self.files_done += nfiles
+            self.bytes_done += nbytes
+
+    def _fetch_range(self, rr):
+        try:
+            with self.hosts(self.host):
+                data = memoryview(self.cr.source.fetch_range(rr.archive,rr.offset,rr.size,cache=False))
+            for ckey,archive,offset,size in rr.parts:
+                self.cr.source.put_range(archive,offset,size,data[offset-rr.offset:offset-rr.offset+size])
+            self._transferred(len(rr.parts),len(data))
+        except Exception as e:
+            with self.lock:
+                self.errors.extend((p[0],e) for p in rr.parts)
+
+    def _fetch_loose(self, ckey):
+        try:
+            with self.hosts(self.host):
+                data = self.cr._get_encoded_file(self.cr.get_file_info_by_ckey(ckey))
+            self._transferred(1,len(data))
+        except Exception as e:
+            with self.lock:
+                self.errors.append((ckey,e))
+
+    def run(self):
+        """ Fetches everything in the plan, in this thread """
+        self.host = getattr(self.cr.source,"host",lambda:None)()
+        waves = self.plan()
+        tasks = []
+        for _,ckeys in waves:
+            locations = []
+            for ckey in ckeys:
+                finfo = self.cr.get_file_info_by_ckey(ckey)
+                if getattr(finfo,"data_file",None) is not None:
+                    locations.append((ckey,finfo.data_file,finfo.offset,finfo.compressed_size))
+                else:
+                    tasks.append((self._fetch_loose,ckey))
+            tasks += [(self._fetch_range,rr) for rr in plan_ranges(locations,self.max_gap)]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as ex:
+            pending = set()
+            for fn,arg in tasks: # submitted in priority order, and the pool runs them in that order
+                if self.cancelled.is_set():
+                    break
+                pending.add(ex.submit(fn,arg))
+                if len(pending) >= self.workers*2:
+                    _,pending = wait(pending,return_when=FIRST_COMPLETED)
+            wait(pending)
+
+    def _run_thread(self):
+        try:
+            self.run()
+        except Exception as e: # planning or scheduling failed, nothing else would ever hear of it
+            with self.lock:
+                self.errors.append((None,e))
+
+    def start(self):
+        """ Runs the prefetch in a background thread, returns self. If planning or scheduling fails, the exception is
+        recorded in errors with a ckey of None. """
+        self.thread = threading.Thread(target=self._run_thread,daemon=True,name="PyCASC prefetch")
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        """ Stops submitting new requests, the ones in flight still finish """
+        self.cancelled.set()
+
+    def wait(self, timeout=None):
+        """ Waits for a started prefetch to finish, returns whether it has """
+        if self.thread is not None:
+            self.thread.join(timeout)
+        return self.done()
+
+    def done(self):
+        return self.thread is not None and not self.thread.is_alive()
+
+    def __repr__(self):
+        return f"<Prefetcher {self.files_done}/{self.files_total} files, {self.bytes_done} bytes, {len(self.errors)} errors>"
@@ -1,8 +1,7 @@
-from io import BytesIO
 import struct
 import pathlib
-from PyCASC.utils.CASCUtils import read_cstr, NAMED_FILE, SNO_FILE, SNO_INDEXED_FILE
-from PyCASC.utils.blizzutils import byteskey_to_hex
+from PyCASC.utils.CASCUtils import NAMED_FILE, SNO_FILE, SNO_INDEXED_FILE, TranslateTable
+from PyCASC.utils.bufferreader import BufferReader
 
 SNOGroups={
     # id : ( name , ext )
@@ -76,121 +75,120 @@ SNOGroups={
     69:("DungeonFinder","")
 }
 
+_sno_entry = struct.Struct("<16sI")
+_sno_indexed_entry = struct.Struct("<16sII")
+
+def _cstr_at(d, pos):
+    """ Returns (string, position after its null) for the null terminated string at pos of the bytes d """
+    end = d.index(b'\0',pos)
+    try:
+        return d[pos:end].decode("utf-8"),end+1
+    except UnicodeDecodeError:
+        print(f"Failed to decode {d[pos:end]}")
+        return None,end+1
+
+_coretoc_header = struct.Struct(f"<{70*3}I")
+_coretoc_entry = struct.Struct("<3I")
+
 def _parse_d3_coretoc(ctfd):
-    cf = BytesIO(ctfd)
+    d = bytes(ctfd) # names are found by offset, straight in the bytes. the reader only does the fixed-width records
+    r = BufferReader(d)
     group_count = 70 # len(SNOGroups) Yeah i dont fucking know why there's 3 groups
-    group_lens = [int.from_bytes(cf.read(4), byteorder='little') for x in range(group_count)]
-    group_offsets = [int.from_bytes(cf.read(4), byteorder='little') for x in range(group_count)]
-    group_unk_counts = [int.from_bytes(cf.read(4), byteorder='little') for x in range(group_count)]
+    header = r.unpack(_coretoc_header)
+    group_lens = header[:group_count]
+    group_offsets = header[group_count:group_count*2]
 
     snomap = {}
-
-    cf.seek(4,1)
     for gri in range(group_count):
         grln=group_lens[gri]
         if grln <= 0: 
             continue
-        gr_offset=group_offsets[gri] + 12*group_count+4 # offset + header
-        cf.seek(gr_offset)
-        for _ in range(grln):
-            grpId, snoId, name_offset = struct.unpack("III",cf.read(12))
-            noffset = gr_offset + 12*grln + name_offset # offset+header + group
-            
-            op=cf.tell()
-            cf.seek(noffset)
-            name = read_cstr(cf)
-            cf.seek(op)
-
-            snomap[snoId] = (name,grpId)+SNOGroups[grpId]
+        r.seek(group_offsets[gri] + 12*group_count+4) # offset + header
+        names_offset = r.tell() + 12*grln # names follow the group's entries
+        for grpId, snoId, name_offset in r.iter_unpack(_coretoc_entry,grln):
+            snomap[snoId] = (_cstr_at(d,names_offset+name_offset)[0],grpId)+SNOGroups[grpId]
 
     # snoid : snoinfo
     return snomap
 
 def _parse_d3_packages(pkfd):
-    pf = BytesIO(pkfd)
-    sig,numnames = struct.unpack("II",pf.read(8))
+    r = BufferReader(pkfd)
+    sig,numnames = r.u32(),r.u32()
     assert sig == 0xAABB0002
     name_arr = {}
-    for _ in range(numnames):
-        p=read_cstr(pf).replace("\\","/")
-        p=pathlib.PurePath(p)
-        # if p.stem in name_arr:
-        #     continue
-
+    names = bytes(r.take()).split(b'\0',numnames)[:numnames]
+    for p in names:
+        p=pathlib.PurePath(p.decode("utf-8",errors="replace").replace("\\","/"))
         name_arr[p.stem]=p.parts[:-1]+(p.stem,p.suffix)
-    print(f"Finished reading {len(name_arr)}/{numnames} names at {pf.tell()}")
+    print(f"Finished reading {len(name_arr)}/{numnames} names at {8+sum(map(len,names))+len(names)}")
     return name_arr
 
+def _parse_d3_dir_root(d):
+    """ Parses one directory's root file. Returns (sno entries, indexed sno entries, named entries) """
+    d = bytes(d)
+    r = BufferReader(d,4) # past the magic
 
-def _parse_d3_root_entry(df,t):
-    ckey = byteskey_to_hex(df.read(16))
-    if t is SNO_FILE or t is SNO_INDEXED_FILE:
-        snoid,=struct.unpack("I",df.read(4))
-        if t is SNO_INDEXED_FILE:
-            findex,=struct.unpack("I",df.read(4))
-            return t,(snoid,findex),ckey
-        else:
-            return t,snoid,ckey
-    elif t is NAMED_FILE:
-        return t,read_cstr(df),ckey
+    sno = [(snoid,ckey) for ckey,snoid in r.iter_unpack(_sno_entry,r.u32())]
+    sno_indexed = [(snoid,findex,ckey) for ckey,snoid,findex in r.iter_unpack(_sno_indexed_entry,r.u32())]
+
+    named = []
+    for _ in range(r.u32()):
+        ckey = r.read(16)
+        fname,pos = _cstr_at(d,r.tell())
+        r.seek(pos)
+        named.append((NAMED_FILE,fname,ckey))
+    return sno,sno_indexed,named
+
+def _fetch_all(cr, ckeys):
+    """ Fetches the files concurrently, returns a dict of ckey:data for the ones that exist """
+    return dict(cr.fetch_files_by_ckeys(ckeys))
 
 def parse_d3_root(fd,cr):
-    f = BytesIO(fd)
-    sig = f.read(4)
-    assert sig == b'\xc4\xd0\x07\x80'
-    count, = struct.unpack("I",f.read(4))
-    final_entries = []
-    sno_entries = []
+    d = bytes(fd)
+    r = BufferReader(d)
+    assert r.read(4) == b'\xc4\xd0\x07\x80'
     dirs = []
-    for _ in range(count):
-        ckey=f.read(16)
-        name=read_cstr(f)
+    for _ in range(r.u32()):
+        ckey = r.read(16).hex()
+        name,pos = _cstr_at(d,r.tell())
+        r.seek(pos)
         dirs.append((name,ckey))
 
-    for name,ckey in dirs:
-        ckey=byteskey_to_hex(ckey)
+    dirfiles = _fetch_all(cr,[ckey for _,ckey in dirs])
+
+    final_entries = TranslateTable()
+    dir_entries = []
+    for name,ckey in dirs: # in root order, whatever order the fetches finished in
         final_entries.append((NAMED_FILE,"_ROOTFILES/"+name,ckey))
-        dirfile = cr.get_file_by_ckey(ckey)
-        if dirfile is None:
+        if dirfiles.get(ckey) is None:
             continue
-        df = BytesIO(dirfile)
-        dfmagic = df.read(4)
-
-        snocount, = struct.unpack("I",df.read(4))
-        for _ in range(snocount):
-            e = _parse_d3_root_entry(df,SNO_FILE)+(name,)
-            sno_entries.append(e)
-        
-        snoidx_count, = struct.unpack("I",df.read(4))
-        for _ in range(snoidx_count):
-            e = _parse_d3_root_entry(df,SNO_INDEXED_FILE)+(name,)
-            sno_entries.append(e)
-
-        namecount, = struct.unpack("I",df.read(4))
-        for _ in range(namecount):
-            e = _parse_d3_root_entry(df,NAMED_FILE)+(name,)
-            final_entries.append(e) 
-            # add them directly to the final entries, since these are basically the final results for this type of entry
-    
-    coretoc_ckey = [c for c in final_entries if c[1]=="CoreTOC.dat"][0][2]
-    sno_table = _parse_d3_coretoc(cr.get_file_by_ckey(coretoc_ckey)) # snid : (name,sngrp,grpnm,grpext)
-
-    packages_ckey = [c for c in final_entries if c[1]=="Data_D3\\PC\\Misc\\Packages.dat"][0][2]
-    pkg_table = _parse_d3_packages(cr.get_file_by_ckey(packages_ckey)) # fn : (fpath,fname,fext)
-
-    for sf in sno_entries:
-        if sf[0]==SNO_FILE:
-            if sf[1] in sno_table: # if this file is in the sno_table, then we know it's name
-                sfn = sno_table[sf[1]]
-                final_entries.append((NAMED_FILE,f"{sfn[2]}/{sfn[0]}.{sfn[3]}",sf[2]))
+        sno,sno_indexed,named = _parse_d3_dir_root(dirfiles[ckey])
+        dir_entries.append((sno,sno_indexed))
+        final_entries.extend(named) # these are basically the final results for this type of entry
+
+    named = {}
+    for e in final_entries:
+        named.setdefault(e[1],e[2])
+    coretoc_ckey = named["CoreTOC.dat"]
+    packages_ckey = named["Data_D3\\PC\\Misc\\Packages.dat"]
+    tocs = _fetch_all(cr,[coretoc_ckey,packages_ckey])
+    sno_table = _parse_d3_coretoc(tocs[coretoc_ckey]) # snid : (name,sngrp,grpnm,grpext)
+    pkg_table = _parse_d3_packages(tocs[packages_ckey]) # fn : (fpath,fname,fext)
+
+    for sno,sno_indexed in dir_entries:
+        for snoid,ckey in sno:
+            sfn = sno_table.get(snoid)
+            if sfn is not None: # if this file is in the sno_table, then we know it's name
+                final_entries.append((NAMED_FILE,f"{sfn[2]}/{sfn[0]}.{sfn[3]}",ckey))
             else: # otherwise, we dont know the name.
-                final_entries.append((SNO_FILE,sf[1],sf[2]))
-        else: # sf is SNO_INDEXED_FILE
-            if sf[1][0] in sno_table: # if this file is in the sno_table, then we know it's name
-                sfn = sno_table[sf[1][0]]
+                final_entries.append((SNO_FILE,snoid,ckey))
+
+        for snoid,findex,ckey in sno_indexed:
+            sfn = sno_table.get(snoid)
+            if sfn is not None:
                 pkg = pkg_table[sfn[0]]
-                final_entries.append((NAMED_FILE,f"{sfn[2]}/{pkg[1]}/{sf[1][1]:05d}{pkg[-1]}",sf[2]))
-            else: # otherwise, we dont know the name.
-                final_entries.append((SNO_INDEXED_FILE,sf[1],sf[2]))
+                final_entries.append((NAMED_FILE,f"{sfn[2]}/{pkg[1]}/{findex:05d}{pkg[-1]}",ckey))
+            else:
+                final_entries.append((SNO_INDEXED_FILE,(snoid,findex),ckey))
 
     return final_entries
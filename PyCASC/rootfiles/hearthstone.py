@@ -1,15 +1,10 @@
-from io import BytesIO
-import struct
-import pathlib
-from PyCASC.utils.CASCUtils import read_cstr, var_int, NAMED_FILE, SNO_FILE, SNO_INDEXED_FILE
-from PyCASC.utils.blizzutils import byteskey_to_hex
+from PyCASC.utils.CASCUtils import NAMED_FILE, SNO_FILE, SNO_INDEXED_FILE, TranslateTable
 
 def parse_hearthstone_root(fd):
-    name_map = []
-    if isinstance(fd,bytes):
-        fd = fd.decode("utf-8")
+    if not isinstance(fd,str):
+        fd = str(fd,"utf-8")
 
-    for x in fd.splitlines():
-        filepath,unk,ckey = x.split("|")
-        name_map.append((NAMED_FILE,filepath,ckey))
+    rows = [x.split("|") for x in fd.splitlines()] # filepath|unk|ckey
+    name_map = TranslateTable()
+    name_map.add_named([r[0] for r in rows],bytes.fromhex("".join(r[2] for r in rows)))
     return name_map
\ No newline at end of file
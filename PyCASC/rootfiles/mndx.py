@@ -1,8 +1,20 @@
-from io import BytesIO
+import sys
 import struct
-import pathlib
-from PyCASC.utils.CASCUtils import read_cstr, var_int, NAMED_FILE, SNO_FILE, SNO_INDEXED_FILE
-from PyCASC.utils.blizzutils import byteskey_to_hex
+from array import array
+from bisect import bisect_right
+from collections import deque
+from itertools import accumulate
+from PyCASC.utils.bufferreader import BufferReader
+
+MNDX_LAST_CKEY_ENTRY = 0x80000000 # set on the last ckey entry (package variant) of a file
+
+_ckey_entry = struct.Struct("<I16sI") # flags (low 24 bits are the package), ckey, content size
+_bitarray_info = struct.Struct("<IIQ") # bits per entry, entry mask, entry count
+_sparse_info = struct.Struct("<II") # bit count, set bit count
+_db_info = struct.Struct("<II") # level 1 node count, config
+_mndx_header = struct.Struct("<4sII") # MNDX, header version, format version
+_mndx_tables = struct.Struct("<7I") # mar info offset, count, size, ckey entries offset, count, file name count, entry size
+_mar_info = struct.Struct("<5I")
 
 class MARInfo:
     idx:int
@@ -11,98 +23,308 @@ class MARInfo:
     off:int
     off_h:int
 
-class MNDX_GeneralArray:
-    def __init__(self,f,cb,el_len=4):
-        """ Read a binary array with cb being each element's structure handler """
-
-        self.byte_count = var_int(f,8)
-        assert self.byte_count  % el_len == 0, f"Bytelen {self.byte_count } does not match ellen {el_len}"
-        self.num_elements = self.byte_count // el_len
+def _r_vector(r):
+    """ Reads a serialized array (8 byte byte count, the data, padding to 8 bytes) from a BufferReader """
+    byte_count = r.u64()
+    assert byte_count <= r.remaining(), f"Array of {byte_count} bytes runs past the end of the file, definitely a bug"
+    data = r.take(byte_count)
+    r.skip((0-byte_count)&0x07)
+    return data
 
-        assert self.num_elements < 10000000, f"Array WAY too big (s:{self.num_elements}), definitely a bug"
-
-        self.data=[]
-        for x in range(self.num_elements):
-            self.data.append(cb(f))
-        f.seek((0-int(self.byte_count))&0x07,1)
-
-class MNDX_IntArray:
-    def __init__(self,f):
-        genarr = MNDX_GeneralArray(f,lambda f: var_int(f,4), el_len=4)
-        self.byte_count = genarr.byte_count
-        self.num_elements = genarr.num_elements
-        self.data = genarr.data
+def _words(b):
+    a = array('I')
+    a.frombytes(b)
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a
 
 class MNDX_BitArray:
-    def __init__(self,f):
-        self.array = MNDX_IntArray(f)
-        self.bits_per_ent = var_int(f,4)
-        self.entry_bitmask = var_int(f,4)
-        self.total_elements = var_int(f,8)
+    """ Packed array of bits_per_ent wide values """
+    def __init__(self, r):
+        self.units = _r_vector(r)
+        self.bits_per_ent, self.entry_bitmask, self.total_elements = r.unpack(_bitarray_info)
+        assert self.bits_per_ent * self.total_elements <= len(self.units)*8, "Invalid BitArray"
 
-        assert self.bits_per_ent * self.total_elements / 32 <= self.array.num_elements, "Invalid BitArray"
+    def __getitem__(self, i):
+        pos = i*self.bits_per_ent
+        b = pos>>3
+        return (int.from_bytes(self.units[b:b+5],'little') >> (pos&7)) & self.entry_bitmask
 
 class MNDX_SparseArray:
-    def __init__(self,f):
-        self.itembits = MNDX_IntArray(f)
-        self.totalitems,self.validitems = var_int(f,4), var_int(f,4)
+    """ Bit vector with rank and select.
+    The rank/select tables stored in the file are skipped, a cumulative popcount per 32 bit word is built on first use instead. """
+    def __init__(self, r):
+        self.itembits = _words(_r_vector(r))
+        self.totalitems,self.validitems = r.unpack(_sparse_info)
         assert self.validitems <= self.totalitems, f"{self.validitems} < {self.totalitems}"
-        self.basevals = MNDX_GeneralArray(f,lambda f:(var_int(f,3)),el_len=3) # each el has 3 bytes.
-        self.intarr1 = MNDX_IntArray(f)
-        self.intarr2 = MNDX_IntArray(f)
+        for _ in range(3): # base values (rank index), select0 and select1 samples
+            _r_vector(r)
+        self.ranks = None
+        self.zero_ranks = None
+
+    def __len__(self):
+        return self.totalitems
 
-class MNDX_HashTable:
-    def __init__(self, f):
-        pass
+    def __getitem__(self, i):
+        return (self.itembits[i>>5] >> (i&31)) & 1
 
+    def _build_ranks(self):
+        self.ranks = array('I',accumulate(map(int.bit_count,self.itembits),initial=0))
+        self.zero_ranks = array('I',(32*w-r for w,r in enumerate(self.ranks)))
+
+    def rank1(self, i):
+        """ Number of set bits before i """
+        if self.ranks is None:
+            self._build_ranks()
+        return self.ranks[i>>5] + (self.itembits[i>>5] & ((1<<(i&31))-1)).bit_count()
+
+    def _select(self, ranks, n, invert):
+        w = bisect_right(ranks,n)-1
+        x = self.itembits[w]^0xffffffff if invert else self.itembits[w]
+        for _ in range(n-ranks[w]):
+            x &= x-1 # drop the lowest set bit
+        return w*32 + (x&-x).bit_length()-1
+
+    def select1(self, n):
+        """ Position of the n-th (from 0) set bit """
+        if self.ranks is None:
+            self._build_ranks()
+        return self._select(self.ranks,n,False)
+
+    def select0(self, n):
+        """ Position of the n-th (from 0) clear bit """
+        if self.ranks is None:
+            self._build_ranks()
+        return self._select(self.zero_ranks,n,True)
 
 class MARFileDB:
-    def parse_filedb(self, f):
-        hdr = f.read(4)
+    """ A MAR name database, which is a marisa trie (LOUDS encoded, with the labels of long edges kept in a tail
+    or in a nested trie). Node 0 is the root, a node's children are the set bits following its clear bit in CollisionTable,
+    and keys (file name indexes) are numbered by the terminal nodes in FileNameIndexes. """
 
-        assert hdr == b'MAR\0', "Incorrect fdb header "+str(hdr)
+    def parse_filedb(self, r, nested=False):
+        """ Parses the database at the BufferReader r's position, leaving r after it. Nested databases have no header. """
+        if not nested:
+            hdr = r.read(4)
+            assert hdr == b'MAR\0', "Incorrect fdb header "+str(hdr)
 
-        self.CollisionTable = MNDX_SparseArray(f)
-        self.FileNameIndexes = MNDX_SparseArray(f)
-        self.CollisionHiBitsIndexes = MNDX_SparseArray(f)
-        self.LoBitsTable = MNDX_GeneralArray(f,lambda f:f.read(1),el_len=1)
-        self.HiBitsTable = MNDX_BitArray(f) # this should be a custom class, but i cba
-        self.PathFragments = MNDX_GeneralArray(f,lambda f:f.read(1),el_len=1)
-        self.PathMarks = MNDX_SparseArray(f)
+        self.CollisionTable = MNDX_SparseArray(r) # louds
+        self.FileNameIndexes = MNDX_SparseArray(r) # terminal flags
+        self.CollisionHiBitsIndexes = MNDX_SparseArray(r) # link flags
+        self.LoBitsTable = _r_vector(r).tobytes() # a node's label, or low 8 bits of its link
+        self.HiBitsTable = MNDX_BitArray(r) # the high bits of links
+        self.PathFragments = _r_vector(r).tobytes() # the tail
+        self.PathMarks = MNDX_SparseArray(r) # tail fragment ends, if the tail isn't null terminated
 
-        if self.CollisionHiBitsIndexes.validitems != 0 and self.PathFragments.validitems == 0:
+        self.childDb = None
+        if self.CollisionHiBitsIndexes.validitems != 0 and len(self.PathFragments) == 0:
             self.childDb = MARFileDB()
-            self.childDb.parse_filedb(f)
+            self.childDb.parse_filedb(r,nested=True)
+
+        _r_vector(r) # name fragment hash table, only a lookup cache
+        self.l1_node_count, self.config = r.unpack(_db_info)
+
+    def _link(self, node, link_id):
+        return self.LoBitsTable[node] | (self.HiBitsTable[link_id] << 8)
+
+    def _parent(self, node):
+        return self.CollisionTable.select1(node) - node - 1
+
+    def _fragment(self, link, restored=None):
+        """ The label of a long edge, in order. restored is the nested database's _restore_all(), if it was built """
+        if self.childDb is not None:
+            return restored[link] if restored is not None else self.childDb._restore(link)
+        if len(self.PathMarks) == 0:
+            return self.PathFragments[link:self.PathFragments.index(b'\0',link)]
+        end = self.PathMarks.select1(self.PathMarks.rank1(link))
+        return self.PathFragments[link:end+1]
+
+    def _restore(self, node):
+        """ Walks from node up to the root, collecting labels. Nested databases store their fragments reversed, so this reads them in order. """
+        out = []
+        while True:
+            if self.CollisionHiBitsIndexes[node]:
+                out.append(self._fragment(self._link(node,self.CollisionHiBitsIndexes.rank1(node))))
+            else:
+                out.append(self.LoBitsTable[node:node+1])
+            if node <= self.l1_node_count:
+                return b''.join(out)
+            node = self._parent(node)
+
+    def _restore_all(self):
+        """ _restore of every node, built in one pass over the trie (a node's parent always comes before it) """
+        louds, links = self.CollisionTable, self.CollisionHiBitsIndexes
+        restored = self.childDb._restore_all() if self.childDb is not None else None
+        out = [b'']
+        parent, node, link_id = 0, 1, 0
+        for louds_pos in range(2,len(louds)):
+            if not louds[louds_pos]:
+                parent += 1
+                continue
+            if links[node]:
+                label = self._fragment(self._link(node,link_id),restored)
+                link_id += 1
+            else:
+                label = self.LoBitsTable[node:node+1]
+            out.append(label if parent == 0 else label+out[parent])
+            node += 1
+        return out
+
+    def _find_child(self, node, query, qpos):
+        """ Follows the edge of node that matches query[qpos:]. Returns (child, new qpos), child is None if there's none """
+        louds_pos = self.CollisionTable.select0(node)+1
+        if not self.CollisionTable[louds_pos]:
+            return None,qpos
+        child = louds_pos-node-1
+        link_id = None
+        while True:
+            if self.CollisionHiBitsIndexes[child]:
+                link_id = self.CollisionHiBitsIndexes.rank1(child) if link_id is None else link_id+1
+                frag = self._fragment(self._link(child,link_id))
+                if query.startswith(frag,qpos):
+                    return child,qpos+len(frag)
+                if query[qpos:qpos+1] == frag[:1]: # siblings start with different characters, a partial match is a miss
+                    return None,qpos
+            elif self.LoBitsTable[child] == query[qpos]:
+                return child,qpos+1
+            child += 1
+            louds_pos += 1
+            if not self.CollisionTable[louds_pos]:
+                return None,qpos
+
+    def lookup(self, name):
+        """ Returns the file name index of name (bytes), or None """
+        node,qpos = 0,0
+        while qpos < len(name):
+            node,qpos = self._find_child(node,name,qpos)
+            if node is None:
+                return None
+        if not self.FileNameIndexes[node]:
+            return None
+        return self.FileNameIndexes.rank1(node)
+
+    def iter_names(self):
+        """ Yields (file name index, name) for every name, in one pass over the trie (breadth first, so in index order) """
+        louds, terminal, links = self.CollisionTable, self.FileNameIndexes, self.CollisionHiBitsIndexes
+        name_index = 0
+        if terminal[0]:
+            yield name_index,b''
+            name_index += 1
+
+        restored = self.childDb._restore_all() if self.childDb is not None else None
+        prefixes = deque([b'']) # names of the nodes whose children are next in the louds
+        node, link_id = 1, 0
+        for louds_pos in range(2,len(louds)): # the louds starts with the root, as the only child of a super root
+            if not louds[louds_pos]: # done with this parent's children
+                prefixes.popleft()
+                if not prefixes:
+                    break
+                continue
+            if links[node]:
+                label = self._fragment(self._link(node,link_id),restored)
+                link_id += 1
+            else:
+                label = self.LoBitsTable[node:node+1]
+            name = prefixes[0]+label
+            if terminal[node]:
+                yield name_index,name
+                name_index += 1
+            prefixes.append(name)
+            node += 1
+
+class MNDXRoot:
+    """ The root of Heroes of the Storm and StarCraft II. Its MAR databases hold the package names, the file names
+    with their package stripped, and the full file names. A file's ckey entries are found by its stripped name's index,
+    one entry per package it's in. """
+
+    def __init__(self, fd):
+        r = BufferReader(fd)
+        magic,hver,fver = r.unpack(_mndx_header)
+        assert magic == b'MNDX'
+        assert 1 <= fver <= 2, "Unsupported MNDX root v"+str(fver)
+        if hver == 2:
+            r.skip(8)
 
-        self.HashTable = MNDX_HashTable(f)
+        mio, mic, mis, ckeo, ckec, fnc, ckes = r.unpack(_mndx_tables)
+        assert mic <= 3 and mis == 20, f"mic={mic} | mis={mis}"
+        assert ckes == _ckey_entry.size, f"ckes={ckes}"
 
-        # if self.PathFragmentTable
+        self.marfiles = []
+        r.seek(mio)
+        for idx,size,size_h,off,off_h in list(r.iter_unpack(_mar_info,mic)):
+            m = MARFileDB()
+            m.parse_filedb(BufferReader(r.view[off:off+size]))
+            self.marfiles.append(m)
 
-def parse_mndx_root(fd):
-    f = BytesIO(fd)
-    assert f.read(4) == b'MNDX'
+        r.seek(ckeo)
+        self.ckey_entries = r.take(ckec*ckes)
+        flags = array('I',(e[0] for e in _ckey_entry.iter_unpack(self.ckey_entries)))
+        # a file's entries start right after the previous file's last entry
+        self.first_entries = array('I',[0])
+        self.first_entries.extend(i+1 for i,f in enumerate(flags) if f & MNDX_LAST_CKEY_ENTRY)
+        del self.first_entries[fnc:]
+        self.packages = None
 
-    hver,fver = struct.unpack("II",f.read(8))
-    assert 1 <= fver <= 2, "Unsupported MNDX root v"+str(fver)
+    def _load_packages(self):
+        self.packages = {name:i for i,name in self.marfiles[0].iter_names()}
 
-    if hver == 2:
-        f.seek(8,1)
+    def _find_package(self, name):
+        """ Returns (package index, name with the package stripped) for the longest package name prefixing name """
+        if self.packages is None:
+            self._load_packages()
+        i = len(name)
+        while i > 0:
+            i = name.rfind(b'/',0,i)
+            if i <= 0:
+                break
+            if name[:i] in self.packages:
+                return self.packages[name[:i]],name[i:]
+        return None,None
 
-    mio, mic, mis = struct.unpack("III", f.read(12))
-    
-    ckeo, ckec, fnc, ckes = struct.unpack("IIII", f.read(16))
-    assert mic <= 3 and mis == 20, f"mic={mic} | mis={mis}"
+    def _ckey_entry(self, name_index, package):
+        if name_index is None or name_index >= len(self.first_entries):
+            return None
+        for e in range(self.first_entries[name_index],len(self.ckey_entries)//_ckey_entry.size):
+            flags,ckey,size = _ckey_entry.unpack_from(self.ckey_entries,e*_ckey_entry.size)
+            if package is None or flags & 0xffffff == package:
+                return ckey,size
+            if flags & MNDX_LAST_CKEY_ENTRY:
+                return None
+        return None
 
-    marfiles = []
-    for mc in range(mic):
-        m = MARFileDB()
-        
-        f.seek(mio + mc * mis)
-        idx,size,size_h,off,off_h = struct.unpack("5I",f.read(20))
+    def _resolve(self, name, find_stripped):
+        if len(self.marfiles) < 3: # no packages, names map straight to entries
+            return self._ckey_entry(self.marfiles[-1].lookup(name),None)
+        package,stripped = self._find_package(name)
+        if package is None:
+            return None
+        name_index = find_stripped(stripped[1:]) # the package's trailing separator may or may not be stripped too
+        if name_index is None:
+            name_index = find_stripped(stripped)
+        return self._ckey_entry(name_index,package)
 
-        f.seek(off)
-        m.parse_filedb(f)
+    def lookup(self, path):
+        """ Returns (ckey, content size) of path, or None. Walks the tries, without listing every name. """
+        name = path.strip().replace("\\","/").encode("utf-8")
+        return self._resolve(name,self.marfiles[1].lookup if len(self.marfiles) >= 3 else None)
 
-        marfiles.append(m)
+    def iter_files(self):
+        """ Yields (name, ckey, content size) for every file """
+        stripped_names = {}
+        if len(self.marfiles) >= 3:
+            stripped_names = {name:i for i,name in self.marfiles[1].iter_names()}
+        for i,name in self.marfiles[-1].iter_names():
+            if len(self.marfiles) < 3:
+                ent = self._ckey_entry(i,None)
+            else:
+                ent = self._resolve(name,stripped_names.get)
+            if ent is not None:
+                yield (name.decode("utf-8",errors="replace"),)+ent
 
-    return []
\ No newline at end of file
+def parse_mndx_root(fd,cascreader=None):
+    """ Parses the root and returns it, kept on the reader as mndx_root too. No name is listed here: paths are looked up
+    in the tries (lookup), and the reader only walks every name when it's asked for a listing (iter_files). """
+    root = MNDXRoot(fd)
+    if cascreader is not None:
+        cascreader.mndx_root = root
+    return root
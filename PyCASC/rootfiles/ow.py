@@ -1,19 +1,11 @@
 
-from PyCASC.utils.CASCUtils import read_cstr, NAMED_FILE, SNO_FILE, SNO_INDEXED_FILE
+from PyCASC.utils.CASCUtils import NAMED_FILE, SNO_FILE, SNO_INDEXED_FILE, TranslateTable
 
 def parse_ow_root(fd):
-    name_map = []
-    
-    if isinstance(fd,bytes):
-        fd = fd.decode("utf-8")
-
-    skipfirst = False
-    for l in fd.splitlines():
-        if not skipfirst:
-            skipfirst=True
-            continue
-        ld = l.split("|")
-
-        name_map.append((NAMED_FILE,ld[0],ld[1]))
+    if not isinstance(fd,str):
+        fd = str(fd,"utf-8")
 
+    rows = [l.split("|",2) for l in fd.splitlines()[1:]] # first line is the header
+    name_map = TranslateTable()
+    name_map.add_named([r[0] for r in rows],bytes.fromhex("".join(r[1] for r in rows)))
     return name_map
\ No newline at end of file
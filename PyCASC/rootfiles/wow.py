@@ -1,120 +1,181 @@
+import sys
 import struct
-from io import BytesIO
-from PyCASC.utils.CASCUtils import read_cstr, var_int, NAMED_FILE, SNO_FILE, SNO_INDEXED_FILE, WOW_HASHED_FILE, WOW_DATAID_FILE
+from array import array
+from itertools import accumulate, count, compress
+from operator import add
+from bisect import bisect_left
+from PyCASC.utils.CASCUtils import NAMED_FILE, SNO_FILE, SNO_INDEXED_FILE, WOW_HASHED_FILE, WOW_DATAID_FILE, TranslateTable
+from PyCASC.utils.blizzutils import hashlittle2
+from PyCASC.utils.bufferreader import BufferReader
 
 WOWROOT_FORMAT_82 = "82"
 WOWROOT_FORMAT_6x = "6x"
 
-class WOWROOT_GroupHeader:
-    def __init__(self, f):
-        dat = f.read(12)
-        self.valid = True
-        if len(dat)==12:
-            self.number_of_files,self.content_flags,self.locale_flags = struct.unpack("3I",dat)
-        else:
-            self.valid = False
-
-
-class WOWROOT_Group:
-    def __init__(self, f, root_format, handler):
-        self.header = WOWROOT_GroupHeader(f)
-        if not self.header.valid:
-            return
-
-        self.hashes = None
-        self.ckeys = None
-        self.entries = None
-        self.file_data_ids = [var_int(f,4) for x in range(self.header.number_of_files)]
-        handler.file_count += self.header.number_of_files
-
-        if root_format == WOWROOT_FORMAT_82:
-            self.ckeys = [f.read(0x10) for x in range(self.header.number_of_files)]
-            
-            if handler.file_count > handler.hashless_count:
-                self.hashes = [struct.unpack("Q",f.read(8)) for x in range(self.header.number_of_files)]
-
-        elif root_format == WOWROOT_FORMAT_6x:
-            self.entries = [(f.read(0x10),struct.unpack("Q",f.read(8))) for x in range(self.header.number_of_files)]
-
-        else:
-            raise f"Invalid Root Format {root_format}"
-
-class WOWROOT_Handler:
-    def __init__(self, f, root_format, hashless_count):
-        self.f = f
-        self.root_format = root_format
-        self.hashless_count = hashless_count
-        self.files = []
-
-    def load_groups(self, localeMask, override, audioGroup):
-        self.file_count = 0
-        while True:
-            g = WOWROOT_Group(self.f,self.root_format,self)
-            if not g.header.valid:
-                break
-
-            if (g.header.content_flags & 0x100) > 0:
-                continue
-
-            if (g.header.content_flags & 0x80) > 0 and override == 0:
+CFLAG_LOAD_ON_WINDOWS = 0x8
+CFLAG_LOAD_ON_MACOS = 0x10
+CFLAG_LOW_VIOLENCE = 0x80
+CFLAG_DONT_LOAD = 0x100
+CFLAG_NO_NAME_HASH = 0x10000000
+
+LOCALE_ENUS = 0x2
+LOCALE_KOKR = 0x4
+LOCALE_FRFR = 0x10
+LOCALE_DEDE = 0x20
+LOCALE_ZHCN = 0x40
+LOCALE_ESES = 0x80
+LOCALE_ZHTW = 0x100
+LOCALE_ENGB = 0x200
+LOCALE_ENCN = 0x400
+LOCALE_ENTW = 0x800
+LOCALE_ESMX = 0x1000
+LOCALE_RURU = 0x2000
+LOCALE_PTBR = 0x4000
+LOCALE_ITIT = 0x8000
+LOCALE_PTPT = 0x10000
+LOCALE_ALL = 0xffffffff
+
+_group_header = struct.Struct("<3I")
+_entry_6x = struct.Struct("<16sQ")
+
+def wow_path_hash(path):
+    """ The 64 bit name hash a wow root lists a path under (hashlittle2 of the upper case, backslashed path) """
+    c,b = hashlittle2(path.strip().replace("/","\\").upper())
+    return (c<<32)|b
+
+def _le_array(typecode, b):
+    a = array(typecode)
+    a.frombytes(b)
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a
+
+class WOWROOT_View:
+    """ Which part of a wow root a reader exposes. A group of the root is in the view when it is listed for one of the 
+    locales, has none of the exclude_flags, and (if platform_flags is set) isn't meant only for another platform. 
+    The default is what the game loads: every locale, without low violence or dont-load content. """
+
+    def __init__(self, locales=LOCALE_ALL, exclude_flags=CFLAG_LOW_VIOLENCE|CFLAG_DONT_LOAD, platform_flags=0):
+        self.locales = locales
+        self.exclude_flags = exclude_flags
+        self.platform_flags = platform_flags
+
+    def matches(self, content_flags, locale_flags):
+        if content_flags & self.exclude_flags:
+            return False
+        if locale_flags & self.locales == 0:
+            return False
+        platforms = content_flags & (CFLAG_LOAD_ON_WINDOWS|CFLAG_LOAD_ON_MACOS)
+        if self.platform_flags and platforms and platforms & self.platform_flags == 0:
+            return False
+        return True
+
+class WOWROOT_Columns:
+    """ Every entry of a wow root, across all locales, as parallel columns. All of them are kept whatever the reader's view,
+    so switching views (CASCReader.set_root_view) never parses the root again.
+    Row i is the file fdids[i], with ckey ckeys[i*16:i*16+16], the name hash namehashes[i] (0 if its group has none),
+    and the locale and content flags of the group it was listed in. 
+    groups indexes the rows by (content flags, locale flags), so a view of the root is a handful of row ranges. """
+
+    def __init__(self):
+        self.groups = {} # (content flags, locale flags) -> [(start row, end row)]
+        self.fdids = array('I')
+        self.ckeys = bytearray()
+        self.namehashes = array('Q')
+        self.locales = array('I')
+        self.content_flags = array('I')
+
+    def __len__(self):
+        return len(self.fdids)
+
+    def ckey(self, i):
+        return bytes(self.ckeys[i*16:i*16+16])
+
+    def _build_namehash_index(self):
+        """ Sorts the rows that have a name hash by that hash, so lookup_path can binary search them """
+        rows = sorted(compress(range(len(self.namehashes)),self.namehashes),key=self.namehashes.__getitem__)
+        self.namehash_rows = array('I',rows)
+        self.namehash_keys = array('Q',map(self.namehashes.__getitem__,rows))
+
+    def lookup_path(self, path, view=None):
+        """ Returns the row of path that is in view, or None. Needs no listfile, just the name hashes in the root. """
+        if getattr(self,"namehash_keys",None) is None:
+            self._build_namehash_index()
+        view = view if view is not None else WOWROOT_View()
+        h = wow_path_hash(path)
+        i = bisect_left(self.namehash_keys,h)
+        while i < len(self.namehash_keys) and self.namehash_keys[i] == h:
+            row = self.namehash_rows[i]
+            if view.matches(self.content_flags[row],self.locales[row]):
+                return row
+            i += 1
+        return None
+
+    def translate(self, view=None):
+        """ Returns a TranslateTable of every file in view (a WOWROOT_View, the default view if None) """
+        view = view if view is not None else WOWROOT_View()
+        out = TranslateTable()
+        for (content_flags,locale_flags),ranges in self.groups.items():
+            if not view.matches(content_flags,locale_flags):
                 continue
-
-            if (g.header.content_flags >> 0x1f) != audioGroup:
-                continue
-
-            if localeMask != 0 and (g.header.locale_flags & localeMask) == 0:
-                continue
-
-            if self.root_format == WOWROOT_FORMAT_82:
-                fid = 0
-                for x in range(g.header.number_of_files):
-                    fid += g.file_data_ids[x]
-                    fid &= 0xffffffff # the c equivalent here wraps around to negatives.
-                    self.files.append([fid,g.ckeys[x],g.hashes[x] if g.hashes is not None else 0])
-                    fid += 1
-
-    def load_audio_group(self, localeMask, audioGroup):
-        p = self.f.tell()
-        self.load_groups(localeMask,False,audioGroup)
-        self.f.seek(p)
-
-    def load(self, localeMask):
-        self.load_audio_group(localeMask,0)
-        self.load_audio_group(localeMask,1)
-        
-
-def parse_82_hdr(f):
-    sig,item_count,namehash_count = struct.unpack("3I",f.read(12))
-
-    if sig != 0x4D465354:
-        return False
-    
-    if namehash_count > item_count:
-        return False
-
-    return (item_count,namehash_count)
-
-def parse_wow_root(fd):
-    f = BytesIO(fd)
-    hashless_count = 0
+            for start,end in ranges:
+                out.add_ids(WOW_DATAID_FILE,self.fdids[start:end],self.ckeys[start*16:end*16])
+        return out
+
+    def hidden_ckeys(self, view=None):
+        """ The ckeys (as ints) only listed in groups outside view, which a reader's listings leave out """
+        view = view if view is not None else WOWROOT_View()
+        shown,hidden,ckeys = set(),set(),bytes(self.ckeys)
+        for (content_flags,locale_flags),ranges in self.groups.items():
+            keys = shown if view.matches(content_flags,locale_flags) else hidden
+            for start,end in ranges:
+                keys.update(ckeys[i:i+16] for i in range(start*16,end*16,16))
+        return {int.from_bytes(k,'big') for k in hidden-shown}
+
+    def _add_group(self, deltas, ckeys, namehashes, content_flags, locale_flags):
+        n = len(deltas)
+        self.groups.setdefault((content_flags,locale_flags),[]).append((len(self.fdids),len(self.fdids)+n))
+        # fdids are delta encoded, each one is the previous fdid + 1 + its delta. (wraps like the uint32 it is)
+        self.fdids.extend(map((0xffffffff).__and__,map(add,accumulate(deltas),count())))
+        self.ckeys += ckeys
+        self.namehashes.extend(namehashes if namehashes is not None else array('Q',bytes(8*n)))
+        self.locales.extend(array('I',[locale_flags])*n)
+        self.content_flags.extend(array('I',[content_flags])*n)
+
+def parse_wow_root_columns(fd):
+    """ Parses a whole wow root in one pass, decoding each group's arrays in bulk. Returns a WOWROOT_Columns. """
+    r = BufferReader(fd)
     root_format = WOWROOT_FORMAT_82
 
-    hdr = parse_82_hdr(f)
-
-    if not hdr: # header is not 82, must be 6x
-        f.seek(-12,1)
+    sig,item_count,namehash_count = r.unpack(_group_header)
+    if sig != 0x4D465354 or namehash_count > item_count: # header is not 82, must be 6x
         root_format = WOWROOT_FORMAT_6x
-    else:
-        hashless_count = hdr[0]-hdr[1]
-        
-    root_handle = WOWROOT_Handler(f,root_format,hashless_count)
-
-    root_handle.load(0xffffffff) # load all locales
-    root_handle.load(0x01) # load all locales
+        r.seek(0)
 
-    name_map = []
-    
-    for x in root_handle.files:
-        name_map.append((WOW_DATAID_FILE,x[0],x[1]))
+    cols = WOWROOT_Columns()
+    while r.remaining() >= _group_header.size:
+        n,content_flags,locale_flags = r.unpack(_group_header)
+        deltas = _le_array('I',r.take(4*n))
 
-    return name_map
\ No newline at end of file
+        if root_format == WOWROOT_FORMAT_82:
+            ckeys = r.take(16*n)
+            namehashes = None
+            if not content_flags & CFLAG_NO_NAME_HASH:
+                namehashes = _le_array('Q',r.take(8*n))
+        else: # 6x interleaves ckeys and name hashes
+            entries = list(r.iter_unpack(_entry_6x,n))
+            ckeys = b''.join(e[0] for e in entries)
+            namehashes = array('Q',[e[1] for e in entries])
+
+        cols._add_group(deltas,ckeys,namehashes,content_flags,locale_flags)
+
+    return cols
+
+def parse_wow_root(fd,cascreader=None):
+    """ Parses the root, and returns the translate table for the reader's root_view (or the default view).
+    The parsed columns are kept on the reader as wow_root, so it can switch views later without parsing the root again. """
+    cols = parse_wow_root_columns(fd)
+    view = None
+    if cascreader is not None:
+        cascreader.wow_root = cols
+        view = getattr(cascreader,"root_view",None)
+    return cols.translate(view)
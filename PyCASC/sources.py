@@ -0,0 +1,88 @@
+import os
+import mmap
+from PyCASC import CACHE_DURATION
+from PyCASC.launcher import getProductVersions, getProductCDNFile, isCDNFileCached, getCDN
+from PyCASC.utils.blizzutils import parse_config, get_cdn_url, get_range_url, fetch_range, put_cached
+
+class CDNSource:
+    """ Where a CDNCASCReader gets its product versions and cdn files from.
+    This one reads from Blizzard's patch servers and cdns, through the local cache. """
+
+    def __init__(self, product, region="us"):
+        self.product = product
+        self.region = region
+
+    def versions(self):
+        return getProductVersions(self.product)
+
+    def get_file(self, file_hash, ftype="data", cache_dur=CACHE_DURATION, enc=None, max_size=-1, index=False, offset=0, size=-1):
+        """ Returns a cdn file (or the [offset, offset+size) range of it) as a memoryview, or a str when enc is given """
+        return getProductCDNFile(self.product,file_hash,self.region,ftype=ftype,cache_dur=cache_dur,enc=enc,max_size=max_size,index=index,offset=offset,size=size)
+
+    def is_cached(self, file_hash, ftype="data", cache_dur=CACHE_DURATION, index=False, offset=0, size=-1):
+        """ Whether get_file can be served without going to the network """
+        return isCDNFileCached(self.product,file_hash,self.region,ftype=ftype,cache_dur=cache_dur,index=index,offset=offset,size=size)
+
+    def host(self):
+        """ The host requests go to, for per-host limits """
+        return getCDN(self.product,self.region)[0]
+
+    def fetch_range(self, file_hash, offset, size, cache=True):
+        """ Downloads a range of a data file with one request, and (with cache) caches it for later get_file calls of that same range """
+        cdnurl,cdnpath = getCDN(self.product,self.region)
+        url = get_cdn_url(cdnurl,cdnpath,"data",file_hash)
+        data = fetch_range(url,offset,size)
+        if cache:
+            put_cached(get_range_url(url,offset,size),data)
+        return data
+
+    def put_range(self, file_hash, offset, size, data):
+        """ Caches data as the given range of a data file, for when it was fetched as part of a wider range """
+        cdnurl,cdnpath = getCDN(self.product,self.region)
+        put_cached(get_range_url(get_cdn_url(cdnurl,cdnpath,"data",file_hash),offset,size),data)
+
+class MirrorSource(CDNSource):
+    """ Reads a product from a local directory laid out like the cdn, with no network I/O at all.
+    The directory holds config/ab/cd/<hash> and data/ab/cd/<hash>[.index] files, plus the product's versions file
+    as served by the patch server. If a cdns file is saved too, and the region's cdn Path exists under the directory,
+    files are read from there instead (so a mirror of several products can share one directory). """
+
+    def __init__(self, path, product=None, region="us"):
+        super().__init__(product, region)
+        self.path = path
+        self.root = path
+        cdns_file = os.path.join(path,"cdns")
+        if os.path.exists(cdns_file):
+            with open(cdns_file,"r") as f:
+                cdns = [x for x in parse_config(f.read()) if x['Name']==region]
+            if len(cdns) and os.path.isdir(os.path.join(path,cdns[0]['Path'])):
+                self.root = os.path.join(path,cdns[0]['Path'])
+
+    def _file_path(self, file_hash, ftype, index=False):
+        return os.path.join(self.root,ftype,file_hash[:2],file_hash[2:4],file_hash+(".index" if index else ""))
+
+    def versions(self):
+        with open(os.path.join(self.path,"versions"),"r") as f:
+            return parse_config(f.read())
+
+    def get_file(self, file_hash, ftype="data", cache_dur=CACHE_DURATION, enc=None, max_size=-1, index=False, offset=0, size=-1):
+        fp = self._file_path(file_hash,ftype,index)
+        if os.path.getsize(fp) == 0: # can't map an empty file
+            d = memoryview(b'')
+        else:
+            with open(fp,"rb") as f:
+                d = memoryview(mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ))
+        d = d[offset:] if size < 0 else d[offset:offset+size]
+        return d if enc is None else str(d,enc)
+
+    def is_cached(self, file_hash, ftype="data", cache_dur=CACHE_DURATION, index=False, offset=0, size=-1):
+        return os.path.exists(self._file_path(file_hash,ftype,index))
+
+    def host(self):
+        return self.path
+
+    def fetch_range(self, file_hash, offset, size, cache=True):
+        return self.get_file(file_hash,offset=offset,size=size)
+
+    def put_range(self, file_hash, offset, size, data):
+        pass # everything is already on disk
@@ -1,178 +1,342 @@
 import struct
-from io import BytesIO
+from array import array
 from typing import List
 from PyCASC import TACT_KEYS
 from PyCASC.utils.blizzutils import byteskey_to_hex, var_int
+from PyCASC.utils.bufferreader import BufferReader, U16BE
 
 def beautify_filesize(i):
     t,c=["","K","M","G","T"],0
     while i>1024:i/=1024;c+=1
     return str(round(i,2))+t[c]+"B"
     
-def parse_encoding_file(fd,whole_key=False):
-    d=BytesIO(fd)
-    assert d.read(2) == b"EN"
-    version,ckey_len,ekey_len = struct.unpack("3B",d.read(3))
-    ckey_pagesize = int.from_bytes(d.read(2),'big')*1024
-    ekey_pagesize = int.from_bytes(d.read(2),'big')*1024
-    ckey_pagecount = int.from_bytes(d.read(4),'big')
-    ekey_pagecount = int.from_bytes(d.read(4),'big')
-    d.seek(1,1) #unk_1
-    espec_blocksize = int.from_bytes(d.read(4),'big')
+def short_ekey(ekey, ekey_size):
+    """ The first 9 bytes of an ekey_size byte long ekey, which is all local storage indexes keep of it.
+    The width has to come from the ekey's source (a reader's EKEY_SIZE): a full key starting with zero bytes is a small int too. """
+    return ekey >> 8*(ekey_size-9)
+
+_encoding_header = struct.Struct(">2s3BHHIIBI")
+
+def parse_encoding_file(fd,whole_key=False,sizes=None):
+    """ Parses the encoding file straight from the buffer it was given (bytes, or a memoryview over the cache).
+    If sizes is a dict, it's filled with ckey -> content (decoded) size, which the ckey pages list for every file. """
+    r=BufferReader(fd)
+    magic,version,ckey_len,ekey_len,ckey_pagesize,ekey_pagesize,ckey_pagecount,ekey_pagecount,_,espec_blocksize = r.unpack(_encoding_header)
+    assert magic == b"EN"
+    ckey_pagesize *= 1024
+    ekey_pagesize *= 1024
 
     # print(version,ckey_len,ekey_len,ckey_pagesize,ekey_pagesize,ckey_pagecount,ekey_pagecount,espec_blocksize)
-    espec_data = d.seek(espec_blocksize,1)
-    ckey_map = _parse_ckey_pages(d,ckey_len,ekey_len,ckey_pagesize,ckey_pagecount,whole_key)
+    r.skip(espec_blocksize)
+    ckey_map = _parse_ckey_pages(r,ckey_len,ekey_len,ckey_pagesize,ckey_pagecount,whole_key,sizes)
 
     return ckey_map # i could do more here, but this is the only thing i actually need so idgaf.
 
-def _parse_ckey_pages(d,ckey_len,ekey_len,ckey_pagesize,ckey_pagecount,whole_key):
-    a=d.tell()
-    headerlen=0x20*ckey_pagecount
-    # d.seek(0x20*ckey_pagecount,1) # read the index table
+def _parse_ckey_pages(r,ckey_len,ekey_len,ckey_pagesize,ckey_pagecount,whole_key,sizes=None):
+    a=r.tell()+0x20*ckey_pagecount # skip the index table
+    ekey_readlen = ekey_len if whole_key else 9
+    # ekey count, 40 bit content size (as 8+32 bits), ckey, first ekey
+    entry = struct.Struct(f">BBI{ckey_len}s{ekey_readlen}s{ekey_len-ekey_readlen}x")
     ckey_map = {}
     for i in range(ckey_pagecount):
-        d.seek(headerlen + i * ckey_pagesize+a)
-        while True:
-            ekcount = struct.unpack("H",d.read(2))[0]
-            if ekcount==0:
-                break
-            d.seek(4,1)
-            # cfsize, = struct.unpack(">i",d.read(4))
-            ckey = int.from_bytes(d.read(ckey_len),byteorder='big')
-            # assert ekcount == len(ekeys)
-            if whole_key:
-                ckey_map[ckey]=int.from_bytes(d.read(ekey_len),byteorder='big')
+        pos = a + i * ckey_pagesize
+        end = pos + ckey_pagesize
+        # almost every ckey has one ekey, so runs of entries are unpacked as fixed size records
+        while pos + entry.size <= end:
+            r.seek(pos)
+            for ekcount,size_hi,size_lo,ckey,ekey in r.iter_unpack(entry,(end-pos)//entry.size):
+                if ekcount==0:
+                    pos = end
+                    break
+                ckey = int.from_bytes(ckey,'big')
+                if sizes is not None:
+                    sizes[ckey] = size_hi<<32 | size_lo
+                ckey_map[ckey]=int.from_bytes(ekey,'big')
+                pos += entry.size + ekey_len*(ekcount-1)
+                if ekcount > 1: # the next entry starts after this one's other ekeys, start a new run there
+                    break
             else:
-                ckey_map[ckey]=int.from_bytes(d.read(ekey_len)[:9],byteorder='big')
-            # [byteskey_to_hex(d.read(ekey_len)) for x in range(ekcount)][0]
-            d.seek(ekey_len*(ekcount-1),1)
+                break
     return ckey_map
 
-class INTag:
-    name:str
-    tagtype:int
-    flags:List[int]
+_BIT_REVERSED = bytes(int(f"{x:08b}"[::-1],2) for x in range(256))
+_BYTE_BITS = [tuple(z for z in range(8) if x>>z&1) for x in range(256)]
+
+def _r_tag_bitmap(mask):
+    """ A tag's file mask (first file in the high bit of the first byte) as an int with file i at bit i """
+    return int.from_bytes(bytes(mask).translate(_BIT_REVERSED),'little')
+
+def bitmap_indices(bitmap, count):
+    """ The positions of the set bits of bitmap, in order """
+    out = []
+    for y,b in enumerate(bitmap.to_bytes((count+7)//8,'little')):
+        if b:
+            out.extend(y*8+z for z in _BYTE_BITS[b])
+    return out
+
+class TagIndex:
+    """ The tags of an install or download manifest, each kept as a bitmap (an int, file i at bit i) over the manifest's files.
+    Queries are bitwise ops over whole bitmaps, e.g. select("Windows","enUS","x86_64") for the files that have all three tags. """
+
+    def __init__(self, count):
+        self.count = count
+        self.tags = {} # name -> (tag type, bitmap)
+        self.tag_bytes = {} # name -> bitmap as bytes, for per file tests
+
+    def add(self, name, tagtype, bitmap):
+        self.tags[name] = (tagtype,bitmap)
+
+    def names(self, tagtype=None):
+        return [n for n,(t,_) in self.tags.items() if tagtype is None or t == tagtype]
+
+    def bitmap(self, *tags, exclude=()):
+        """ Bitmap of the files that have every one of tags and none of exclude """
+        bm = (1<<self.count)-1
+        for t in tags:
+            bm &= self.tags[t][1]
+        for t in exclude:
+            bm &= ~self.tags[t][1]
+        return bm
+
+    def select(self, *tags, exclude=()):
+        """ Indices of the files that have every one of tags and none of exclude """
+        return bitmap_indices(self.bitmap(*tags,exclude=exclude),self.count)
+
+    def tags_of(self, i):
+        """ Names of the tags file i has """
+        if len(self.tag_bytes) != len(self.tags):
+            self.tag_bytes = {n:bm.to_bytes((self.count+7)//8,'little') for n,(_,bm) in self.tags.items()}
+        return [n for n,b in self.tag_bytes.items() if b[i>>3]>>(i&7)&1]
+
+def _r_tags(r, tag_num, file_num):
+    """ Reads a manifest's tag table from a BufferReader. Returns a TagIndex. """
+    tags = TagIndex(file_num)
+    mask_len = (file_num + 7) // 8
+    for _ in range(tag_num):
+        name = r.cstr()
+        tagtype, = r.unpack(U16BE)
+        tags.add(name,tagtype,_r_tag_bitmap(r.take(mask_len)))
+    return tags
 
 class INEntry:
     name:str
     md5:int
     size:int
-    tags:List[INTag]
+    tags:List[str]
 
-def parse_install_file(fd):
-    f = BytesIO(fd)
+class InstallManifest:
+    """ The install manifest, as columns: file i is names[i], with the ckey ckeys[i*16:i*16+16] and size sizes[i].
+    tags is its TagIndex. Iterating yields an INEntry per file. """
 
-    assert f.read(2) == b"IN"
-    b1,b2 = f.read(2)
+    def __init__(self, tags):
+        self.tags = tags
+        self.names = []
+        self.ckeys = bytearray()
+        self.sizes = array('I')
 
-    tag_num = int.from_bytes(f.read(2),byteorder="big")
-    file_num = int.from_bytes(f.read(4),byteorder="big")
-    mask_len = (file_num + 7) // 8
+    def __len__(self):
+        return len(self.names)
+
+    def ckey(self, i):
+        return int.from_bytes(self.ckeys[i*16:i*16+16],'big')
+
+    def select(self, *tags, exclude=()):
+        """ Indices of the files that have every one of tags and none of exclude """
+        return self.tags.select(*tags,exclude=exclude)
+
+    def __iter__(self):
+        for i in range(len(self.names)):
+            e = INEntry()
+            e.name = self.names[i]
+            e.md5 = self.ckey(i)
+            e.size = self.sizes[i]
+            e.tags = self.tags.tags_of(i)
+            yield e
 
-    tags = []
-    for x in range(tag_num):
-        t = INTag()
-        t.name = read_cstr(f)
-        t.tagtype = int.from_bytes(f.read(2),byteorder="little")
-        t.flags = []
-
-        for y in range(mask_len):
-            bd = f.read(1)[0]
-            bd = (((bd * 0x0202020202) & 0x010884422010) % 1023) 
-            for z in range(8):
-                if (bd & (2 ** z)) > 0:
-                    t.flags.append(y*8+z)
-        tags.append(t)
-
-    files = []
-    for x in range(file_num):
-        e = INEntry()
-        e.name = read_cstr(f)
-        e.md5 = var_int(f,16,False)
-        e.size = var_int(f,4,False)
-        e.tags = [t.name for t in tags if x in t.flags]
-        files.append(e)
-
-    return files
+_install_header = struct.Struct(">2sBBHI")
+
+def parse_install_file(fd):
+    """ Parses the install manifest into an InstallManifest """
+    r = BufferReader(fd)
+    magic,version,hash_size,tag_num,file_num = r.unpack(_install_header)
+    assert magic == b"IN"
+    tags = _r_tags(r,tag_num,file_num)
+
+    im = InstallManifest(tags)
+    entry = struct.Struct(f">{hash_size}sI")
+    for _ in range(file_num):
+        im.names.append(r.cstr())
+        ckey,size = r.unpack(entry)
+        im.ckeys += ckey.rjust(16,b'\0')
+        im.sizes.append(size)
+    return im
 
 class DLEntry:
     key:bytes
     index:int
     tags:List[str]
 
-def parse_download_file(fd):
-    f = BytesIO(fd)
+class DownloadManifest:
+    """ The download manifest, as columns: file i has the ekey ekeys[i*ekey_size:(i+1)*ekey_size], 
+    the encoded size sizes[i], and the download priority priorities[i] (lower is needed sooner).
+    tags is its TagIndex. Iterating yields a DLEntry per file. """
 
-    assert f.read(2) == b"DL"
-    b1,b2,b3 = f.read(3)
+    def __init__(self, ekey_size, tags):
+        self.ekey_size = ekey_size
+        self.tags = tags
+        self.ekeys = b''
+        self.sizes = array('Q')
+        self.priorities = array('h')
 
-    file_num = int.from_bytes(f.read(4),byteorder="big")
-    tag_num = int.from_bytes(f.read(2),byteorder="big")
+    def __len__(self):
+        return len(self.sizes)
 
-    mask_len = (file_num + 7) // 8
+    def ekey(self, i):
+        return self.ekeys[i*self.ekey_size:(i+1)*self.ekey_size]
 
-    dl_entries = []
+    def select(self, *tags, exclude=()):
+        """ Indices of the files that have every one of tags and none of exclude """
+        return self.tags.select(*tags,exclude=exclude)
 
-    for x in range(file_num):
-        ck = f.read(16) # hash
-        f.seek(0xA,1) # unk
+    def __iter__(self):
+        for i in range(len(self)):
+            dle = DLEntry()
+            dle.key = self.ekey(i)
+            dle.index = i
+            dle.tags = self.tags.tags_of(i)
+            yield dle
 
-        dle = DLEntry()
-        dle.key = ck
-        dle.index = x
-        dle.tags = []
-        dl_entries.append(dle)
+_download_header = struct.Struct(">2sBBBIH")
+_base_priority = struct.Struct(">b3x") # and 3 unknown bytes
 
-    f.read(5) # idfk.
+def parse_download_file(fd):
+    """ Parses the download manifest into a DownloadManifest """
+    r = BufferReader(fd)
+    magic,version,ekey_size,has_checksum,file_num,tag_num = r.unpack(_download_header)
+    assert magic == b"DL"
+    flag_size,base_priority = 0,0
+    if version >= 2:
+        flag_size = r.u8()
+    if version >= 3:
+        base_priority, = r.unpack(_base_priority)
+
+    entry_size = ekey_size+5+1+(4 if has_checksum else 0)+flag_size
+    # the entries are fixed size records, each column is cut out of all of them at once
+    entries = r.take(entry_size*file_num).tobytes()
+    sizes = struct.Struct(f">{ekey_size}xBI{entry_size-ekey_size-5}x") # 40 bit size, as 8+32 bits
+
+    tags = _r_tags(r,tag_num,file_num)
+    dm = DownloadManifest(ekey_size,tags)
+    dm.ekeys = b''.join([entries[i:i+ekey_size] for i in range(0,len(entries),entry_size)])
+    dm.sizes = array('Q',[h<<32|l for h,l in sizes.iter_unpack(entries)])
+    dm.priorities = array('h',(p-base_priority for p in array('b',entries[ekey_size+5::entry_size])))
+    return dm
+
+class SizeManifest:
+    """ The size manifest, as columns: file i has the (partial) ekey ekeys[i*ekey_size:(i+1)*ekey_size] and the encoded size sizes[i].
+    tags is its TagIndex, total_size the sum the manifest states for the whole build. """
+
+    def __init__(self, ekey_size, tags):
+        self.ekey_size = ekey_size
+        self.tags = tags
+        self.total_size = 0
+        self.ekeys = b''
+        self.sizes = array('Q')
+        self.by_ekey = None
+        self.key_len = ekey_size
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def ekey(self, i):
+        return self.ekeys[i*self.ekey_size:(i+1)*self.ekey_size]
+
+    def size_of(self, ekey):
+        """ The encoded size of the file with ekey (bytes), or None. An ekey shorter than ekey_size is matched on its length. """
+        n = min(len(ekey),self.ekey_size)
+        if self.by_ekey is None or self.key_len != n:
+            self.by_ekey = {self.ekey(i)[:n]:s for i,s in enumerate(self.sizes)}
+            self.key_len = n
+        return self.by_ekey.get(bytes(ekey[:n]))
+
+_size_header = struct.Struct(">2sBBIH")
+_size_v1_totals = struct.Struct(">QB") # total size, esize bytes
+
+def parse_size_file(fd):
+    """ Parses the size manifest into a SizeManifest """
+    r = BufferReader(fd)
+    magic,version,ekey_size,file_num,tag_num = r.unpack(_size_header)
+    assert magic == b"DS"
+    if version == 1:
+        total_size,esize_bytes = r.unpack(_size_v1_totals)
+    else:
+        total_size,esize_bytes = r.uint(5,big=True),4
+    tags = _r_tags(r,tag_num,file_num)
 
-    for x in range(tag_num):
-        tagname = read_cstr(f)
-        tagtype = int.from_bytes(f.read(2),byteorder="little")
+    entry_size = ekey_size+esize_bytes
+    entries = r.take(entry_size*file_num).tobytes() # cut into columns, as in parse_download_file
 
-        for y in range(mask_len):
-            bd = f.read(1)[0]
-            bd = (((bd * 0x0202020202) & 0x010884422010) % 1023) 
-            for z in range(8):
-                # print(f"[{tagname}] {bd:b} & {2**z:b}? ({y*8+z})")
-                if y*8+z < len(dl_entries) and (bd & (2 ** z)) > 0:
-                    dl_entries[y*8+z-1].tags.append(tagname)
-    
-    return dl_entries
+    sm = SizeManifest(ekey_size,tags)
+    sm.total_size = total_size
+    sm.ekeys = b''.join([entries[i:i+ekey_size] for i in range(0,len(entries),entry_size)])
+    if esize_bytes == 4:
+        sm.sizes = array('Q',[x for x, in struct.iter_unpack(f">{ekey_size}xI",entries)])
+    else:
+        sm.sizes = array('Q',[int.from_bytes(entries[i:i+esize_bytes],'big') for i in range(ekey_size,len(entries),entry_size)])
+    return sm
 
 def _r_casc_dataheader(f):
     blth,sz,f_0,f_1,chkA,chkB=struct.unpack("16sI2b4s4s",f.read(30))
     return blth,sz,f_0,f_1,chkA,chkB
 
-def _r_casc_blteheader(f):
-    assert f.read(4) == b"BLTE"
-    sz, = struct.unpack("I",f.read(4))
-    if sz == 0: # single chunk. 
+_blte_magic = struct.Struct("<4sI") # BLTE, header size
+_blte_table = struct.Struct(">B3s") # flags, chunk count
+_blte_chunk = struct.Struct(">II16s") # compressedSize,decomressedSize,16byte checksum
+
+def _unpack_blteheader(r):
+    """ Reads a blte header from a BufferReader, leaving it at the first chunk """
+    magic,sz = r.unpack(_blte_magic)
+    assert magic == b"BLTE"
+    if sz == 0: # single chunk.
         return 0,0,1,[(-1,-1,b'')]
-    
-    flg,cc=struct.unpack("B3s",f.read(4))
-    cc=int.from_bytes(cc,'big',signed=False)
 
-    chunks=[]
-    for _ in range(cc):
-        chunks.append(struct.unpack(">II16s",f.read(24)))
-        #compressedSize,decomressedSize,16byte checksum
-    return sz,flg,cc,chunks
+    flg,cc=r.unpack(_blte_table)
+    cc=int.from_bytes(cc,'big',signed=False)
+    return sz,flg,cc,list(r.iter_unpack(_blte_chunk,cc))
 
-def _r_casc_bltechunk(f,ci):
-    etype=f.read(1)
+def _r_casc_blteheader(f):
+    """ Same as _unpack_blteheader, but reads from a file object (only the header's bytes) """
+    head = f.read(8)
+    if head[4:8] != bytes(4): # not single chunk, so a chunk table follows
+        head += f.read(4)
+        head += f.read(_blte_chunk.size*int.from_bytes(head[9:12],'big'))
+    return _unpack_blteheader(BufferReader(head))
+
+def read_blteheader(read):
+    """ Reads just a blte header through read(start, size), which returns that range of the blte data (an http range, say).
+    Two reads at most: the 8 byte preamble, then the rest of the header, whose size the preamble gives. """
+    head = bytes(read(0,8))
+    size = int.from_bytes(head[4:8],'big')
+    if size: # not single chunk, so a chunk table follows
+        head += bytes(read(8,size-8))
+    return _unpack_blteheader(BufferReader(head))
+
+def _r_casc_bltechunk(cd,ci):
+    """ Decodes a single chunk, cd is a buffer holding the chunk (starting at its encoding byte) """
+    etype=cd[:1]
     if etype==b"N": #plain data
-        return f.read(ci[1] if ci[1]>0 else -1)
+        return cd[1:1+ci[1]] if ci[1]>0 else cd[1:]
     elif etype==b"Z":
         import zlib
-        return zlib.decompress(f.read(ci[0]-1 if ci[1]>0 else -1))
+        return zlib.decompress(cd[1:])
     elif etype==b"E":
-        keyname_len = var_int(f,1)
-        keyname = f.read(keyname_len)
-        iv_len = var_int(f,1)
-        iv = f.read(iv_len)
-        ktype = f.read(1)
-        data = f.read(ci[0]-1-keyname_len-1-iv_len-1-1)
+        keyname_len = cd[1]
+        keyname = bytes(cd[2:2+keyname_len])
+        p = 2+keyname_len
+        iv_len = cd[p]
+        iv = bytes(cd[p+1:p+1+iv_len])
+        ktype = cd[p+1+iv_len:p+2+iv_len]
+        data = bytes(cd[p+2+iv_len:])
 
         retdata = b''
         if keyname in TACT_KEYS:
@@ -186,32 +350,94 @@ def _r_casc_bltechunk(f,ci):
     else:
         raise Exception(f"Fuck you {etype} encoding")
 
+def _r_blteheader(df):
+    """ Reads a blte header from a file object or a buffer, returns (header, stream left at the first chunk) """
+    if hasattr(df,"read") and not isinstance(df,BufferReader):
+        return _r_casc_blteheader(df),df
+    if not isinstance(df,BufferReader):
+        df=BufferReader(df)
+    return _unpack_blteheader(df),df
+
 def parse_blte(df,read_data=True,max_size=-1):
-    if isinstance(df,bytes):
-        df=BytesIO(df)
-    blte_header=_r_casc_blteheader(df)
-    blte_data,ds = BytesIO(),0
+    """ Parses a BLTE stream from either a file object or a buffer (bytes / memoryview). 
+    Buffers are decoded in place, without being copied into an intermediary stream first. """
+    blte_header,df = _r_blteheader(df)
+    blte_data,ds = [],0
     if read_data:
-        for c in blte_header[3]: # for each chunk
-            chunk_data = _r_casc_bltechunk(df,c)
-            blte_data.write(chunk_data)
+        for c,data in iter_blte_chunks(df,blte_header): # for each chunk
+            blte_data.append(data)
             ds += c[1]
             if max_size>0 and ds>max_size:
                 break
-    return blte_header, blte_data.getvalue()
-
-def cascfile_size(data_path,data_index,offset):
-    size=0
-    chunkcount=0
+    return blte_header, b''.join(blte_data)
+
+def iter_blte(df,start_chunk=0):
+    """ Decodes a BLTE stream (file object or buffer) a chunk at a time, yielding (chunk info, data), so a file is never in memory whole.
+    The first start_chunk chunks are skipped without being decoded, to resume a partly written file. """
+    blte_header,df = _r_blteheader(df)
+    yield from iter_blte_chunks(df,blte_header,start_chunk)
+
+def iter_blte_chunks(df,blte_header,start_chunk=0):
+    """ iter_blte, for a file object or BufferReader already past blte_header """
+    is_file = not isinstance(df,BufferReader)
+    for i,c in enumerate(blte_header[3]):
+        if i < start_chunk:
+            if is_file:
+                df.seek(c[0],1)
+            else:
+                df.skip(c[0])
+            continue
+        cd = df.read(c[0]) if is_file else df.take(c[0])
+        yield c,_r_casc_bltechunk(cd,c)
+
+def decode_blte_chunks(data,chunks):
+    """ Decodes consecutive chunks (entries of a blte header's chunk table) out of data, which holds just their encoded bytes """
+    r = BufferReader(data)
+    return [_r_casc_bltechunk(r.take(c[0]),c) for c in chunks]
+
+def blte_chunk_span(blte_header,offset,size):
+    """ Which chunks hold decoded bytes [offset, offset+size) of a multi chunk blte file: 
+    returns (chunks, where their encoded bytes start in the blte data, where their decoded bytes start in the file) """
+    enc,dec = _blte_magic.size+_blte_table.size+_blte_chunk.size*len(blte_header[3]),0 # chunk data starts right after the header
+    wanted,enc_start,dec_start = [],0,0
+    for c in blte_header[3]:
+        if dec+c[1] > offset and dec < offset+size:
+            if not wanted:
+                enc_start,dec_start = enc,dec
+            wanted.append(c)
+        elif wanted:
+            break
+        enc += c[0]
+        dec += c[1]
+    return wanted,enc_start,dec_start
+
+def cascfile_blteheader(data_path,data_index,offset):
+    """ Reads just the blte header of a given cascfile """
     with open(f"{data_path}data.{data_index:03d}","rb") as df:
         df.seek(offset+30) # fuck my ass
         # r_casc_dataheader(df)
-        blte_header,dbfr=parse_blte(df,False)
-        chunkcount=len(blte_header[3])
-        for c in blte_header[3]: # for each chunk
-            size+=c[1]
+        return _r_casc_blteheader(df)
+
+def cascfile_size(data_path,data_index,offset):
+    size=0
+    blte_header=cascfile_blteheader(data_path,data_index,offset)
+    chunkcount=len(blte_header[3])
+    for c in blte_header[3]: # for each chunk
+        size+=c[1]
     return size, chunkcount
 
+def iter_cascfile(data_path,data_index,offset,start_chunk=0):
+    """ iter_blte over a given cascfile, straight from its data file """
+    with open(f"{data_path}data.{data_index:03d}","rb") as df:
+        df.seek(offset+30)
+        yield from iter_blte(df,start_chunk)
+
+def r_cascfile_range(data_path,data_index,offset,start,size):
+    """ Reads size bytes of a given cascfile's blte data, starting start bytes into it """
+    with open(f"{data_path}data.{data_index:03d}","rb") as df:
+        df.seek(offset+30+start)
+        return df.read(size)
+
 def r_cascfile(data_path,data_index,offset,max_size=-1):
     """ Reads a given cascfile, reading as many chunks as needed to get *at least* max_size bytes."""
     # datafile = r_data(f"{data_path}data.{data_index:03d}")
@@ -230,11 +456,15 @@ def r_cascfile(data_path,data_index,offset,max_size=-1):
 #     return ''.join(itertools.takewhile('\0'.__ne__, toeof))
 
 def read_cstr(f):
-    s=b''
-    c=f.read(1)
-    while c != b'\0':
-        s+=c
+    """ Reads a null terminated string from a BufferReader, or a file object """
+    if isinstance(f,BufferReader):
+        s=f.cstr(None)
+    else:
+        s=bytearray()
         c=f.read(1)
+        while c and c != b'\0':
+            s+=c
+            c=f.read(1)
     try:
         return s.decode("utf-8")
     except UnicodeDecodeError:
@@ -247,13 +477,93 @@ NAMED_FILE=2
 WOW_HASHED_FILE=3
 WOW_DATAID_FILE=4
 
+def _ckey_bytes(ckey):
+    if isinstance(ckey,str):
+        return bytes.fromhex(ckey.zfill(32))
+    if isinstance(ckey,int):
+        return ckey.to_bytes(16,'big')
+    return bytes(ckey)
+
+class TranslateTable:
+    """ Which id (name, file data id, sno id...) each ckey is listed under, as parallel columns.
+    Row i is of kind kinds[i] (one of the *_FILE types), with the ckey ckeys[i*16:i*16+16] and the id ids[i]. 
+    Named rows' ids index the name blob, which holds each distinct name once: names[name_offsets[id]:name_offsets[id+1]]. 
+    Indexed sno ids are packed as snoid<<32|index. Iterating yields (kind, id, ckey as an int), with ids unpacked. """
+
+    def __init__(self):
+        self.kinds = array('B')
+        self.ids = array('Q')
+        self.ckeys = bytearray()
+        self.names = bytearray()
+        self.name_offsets = array('Q',[0])
+        self.name_ids = {}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def _name_id(self, name):
+        i = self.name_ids.get(name)
+        if i is None:
+            i = self.name_ids[name] = len(self.name_offsets)-1
+            self.names += name.encode("utf-8")
+            self.name_offsets.append(len(self.names))
+        return i
+
+    def name(self, name_id):
+        return self.names[self.name_offsets[name_id]:self.name_offsets[name_id+1]].decode("utf-8")
+
+    def _pack_id(self, kind, fid):
+        if kind == NAMED_FILE:
+            return self._name_id(fid)
+        if kind == SNO_INDEXED_FILE:
+            return fid[0]<<32 | fid[1]
+        return fid
+
+    def _unpack_id(self, kind, fid):
+        if kind == NAMED_FILE:
+            return self.name(fid)
+        if kind == SNO_INDEXED_FILE:
+            return fid>>32, fid&0xffffffff
+        return fid
+
+    def append(self, entry):
+        """ Adds a (kind, id, ckey) row, ckey being a hex string, bytes or an int """
+        kind,fid,ckey = entry[:3]
+        self.kinds.append(kind)
+        self.ids.append(self._pack_id(kind,fid))
+        self.ckeys += _ckey_bytes(ckey)
+
+    def extend(self, entries):
+        for e in entries:
+            self.append(e)
+
+    def add_ids(self, kind, ids, ckeys):
+        """ Adds rows of one numeric kind in bulk, ids being an iterable of ints and ckeys their concatenated 16 byte ckeys """
+        n = len(self.ids)
+        self.ids.fromlist(ids.tolist() if isinstance(ids,array) else list(ids))
+        self.kinds.extend(array('B',[kind])*(len(self.ids)-n))
+        self.ckeys += ckeys
+
+    def add_named(self, names, ckeys):
+        """ Adds NAMED_FILE rows in bulk, ckeys being the concatenated 16 byte ckeys of names """
+        self.add_ids(NAMED_FILE,map(self._name_id,names),ckeys)
+
+    def select(self, kind):
+        """ Returns a new table of this one's rows of kind """
+        t = TranslateTable()
+        t.extend(e for e in self if e[0] == kind)
+        return t
+
+    def __iter__(self):
+        unpack = self._unpack_id
+        for i,(kind,fid) in enumerate(zip(self.kinds,self.ids)):
+            yield kind,unpack(kind,fid),int.from_bytes(self.ckeys[i*16:i*16+16],'big')
+
 def parse_root_file(uid,fd,cascreader):
-    """Returns an array of format [TYPE, ID, CKEY, EXTRA...],
-    Type = one of NAMED_FILE, ID_FILE, ID_INDEXED_FILE
-    Id = depends on type. NAMED:"strname", ID:"id", ID_INDEXED:("id","index")
+    """Returns the root's TranslateTable, rows of (TYPE, ID, CKEY):
+    Type = one of NAMED_FILE, SNO_FILE, SNO_INDEXED_FILE, WOW_DATAID_FILE
+    Id = depends on type. NAMED:"strname", SNO/WOW_DATAID: id, SNO_INDEXED:(id,index)
     Ckey = that file's ckey
-    Extra = uid specific data 
-        d3: extra is the "directory" that the file is in
     """
     from PyCASC.rootfiles import parse_d3_root, parse_wow_root, parse_mndx_root, parse_warcraft3_root, parse_hearthstone_root, parse_ow_root
 
@@ -264,11 +574,12 @@ def parse_root_file(uid,fd,cascreader):
     elif uid in ['d3']:
         return parse_d3_root(fd,cascreader)
     elif uid in ['hero','s2']:
-        return parse_mndx_root(fd)
+        parse_mndx_root(fd,cascreader) # its names stay in the root, see CASCReader.iter_root_names
+        return TranslateTable()
     elif uid in ['pro']:
         return parse_ow_root(fd)
     elif uid in ['wow']:
-        return parse_wow_root(fd)
+        return parse_wow_root(fd,cascreader)
     else:
         with open(f"{uid}.rootfile","wb+") as f:
             f.write(fd)
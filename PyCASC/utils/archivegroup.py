@@ -0,0 +1,144 @@
+import os
+import mmap
+import struct
+import tempfile
+from array import array
+from collections import Counter
+from PyCASC import CACHE_DIRECTORY
+
+ARCHIVE_GROUP_MAGIC = b"PAGI"
+ARCHIVE_GROUP_VERSION = 1
+
+_header = struct.Struct("<4sIII") # magic, version, archive count, entry count
+_entry = struct.Struct(">16sHII") # ekey, archive id, offset, size. keys are big endian so entries sort the same as the bytes do.
+_entry_prefix = struct.Struct(">H24x") # just the first 2 bytes of an entry's ekey
+
+class InvalidArchiveGroup(Exception):
+    """ An archive group file that isn't one, of another version, or cut short """
+
+class ArchiveGroup:
+    """ A merged ekey -> (archive, offset, size) table over every archive index of a cdn config.
+    The table lives on disk sorted by ekey, and is memory-mapped and binary searched instead of being loaded.
+    Once enough lookups were made that it's a listing (every ckey of the build) rather than a few files being opened,
+    the start of each run of ekeys sharing their first 2 bytes is found in one pass over the table, and lookups only
+    binary search their run from then on. That's 256KB whatever the table's size. """
+    BUCKETS_AFTER = 4096 # lookups binary searched over the whole table before building the bucket starts
+
+    def __init__(self, path):
+        # checked with a plain read, so nothing is mapped yet if it's invalid (and it can be rebuilt right away, on windows too)
+        with open(path,"rb") as f:
+            head = f.read(_header.size)
+            size = os.fstat(f.fileno()).st_size
+            if len(head) < _header.size:
+                raise InvalidArchiveGroup(f"{path} is truncated")
+            magic,version,archive_count,self.entry_count = _header.unpack(head)
+            if magic != ARCHIVE_GROUP_MAGIC or version != ARCHIVE_GROUP_VERSION:
+                raise InvalidArchiveGroup(f"{path} is not a valid archive group")
+            self.entries_start = _header.size + archive_count*16
+            if size != self.entries_start + self.entry_count*_entry.size:
+                raise InvalidArchiveGroup(f"{path} is truncated")
+            self.map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+
+        p = _header.size
+        self.archives = [self.map[p+x*16:p+x*16+16].hex() for x in range(archive_count)]
+        self.buckets = None
+        self.searches = 0
+
+    def __len__(self):
+        return self.entry_count
+
+    def __contains__(self, ekey):
+        return self._find(ekey) >= 0
+
+    def _find(self, ekey):
+        """ Returns the position of ekey's entry, or -1 if it isn't in any archive """
+        buckets = self.buckets
+        if buckets is None:
+            self.searches += 1
+            if self.searches <= self.BUCKETS_AFTER:
+                return self._search(ekey,0,self.entry_count)
+            buckets = self._build_buckets()
+        b = ekey >> 112
+        return self._search(ekey,buckets[b],buckets[b+1])
+
+    def _build_buckets(self):
+        end = self.entries_start + self.entry_count*_entry.size
+        counts = Counter(k for k, in _entry_prefix.iter_unpack(memoryview(self.map)[self.entries_start:end]))
+        buckets = array('I',[0])
+        for b in range(0x10000):
+            buckets.append(buckets[-1]+counts.get(b,0))
+        self.buckets = buckets
+        return buckets
+
+    def _search(self, ekey, lo, hi):
+        """ Binary searches entries [lo, hi) of the table for ekey's entry """
+        k = ekey.to_bytes(16,'big')
+        m, start, esz = self.map, self.entries_start, _entry.size
+        while lo < hi:
+            mid = (lo+hi)//2
+            p = start + mid*esz
+            mk = m[p:p+16]
+            if mk < k:
+                lo = mid+1
+            elif mk > k:
+                hi = mid
+            else:
+                return p
+        return -1
+
+    def lookup(self, ekey):
+        """ Returns (archive hash, offset, size) for an ekey, or None """
+        p = self._find(ekey)
+        if p < 0:
+            return None
+        _,aid,offset,size = _entry.unpack_from(self.map,p)
+        return self.archives[aid],offset,size
+
+    @staticmethod
+    def build(path, archives, indexes):
+        """ Writes a new archive group to path.
+        archives is the cdn config's archive list, indexes yields (archive hash, {ekey:FileInfo}) for each parsed archive index.
+        When an ekey appears in more than one archive, the first archive listed wins. """
+        archive_ids = {a:i for i,a in enumerate(archives)}
+        seen = {}
+        for a,ents in indexes:
+            aid = archive_ids[a]
+            for ek in ents:
+                if ek in seen:
+                    continue
+                e = ents[ek]
+                seen[ek] = (aid,e.offset,e.compressed_size)
+
+        tfd,tmp_path = tempfile.mkstemp(suffix=".tmp",dir=os.path.dirname(path))
+        try:
+            with open(tfd,"wb") as f:
+                f.write(_header.pack(ARCHIVE_GROUP_MAGIC,ARCHIVE_GROUP_VERSION,len(archives),len(seen)))
+                f.write(b"".join(bytes.fromhex(a) for a in archives))
+                f.write(b"".join(_entry.pack(ek.to_bytes(16,'big'),*seen[ek]) for ek in sorted(seen)))
+            os.replace(tmp_path,path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+def load_archive_group(cdn_config_hash, archives, get_index, cache_dir=CACHE_DIRECTORY):
+    """ Opens the archive group for a cdn config, building it (fetching each archive's index with get_index) if it isn't cached yet. """
+    path = os.path.join(cache_dir,f"{cdn_config_hash}.archive-group")
+    if os.path.exists(path):
+        try:
+            return ArchiveGroup(path)
+        except InvalidArchiveGroup as e: # a torn write or an older version, it's only a cache
+            print(f"[AGRP] {e}, rebuilding it")
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir,exist_ok=True)
+
+    from PyCASC import r_cidx
+    def parsed_indexes():
+        for a in archives:
+            try:
+                yield a,r_cidx(get_index(a))
+            except AssertionError as e:
+                print("archive index file " + a + " did not match assertions, ignoring this for now since it only causes minor issues.")
+
+    ArchiveGroup.build(path,archives,parsed_indexes())
+    return ArchiveGroup(path)
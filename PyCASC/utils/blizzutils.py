@@ -3,6 +3,9 @@ import requests
 import os
 import hashlib
 import pickle
+import mmap
+import tempfile
+import threading
 from io import BytesIO
 from time import time
 from PyCASC import CACHE_DIRECTORY, CACHE_DURATION
@@ -150,8 +153,16 @@ def hashlittle2_my(key:bytes):
 def prefix_hash(s):
     return f"{s[:2]}/{s[2:4]}/{s}"
 
+def _cache_file(url):
+    return os.path.join(CACHE_DIRECTORY,f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.cache")
+
+def _map_cache_file(cache_file):
+    """ Memory-maps a cache file and returns a read-only memoryview over its payload (everything after the 4 byte timestamp) """
+    with open(cache_file,"rb") as f:
+        return memoryview(mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ))[4:]
+
 def have_cached(url,cache_dur=CACHE_DURATION):
-    cache_file = os.path.join(CACHE_DIRECTORY,f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.cache")
+    cache_file = _cache_file(url)
     if os.path.exists(cache_file):
         with open(cache_file,"rb") as f:
             ctime = int.from_bytes(f.read(4),byteorder="little")
@@ -159,55 +170,183 @@ def have_cached(url,cache_dur=CACHE_DURATION):
     else:
         return False
 
-def get_cached(url,cache=True,cache_dur=CACHE_DURATION,max_size=-1,offset=0,size=-1):
-    cache_file = os.path.join(CACHE_DIRECTORY,f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.cache")
-    # print(cache_file)
-    d = None
-
-    if os.path.exists(cache_file):
-        with open(cache_file,"rb",buffering=0) as f:
-            ctime = int.from_bytes(f.read(4),byteorder="little")
-            if ctime<time()+cache_dur or cache_dur == -1:
-                f.seek(offset,1)
-                d = f.read(size)
-
-    if d is None:
-        buf=BytesIO()
-        headers={}
-        if not os.path.exists(CACHE_DIRECTORY):
-            os.makedirs(CACHE_DIRECTORY)
-        with open(cache_file,"wb+") as f:
-            f.write(int(time()).to_bytes(4,byteorder="little"))
-            with requests.get(url, headers=headers, stream=True) as r:
-                r.raise_for_status()
-                for x in r.iter_content(512):
-                    buf.write(x)
-                    f.write(x)
-        buf.seek(offset)
-        d = buf.read(size)
-
+try:
+    import fcntl
+    def _lock_fd(fd):
+        fcntl.flock(fd,fcntl.LOCK_EX)
+    def _unlock_fd(fd):
+        fcntl.flock(fd,fcntl.LOCK_UN)
+except ImportError: # windows
+    import msvcrt
+    def _lock_fd(fd):
+        while True:
+            try:
+                msvcrt.locking(fd,msvcrt.LK_LOCK,1)
+                return
+            except OSError: # LK_LOCK gives up after 10 seconds, keep waiting on the other process.
+                pass
+    def _unlock_fd(fd):
+        msvcrt.locking(fd,msvcrt.LK_UNLCK,1)
+
+CACHE_STATS = {"fetches":0,"range_fetches":0,"coalesced":0,"coalesced_cross_process":0}
+_inflight = {} # url -> lock held by the thread currently downloading that url
+_inflight_lock = threading.Lock()
+
+def _acquire_lock_file(lock_file):
+    """ Opens and locks lock_file. Its holder deletes it when done, so a waiter may end up locking a file that's no longer
+    on disk, in which case it starts over on the current one. """
+    while True:
+        lf = open(lock_file,"a+b")
+        _lock_fd(lf.fileno())
+        try:
+            if os.path.samestat(os.fstat(lf.fileno()),os.stat(lock_file)):
+                return lf
+        except FileNotFoundError:
+            pass
+        _unlock_fd(lf.fileno())
+        lf.close()
+
+def _release_lock_file(lf,lock_file):
+    """ Deletes and unlocks a lock file from _acquire_lock_file, so the cache doesn't keep one per url ever fetched """
+    try:
+        os.remove(lock_file) # while still holding it, so whoever gets it next sees it's stale
+    except OSError: # windows won't delete a file another process has open, the last one out deletes it
+        pass
+    _unlock_fd(lf.fileno())
+    lf.close()
+
+def get_cache_stats():
+    """ Returns a copy of the cache counters. 
+    fetches is the number of downloads made (range_fetches the ranged ones), coalesced/coalesced_cross_process count the duplicate downloads that were 
+    avoided by waiting on a download already running in this process or another one. """
+    with _inflight_lock:
+        return dict(CACHE_STATS)
+
+def _download_cached(url,cache_file,cache_dur):
+    """ Downloads url into cache_file, unless a download of it is already running, in which case wait for that instead.
+    Concurrent callers in this process wait on the in-flight download, other processes wait on a lock file next to the cache file. """
+    while True:
+        with _inflight_lock:
+            lock = _inflight.get(url)
+            leader = lock is None
+            if leader:
+                lock = _inflight[url] = threading.Lock()
+                lock.acquire()
+
+        if not leader:
+            with lock:
+                pass
+            if have_cached(url,cache_dur):
+                with _inflight_lock:
+                    CACHE_STATS["coalesced"]+=1
+                return
+            continue # the download we waited on failed, try it ourselves.
+
+        try:
+            lock_file = cache_file+".lock"
+            lf = _acquire_lock_file(lock_file)
+            try:
+                if have_cached(url,cache_dur): # another process fetched it while we waited on the lock.
+                    with _inflight_lock:
+                        CACHE_STATS["coalesced_cross_process"]+=1
+                    return
+                _fetch_to_cache(url,cache_file)
+                with _inflight_lock:
+                    CACHE_STATS["fetches"]+=1
+                return
+            finally:
+                _release_lock_file(lf,lock_file)
+        finally:
+            with _inflight_lock:
+                del _inflight[url]
+            lock.release()
+
+def _write_cache_file(cache_file,chunks):
+    # write next to the cache file and move it into place once complete, so readers never map a partial file.
+    tfd,tmp_file = tempfile.mkstemp(suffix=".tmp",dir=CACHE_DIRECTORY)
     try:
-        return d.decode("utf-8")
+        with open(tfd,"wb") as f:
+            f.write(int(time()).to_bytes(4,byteorder="little"))
+            for x in chunks:
+                f.write(x)
+        try:
+            os.replace(tmp_file,cache_file)
+        except PermissionError:
+            # windows can't replace a file another reader has mapped. cdn files never change under the same url,
+            # so keep serving the mapped one, and leave the refresh to a later fetch.
+            if not os.path.exists(cache_file):
+                raise
+            os.unlink(tmp_file)
     except:
-        return d
+        os.unlink(tmp_file)
+        raise
+
+def _fetch_to_cache(url,cache_file):
+    headers={}
+    with requests.get(url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+        _write_cache_file(cache_file,r.iter_content(64*1024))
+
+def put_cached(url,data):
+    """ Stores data in the cache as the contents of url """
+    if not os.path.exists(CACHE_DIRECTORY):
+        os.makedirs(CACHE_DIRECTORY,exist_ok=True)
+    _write_cache_file(_cache_file(url),[data])
+
+def get_range_url(url,offset,size):
+    """ The cache key a byte range of url is stored under, when only that range was downloaded """
+    return f"{url}#{offset}+{size}"
+
+def fetch_range(url,offset,size):
+    """ Downloads bytes [offset, offset+size) of url with a single ranged request. Nothing is cached. """
+    with requests.get(url, headers={"Range":f"bytes={offset}-{offset+size-1}"}) as r:
+        r.raise_for_status()
+        with _inflight_lock:
+            CACHE_STATS["range_fetches"]+=1
+        if r.status_code != 206: # server ignored the range and sent everything.
+            return r.content[offset:offset+size]
+        return r.content
+
+def get_cached(url,cache=True,cache_dur=CACHE_DURATION,max_size=-1,offset=0,size=-1,enc=None):
+    """ Returns the contents of url, downloading it into the cache first if needed.
+    The result is a read-only memoryview over the memory-mapped cache file (sliced by offset and size), 
+    nothing is copied or decoded unless enc is given, in which case the slice is decoded to a str. 
+    Concurrent misses on the same url (including ranges of the same archive) share a single download. """
+    cache_file = _cache_file(url)
+
+    if size >= 0 and not have_cached(url,cache_dur):
+        # only this range may have been fetched (see fetch_range), without the rest of the file.
+        range_url = get_range_url(url,offset,size)
+        if have_cached(range_url,cache_dur):
+            d = _map_cache_file(_cache_file(range_url))
+            return d if enc is None else str(d,enc)
+
+    if not have_cached(url,cache_dur):
+        if not os.path.exists(CACHE_DIRECTORY):
+            os.makedirs(CACHE_DIRECTORY,exist_ok=True)
+        _download_cached(url,cache_file,cache_dur)
+    d = _map_cache_file(cache_file)
+
+    d = d[offset:] if size < 0 else d[offset:offset+size]
+    return d if enc is None else str(d,enc)
 
 # I don't really want to use this, since splitting it into different handlers allows easier 
 #  parsing of each subgroup (since the subgroups are quite similar)
 def get_cdn_url(cdn_url,cdn_path,file_type,file_hash,index=False):
     return f"http://{cdn_url}/{cdn_path}/{file_type}/{file_hash[:2]}/{file_hash[2:4]}/{file_hash}"+(".index" if index else "")
 
-def _get_cdn_file(cdn_url,cdn_path,file_type,file_hash,cache=True,cache_dur=CACHE_DURATION,max_size=-1,index=False,offset=0,size=-1):
+def _get_cdn_file(cdn_url,cdn_path,file_type,file_hash,cache=True,cache_dur=CACHE_DURATION,max_size=-1,index=False,offset=0,size=-1,enc=None):
     """ Get a specified file from a CDN for a product."""
     if not file_type in ['data','config','patch']:
         raise Exception(f"Invalid file type {file_type}")
     u=get_cdn_url(cdn_url,cdn_path,file_type,file_hash,index=index)
-    return get_cached(u,cache=cache,cache_dur=cache_dur,max_size=max_size,offset=offset,size=size)
+    return get_cached(u,cache=cache,cache_dur=cache_dur,max_size=max_size,offset=offset,size=size,enc=enc)
 
-def get_cdn_data(cdn_url,cdn_path,file_hash,cache=True,cache_dur=CACHE_DURATION,max_size=-1,index=False, offset=0, size=-1):
-    """ Gets a specified data file from the specified cdn """
-    return _get_cdn_file(cdn_url,cdn_path,'data',file_hash,cache,cache_dur,max_size=max_size,index=index, offset=offset, size=size)
+def get_cdn_data(cdn_url,cdn_path,file_hash,cache=True,cache_dur=CACHE_DURATION,max_size=-1,index=False, offset=0, size=-1, enc=None):
+    """ Gets a specified data file from the specified cdn, as a memoryview unless enc is given """
+    return _get_cdn_file(cdn_url,cdn_path,'data',file_hash,cache,cache_dur,max_size=max_size,index=index, offset=offset, size=size, enc=enc)
 
-def get_cdn_config(cdn_url,cdn_path,file_hash,parse=True,cache=True,cache_dur=CACHE_DURATION,max_size=-1,index=False):
+def get_cdn_config(cdn_url,cdn_path,file_hash,parse=True,cache=True,cache_dur=CACHE_DURATION,max_size=-1,index=False,enc="utf-8"):
     """ Gets specified config from the specified cdn """
-    f = _get_cdn_file(cdn_url,cdn_path,'config',file_hash,cache,cache_dur,max_size=max_size,index=index)
+    f = _get_cdn_file(cdn_url,cdn_path,'config',file_hash,cache,cache_dur,max_size=max_size,index=index,enc=enc)
     return parse_config(f) if parse else f
\ No newline at end of file
@@ -0,0 +1,107 @@
+import struct
+
+U8 = struct.Struct("<B")
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+U64 = struct.Struct("<Q")
+U16BE = struct.Struct(">H")
+U32BE = struct.Struct(">I")
+U64BE = struct.Struct(">Q")
+
+CSTR_WINDOW = 256 # bytes searched at a time for the end of a string in a memoryview
+
+class BufferReader:
+    """ A cursor over a buffer (bytes, bytearray, mmap, or a memoryview over the cache), which every binary parser reads through.
+    Fixed fields are read with precompiled structs (unpack_from at the cursor, nothing is copied), variable width ints with
+    int.from_bytes over a slice of the view, and C strings by finding their terminator instead of reading a byte at a time. """
+    __slots__ = ("data","view","pos")
+
+    def __init__(self, buf, pos=0):
+        self.view = memoryview(buf)
+        # cstr searches a buffer with .find (bytes, bytearray, mmap). memoryviews have none, they're searched in small windows instead.
+        self.data = buf if hasattr(buf,"find") and not isinstance(buf,memoryview) else None
+        self.pos = pos
+
+    def __len__(self):
+        return len(self.view)
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def skip(self, n):
+        self.pos += n
+
+    def remaining(self):
+        return len(self.view) - self.pos
+
+    def unpack(self, st):
+        """ Reads the fields of a precompiled struct.Struct """
+        v = st.unpack_from(self.view,self.pos)
+        self.pos += st.size
+        return v
+
+    def iter_unpack(self, st, count):
+        """ Reads count consecutive records of a precompiled struct.Struct """
+        start = self.pos
+        self.pos += st.size*count
+        return st.iter_unpack(self.view[start:self.pos])
+
+    def u8(self):
+        self.pos += 1
+        return self.view[self.pos-1]
+
+    def u16(self):
+        return self.unpack(U16)[0]
+
+    def u32(self):
+        return self.unpack(U32)[0]
+
+    def u64(self):
+        return self.unpack(U64)[0]
+
+    def u16be(self):
+        return self.unpack(U16BE)[0]
+
+    def u32be(self):
+        return self.unpack(U32BE)[0]
+
+    def u64be(self):
+        return self.unpack(U64BE)[0]
+
+    def uint(self, n, big=False):
+        """ Reads an n byte unsigned int, for the odd widths (40 bit sizes, 9 byte ekeys) structs don't cover """
+        self.pos += n
+        return int.from_bytes(self.view[self.pos-n:self.pos],'big' if big else 'little')
+
+    def read(self, n=-1):
+        """ Reads n bytes (the rest of the buffer if n is negative) as bytes """
+        return self.take(n).tobytes()
+
+    def take(self, n=-1):
+        """ Like read, but returns a memoryview into the buffer instead of a copy """
+        start = self.pos
+        self.pos = len(self.view) if n < 0 else self.pos+n
+        return self.view[start:self.pos]
+
+    def cstr(self, encoding="utf-8"):
+        """ Reads a nul terminated string, and the nul. Returns bytes if encoding is None. """
+        end = self.data.find(b'\0',self.pos) if self.data is not None else self._find_nul()
+        if end < 0:
+            raise ValueError(f"Unterminated string at {self.pos}")
+        s = self.view[self.pos:end]
+        self.pos = end+1
+        return s.tobytes() if encoding is None else str(s,encoding)
+
+    def _find_nul(self):
+        """ The position of the next nul, copying only growing windows of the view after the cursor, never all of it """
+        p,n = self.pos,CSTR_WINDOW
+        while p < len(self.view):
+            i = bytes(self.view[p:p+n]).find(b'\0')
+            if i >= 0:
+                return p+i
+            p += n
+            n *= 2
+        return -1
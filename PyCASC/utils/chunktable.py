@@ -0,0 +1,147 @@
+import os
+import struct
+import tempfile
+import threading
+from PyCASC import CACHE_DIRECTORY
+
+CHUNK_TABLE_MAGIC = b"PBCT"
+CHUNK_TABLE_VERSION = 1
+
+_header = struct.Struct("<4sI") # magic, version
+_record = struct.Struct("<9sIBI") # first 9 bytes of the ekey, blte header size, flags, chunk count
+_chunk = struct.Struct(">II16s") # compressed size, decompressed size, checksum. as in the blte header itself
+
+class InvalidChunkTableCache(Exception):
+    """ A chunk table side file that isn't one, or not of this version """
+
+def _check_header(path, data):
+    if len(data) < _header.size:
+        raise InvalidChunkTableCache(f"{path} is truncated")
+    magic,version = _header.unpack_from(data,0)
+    if magic != CHUNK_TABLE_MAGIC or version != CHUNK_TABLE_VERSION:
+        raise InvalidChunkTableCache(f"{path} is not a valid chunk table cache")
+
+class ChunkTableCache:
+    """ The BLTE chunk tables of every file read so far, kept in an append-only side file keyed by ekey.
+    A file's sizes, chunk count and chunk layout (for seeking, or verifying chunk checksums) then come from here instead
+    of its BLTE header, across process restarts too. The file is only read on the first lookup. """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = None
+        self.records = None # first 9 bytes of ekey -> position of its record in data
+
+    def _load(self):
+        data = b''
+        if os.path.exists(self.path):
+            with open(self.path,"rb") as f:
+                data = f.read()
+        records = {}
+        if data:
+            try:
+                _check_header(self.path,data)
+            except InvalidChunkTableCache as e: # it's only a cache, start over
+                print(f"[CTBL] {e}, rebuilding it")
+                self._discard()
+                data = b''
+        if data:
+            p = _header.size
+            while p + _record.size <= len(data):
+                ek,_,_,cc = _record.unpack_from(data,p)
+                end = p + _record.size + cc*_chunk.size
+                if end > len(data): # a torn write at the end, ignore it
+                    break
+                records[ek] = p
+                p = end
+        self.data,self.records = bytearray(data),records
+
+    def _discard(self):
+        """ Moves an invalid side file out of the way (deleting it if it can't be), so the next put starts a new one """
+        try:
+            os.replace(self.path,self.path+".invalid")
+        except OSError:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def _create(self):
+        """ Creates the side file with its header in one step, so processes creating it at once can't both write a header """
+        os.makedirs(os.path.dirname(self.path),exist_ok=True)
+        tfd,tmp_path = tempfile.mkstemp(suffix=".tmp",dir=os.path.dirname(self.path))
+        try:
+            with open(tfd,"wb") as f:
+                f.write(_header.pack(CHUNK_TABLE_MAGIC,CHUNK_TABLE_VERSION))
+            try: # unlike a replace, a link never clobbers a file another process created (and appended to) meanwhile
+                os.link(tmp_path,self.path)
+            except FileExistsError:
+                if os.path.getsize(self.path) == 0: # left empty by a crash, nothing to lose
+                    os.replace(tmp_path,self.path)
+            except OSError: # no hard links on this filesystem
+                os.replace(tmp_path,self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _ensure_loaded(self):
+        if self.records is None:
+            with self.lock:
+                if self.records is None:
+                    self._load()
+
+    def __contains__(self, ekey):
+        self._ensure_loaded()
+        return ekey.to_bytes(9,'big') in self.records
+
+    def get(self, ekey):
+        """ Returns the blte header (size, flags, chunk count, [(compressed size, decompressed size, checksum)]) stored for ekey
+        (an int of its first 9 bytes), the same tuple parse_blte gives, or None """
+        self._ensure_loaded()
+        p = self.records.get(ekey.to_bytes(9,'big'))
+        if p is None:
+            return None
+        _,sz,flg,cc = _record.unpack_from(self.data,p)
+        if sz == 0:
+            return 0,0,1,[(-1,-1,b'')]
+        return sz,flg,cc,list(_chunk.iter_unpack(self.data[p+_record.size:p+_record.size+cc*_chunk.size]))
+
+    def put(self, ekey, blte_header):
+        """ Stores a file's blte header, unless it's already stored. Raises OSError if the side file can't be written. """
+        self._ensure_loaded()
+        k = ekey.to_bytes(9,'big')
+        if k in self.records:
+            return
+        sz,flg,cc,chunks = blte_header
+        if sz == 0: # single chunk files list no chunk table
+            rec = _record.pack(k,0,0,0)
+        else:
+            rec = _record.pack(k,sz,flg,cc) + b''.join(_chunk.pack(*c) for c in chunks)
+
+        with self.lock:
+            if k in self.records:
+                return
+            if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+                self._create()
+            with open(self.path,"ab") as f:
+                pos = f.tell()
+                f.write(rec)
+            # extend what we have in memory, other processes' appends are picked up on the next load
+            if len(self.data) < pos:
+                self.data.extend(bytes(pos-len(self.data)))
+            del self.data[pos:]
+            self.data += rec
+            self.records[k] = pos
+
+def blte_sizes(blte_header):
+    """ (decompressed size, chunk count) of a blte header. Single chunk files report -1, their header doesn't say. """
+    return sum(c[1] for c in blte_header[3]),len(blte_header[3])
+
+_caches = {}
+
+def open_chunk_cache(cache_dir=CACHE_DIRECTORY):
+    """ The shared ChunkTableCache of a cache directory """
+    path = os.path.join(cache_dir,"blte-chunks")
+    if path not in _caches:
+        _caches[path] = ChunkTableCache(path)
+    return _caches[path]
@@ -0,0 +1,65 @@
+""" Compares fetching archived files one ranged request at a time against a coalesced fetchplan,
+using a local stand-in for the cdn that serves a synthetic archive. 
+
+usage: python bench/bench_fetchplan.py [file count] [latency ms] """
+import os, sys, re, random, tempfile, threading
+from time import time, sleep
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),".."))
+from PyCASC.fetchplan import plan_ranges, execute_plan
+from PyCASC.utils.blizzutils import fetch_range
+
+class RangeHandler(BaseHTTPRequestHandler):
+    archive = b''
+    latency = 0
+    requests = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with RangeHandler.lock:
+            RangeHandler.requests += 1
+        sleep(self.latency)
+        start,end = map(int,re.match(r"bytes=(\d+)-(\d+)",self.headers["Range"]).groups())
+        body = self.archive[start:end+1]
+        self.send_response(206)
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def make_archive(file_count):
+    """ Returns an archive blob and the (key, archive, offset, size) of every file in it """
+    locations, pos = [], 0
+    for x in range(file_count):
+        size = random.randint(200,64*1024)
+        locations.append((x,"archive",pos,size))
+        pos += size
+    return os.urandom(pos), locations
+
+def run(name, fetch, plan, workers):
+    RangeHandler.requests = 0
+    t = time()
+    got = sum(len(d) for _,d in execute_plan(plan,fetch,workers))
+    print(f"{name:<28} {RangeHandler.requests:>6} requests {time()-t:>8.3f}s {got/1024/1024:>8.1f}MB")
+
+if __name__ == '__main__':
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    RangeHandler.latency = (int(sys.argv[2]) if len(sys.argv) > 2 else 5)/1000
+    RangeHandler.archive, locations = make_archive(file_count)
+    # a directory extraction only wants some of the files in an archive.
+    wanted = sorted(random.sample(locations,file_count//2),key=lambda l:l[0])
+
+    server = ThreadingHTTPServer(("127.0.0.1",0),RangeHandler)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/archive"
+    fetch = lambda archive,offset,size: fetch_range(url,offset,size)
+
+    print(f"{len(wanted)} of {file_count} files, {RangeHandler.latency*1000:.0f}ms latency")
+    run("one request per file",fetch,plan_ranges(wanted,max_gap=-1,max_span=0),1)
+    run("one request per file, x4",fetch,plan_ranges(wanted,max_gap=-1,max_span=0),4)
+    run("planned, gap 64k, x4",fetch,plan_ranges(wanted),4)
+    run("planned, gap 1M, x4",fetch,plan_ranges(wanted,max_gap=1024*1024),4)
+    server.shutdown()
@@ -0,0 +1,280 @@
+""" Times each binary parser against the BytesIO + var_int way of reading it (one field, one read at a time),
+on synthetic files of about the size real builds have. Both ways are checked to give the same results.
+
+usage: python bench/bench_parsers.py [scale, 1 is about a real build's sizes] """
+import os, sys, struct, random, tempfile
+from io import BytesIO
+from time import perf_counter
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),".."))
+from PyCASC import r_idx, r_cidx, FileInfo
+from PyCASC.utils.blizzutils import var_int
+from PyCASC.utils.bufferreader import BufferReader
+from PyCASC.utils.CASCUtils import parse_encoding_file, parse_install_file, parse_download_file, parse_size_file, parse_blte, read_cstr
+from PyCASC.rootfiles.wow import parse_wow_root_columns
+from PyCASC.rootfiles.diablo3 import _parse_d3_dir_root
+
+rnd = random.Random(1)
+key = lambda: rnd.randbytes(16)
+
+def run(name, before, after, data, same=lambda a,b: a == b, repeat=3):
+    tb = min(_timed(before,data) for _ in range(repeat))
+    ta = min(_timed(after,data) for _ in range(repeat))
+    ok = same(before(data),after(data))
+    print(f"{name:<18} {len(data)/1024/1024:>7.1f}MB  before {tb:>8.3f}s  after {ta:>8.3f}s  {tb/ta:>6.1f}x  {'ok' if ok else 'MISMATCH'}")
+
+def _timed(fn, data):
+    t = perf_counter()
+    fn(data)
+    return perf_counter()-t
+
+def old_read_cstr(f):
+    s=b''
+    c=f.read(1)
+    while c != b'\0':
+        s+=c
+        c=f.read(1)
+    return s.decode("utf-8")
+
+def old_tags(f, tag_num, file_num):
+    tags = {}
+    for _ in range(tag_num):
+        name = old_read_cstr(f)
+        tagtype = var_int(f,2,False)
+        tags[name] = int.from_bytes(f.read((file_num+7)//8),'big')
+    return tags
+
+# encoding
+
+def make_encoding(n):
+    pairs = sorted((key(),key(),rnd.randrange(1<<30)) for _ in range(n))
+    entries = [bytes([1])+sz.to_bytes(5,"big")+ck+ek for ck,ek,sz in pairs]
+    per = 4096//len(entries[0])
+    pages = [b"".join(entries[i:i+per]).ljust(4096,b"\0") for i in range(0,n,per)]
+    hdr = b"EN"+struct.pack(">3BHHIIBI",1,16,16,4,4,len(pages),0,0,2)+b"z\0"
+    return hdr+bytes(32*len(pages))+b"".join(pages)
+
+def old_encoding(fd):
+    d=BytesIO(fd)
+    d.read(2)
+    version,ckey_len,ekey_len = struct.unpack("3B",d.read(3))
+    ckey_pagesize = var_int(d,2,False)*1024
+    var_int(d,2,False)
+    ckey_pagecount = var_int(d,4,False)
+    var_int(d,4,False)
+    d.seek(1,1)
+    d.seek(var_int(d,4,False),1)
+    a = d.tell()+0x20*ckey_pagecount
+    ckey_map = {}
+    for i in range(ckey_pagecount):
+        d.seek(a+i*ckey_pagesize)
+        end = d.tell()+ckey_pagesize
+        while d.tell()+6+ckey_len <= end:
+            ekcount = var_int(d,1)
+            if ekcount == 0:
+                break
+            d.seek(5,1)
+            ckey = var_int(d,ckey_len,False)
+            ckey_map[ckey] = var_int(d,9,False)
+            d.seek(ekey_len*ekcount-9,1)
+    return ckey_map
+
+# install, download and size manifests
+
+def make_install(n, tag_num=20):
+    d = b"IN"+struct.pack(">BBHI",1,16,tag_num,n)
+    for t in range(tag_num):
+        d += f"tag{t}".encode()+b"\0"+struct.pack(">H",t)+rnd.randbytes((n+7)//8)
+    for i in range(n):
+        d += f"some/install/path/file{i}.dat".encode()+b"\0"+key()+struct.pack(">I",i)
+    return d
+
+def old_install(fd):
+    f = BytesIO(fd)
+    f.read(2)
+    f.read(1)
+    hash_size = var_int(f,1)
+    tag_num = var_int(f,2,False)
+    file_num = var_int(f,4,False)
+    tags = old_tags(f,tag_num,file_num)
+    return tags,[(old_read_cstr(f),var_int(f,hash_size,False),var_int(f,4,False)) for _ in range(file_num)]
+
+def same_install(old, im):
+    return [(e.name,e.md5,e.size) for e in im] == old[1] and len(im.tags.tags) == len(old[0])
+
+def make_download(n, tag_num=20):
+    d = b"DL"+struct.pack(">BBBIH",3,16,0,n,tag_num)+bytes([1])+struct.pack(">b3x",0)
+    d += b"".join(key()+rnd.randrange(1<<30).to_bytes(5,'big')+struct.pack(">bB",rnd.randrange(4),0) for _ in range(n))
+    for t in range(tag_num):
+        d += f"tag{t}".encode()+b"\0"+struct.pack(">H",t)+rnd.randbytes((n+7)//8)
+    return d
+
+def old_download(fd):
+    f = BytesIO(fd)
+    f.read(2)
+    version,ekey_size,has_checksum = f.read(3)
+    file_num = var_int(f,4,False)
+    tag_num = var_int(f,2,False)
+    flag_size = var_int(f,1)
+    f.read(4)
+    entries = []
+    for _ in range(file_num):
+        ekey = f.read(ekey_size)
+        size = var_int(f,5,False)
+        priority = struct.unpack("b",f.read(1))[0]
+        f.read(flag_size)
+        entries.append((ekey,size,priority))
+    return entries,old_tags(f,tag_num,file_num)
+
+def same_download(old, dm):
+    return [(dm.ekey(i),dm.sizes[i],dm.priorities[i]) for i in range(len(dm))] == old[0]
+
+def make_size(n, tag_num=5):
+    d = b"DS"+struct.pack(">BBIH",2,9,n,tag_num)+rnd.randrange(1<<39).to_bytes(5,'big')
+    for t in range(tag_num):
+        d += f"tag{t}".encode()+b"\0"+struct.pack(">H",t)+rnd.randbytes((n+7)//8)
+    return d+b"".join(key()[:9]+struct.pack(">I",rnd.randrange(1<<30)) for _ in range(n))
+
+def old_size(fd):
+    f = BytesIO(fd)
+    f.read(2)
+    version,ekey_size = f.read(2)
+    file_num = var_int(f,4,False)
+    tag_num = var_int(f,2,False)
+    var_int(f,5,False)
+    tags = old_tags(f,tag_num,file_num)
+    return [(f.read(ekey_size),var_int(f,4,False)) for _ in range(file_num)]
+
+def same_size(old, sm):
+    return [(sm.ekey(i),sm.sizes[i]) for i in range(len(sm))] == old
+
+# local .idx and cdn .index files
+
+def make_idx(n):
+    ents = b"".join(key()[:9]+rnd.randrange(1<<38).to_bytes(5,'big')+struct.pack("<I",rnd.randrange(1<<30)) for _ in range(n))
+    return struct.pack("<IIH6BQQII",0x10,0,7,0,0,4,5,9,30,0,0,len(ents),0)+ents
+
+def old_idx(d):
+    f = BytesIO(d)
+    hl,hh,u_0,bi,u_1,ess,eos,eks,afhb,atsm,_,elen,eh=struct.unpack("IIH6BQQII",f.read(0x28))
+    ents = []
+    for _ in range(0,elen,ess+eos+eks):
+        e = FileInfo()
+        e.ekey,eo,e.compressed_size = var_int(f,eks,False),var_int(f,eos,False),var_int(f,ess)
+        e.data_file,e.offset = eo>>30,eo&(2**30-1)
+        ents.append(e)
+    return ents
+
+def new_idx(d):
+    path = os.path.join(tempfile.gettempdir(),"bench_parsers.idx")
+    with open(path,"wb") as f:
+        f.write(d)
+    return r_idx(path)
+
+def same_idx(old, new):
+    fields = lambda ents: [(e.ekey,e.data_file,e.offset,e.compressed_size) for e in ents]
+    return fields(old) == fields(new)
+
+def make_cidx(n):
+    ents = sorted((key(),rnd.randrange(1,1<<20),rnd.randrange(1<<30)) for _ in range(n))
+    per = 4096//24
+    blocks = [b"".join(ek+struct.pack(">II",s,o) for ek,s,o in ents[i:i+per]).ljust(4096,b"\0") for i in range(0,n,per)]
+    toc = b"".join(ents[min(i+per,n)-1][0] for i in range(0,n,per))+bytes(8*len(blocks))
+    return b"".join(blocks)+toc+bytes(8)+struct.pack("<8bI",1,0,0,4,4,4,16,8,n)+bytes(8)
+
+def old_cidx(d):
+    f = BytesIO(d)
+    ents = {}
+    for x in range(len(d)//4096):
+        f.seek(x*4096)
+        for _ in range(4096//24):
+            ek,es,eo = var_int(f,16,False),var_int(f,4,False),var_int(f,4,False)
+            if ek == 0 or es == 0:
+                break
+            e = FileInfo()
+            e.offset,e.compressed_size,e.ekey = eo,es,ek
+            ents[ek] = e
+    return ents
+
+def same_cidx(old, new):
+    fields = lambda ents: {ek:(e.offset,e.compressed_size) for ek,e in ents.items()}
+    return fields(old) == fields(new)
+
+# blte headers, c strings
+
+def make_blte(n):
+    chunks = [(rnd.randrange(1,1<<16),rnd.randrange(1,1<<16),key()) for _ in range(n)]
+    return b"BLTE"+struct.pack("<I",12+24*n)+struct.pack(">B",15)+n.to_bytes(3,'big')+b"".join(struct.pack(">II16s",*c) for c in chunks)
+
+def old_blte(d):
+    f = BytesIO(d)
+    f.read(4)
+    sz = var_int(f,4)
+    flg = var_int(f,1)
+    cc = var_int(f,3,False)
+    return sz,flg,cc,[(var_int(f,4,False),var_int(f,4,False),f.read(16)) for _ in range(cc)]
+
+def make_cstrs(n):
+    return b"".join(f"a/fairly/long/path/to/some/file/number_{i}/with/a/long/name_{'x'*(i%200)}.tex".encode()+b"\0" for i in range(n))
+
+def old_cstrs(d):
+    f = BytesIO(d)
+    return [old_read_cstr(f) for _ in range(d.count(b"\0"))]
+
+def new_cstrs(d):
+    r = BufferReader(d)
+    return [read_cstr(r) for _ in range(d.count(b"\0"))]
+
+# root files
+
+def make_wow(groups, per_group):
+    d = struct.pack("<3I",0x4D465354,groups*per_group,groups*per_group)
+    for g in range(groups):
+        d += struct.pack("<3I",per_group,0x8,0x2)+bytes(4*per_group)+b"".join(key() for _ in range(per_group))+rnd.randbytes(8*per_group)
+    return d
+
+def old_wow(fd):
+    f = BytesIO(fd)
+    f.read(12)
+    rows = []
+    while f.tell()+12 <= len(fd):
+        n,content_flags,locale_flags = var_int(f,4),var_int(f,4),var_int(f,4)
+        deltas = [var_int(f,4) for _ in range(n)]
+        ckeys = [f.read(16) for _ in range(n)]
+        namehashes = [var_int(f,8) for _ in range(n)]
+        rows.extend(zip(deltas,ckeys,namehashes))
+    return rows
+
+def same_wow(old, cols):
+    return [(cols.ckey(i),cols.namehashes[i]) for i in range(len(cols))] == [(c,h) for _,c,h in old]
+
+def make_d3(n):
+    d = b"\xc4\xd0\x07\x80"+struct.pack("<I",n)+b"".join(key()+struct.pack("<I",i) for i in range(n))
+    d += struct.pack("<I",n)+b"".join(key()+struct.pack("<II",i,i%7) for i in range(n))
+    return d+struct.pack("<I",n)+b"".join(key()+f"Some\\D3\\Named\\File{i}.dat".encode()+b"\0" for i in range(n))
+
+def old_d3(fd):
+    f = BytesIO(fd)
+    f.read(4)
+    sno = [(f.read(16),var_int(f,4))[::-1] for _ in range(var_int(f,4))]
+    sno_indexed = []
+    for _ in range(var_int(f,4)):
+        ckey,snoid,findex = f.read(16),var_int(f,4),var_int(f,4)
+        sno_indexed.append((snoid,findex,ckey))
+    named = [(2,)+(f.read(16),old_read_cstr(f))[::-1] for _ in range(var_int(f,4))]
+    return sno,sno_indexed,named
+
+if __name__ == '__main__':
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 0.25
+    n = lambda x: max(1,int(x*scale))
+    print(f"scale {scale}")
+    run("encoding",old_encoding,parse_encoding_file,make_encoding(n(1000000)))
+    run("install",old_install,parse_install_file,make_install(n(20000)),same_install)
+    run("download",old_download,parse_download_file,make_download(n(400000)),same_download)
+    run("size",old_size,parse_size_file,make_size(n(400000)),same_size)
+    run("local .idx",old_idx,new_idx,make_idx(n(200000)),same_idx)
+    run("cdn .index",old_cidx,r_cidx,make_cidx(n(100000)),same_cidx)
+    run("blte header",old_blte,lambda d:parse_blte(d,read_data=False)[0],make_blte(n(100000)))
+    run("c strings",old_cstrs,new_cstrs,make_cstrs(n(100000)))
+    run("wow root",old_wow,parse_wow_root_columns,make_wow(n(200),5000),same_wow)
+    run("d3 dir root",old_d3,_parse_d3_dir_root,make_d3(n(200000)))
@@ -1,12 +1,14 @@
-import sys, os
-from PyQt5.QtWidgets import QMainWindow, QApplication, QWidget, QProgressBar, QAction, QTableView, QTableWidget,QTableWidgetItem, QGridLayout, QHeaderView, QAbstractItemView, QTextEdit, QHBoxLayout, QMenu, QFileDialog
+import sys, os, time
+from threading import Thread, Condition
+from PyQt5.QtWidgets import QMainWindow, QApplication, QWidget, QProgressBar, QAction, QTableView, QTableWidget,QTableWidgetItem, QGridLayout, QHeaderView, QAbstractItemView, QTextEdit, QHBoxLayout, QMenu, QFileDialog, QLineEdit
 from PyQt5.QtGui import QIcon, QFont, QDrag, QPixmap, QPainter, QColor, QBrush
-from PyQt5.QtCore import pyqtSlot, Qt, QBuffer, QByteArray, QUrl, QMimeData, pyqtSignal
+from PyQt5.QtCore import pyqtSlot, Qt, QBuffer, QByteArray, QUrl, QMimeData, pyqtSignal, QTimer
 from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent
 from PyQt5.QtMultimediaWidgets import QVideoWidget
 from PyQt5 import QtCore, QtMultimedia
 from PyCASC.utils.CASCUtils import beautify_filesize, SNO_INDEXED_FILE
-from PyCASC import DirCASCReader, CDNCASCReader
+from PyCASC import DirCASCReader, CDNCASCReader, LoadCancelled
+from PyCASC.pathindex import PathIndex
 from widgets.HexViewWidget import HexViewWidget
 from widgets.SaveFileWidget import SaveFileWidget
 import webbrowser
@@ -16,67 +18,176 @@ import webbrowser
 SUPPORTED_CDN = [("Diablo 3","d3"),("Hearthstone","hsb"),("Warcraft III", "w3")]
 
 class TableFolderItem(object):
+    """ A row of the file table, only made for the rows being acted on (see FileTableModel.item) """
     def __init__(self, text, parent, is_folder=False, is_back_button=False, file_data=None):
         self.text = text
         self.is_folder = is_folder
         self.is_back_button = is_back_button
         self.file_data = file_data
         self.parent = parent
-        self.color = None
 
-    def get_color(self,force_update=False):
-        if self.file_data == None:
-            return None
-        
-        if self.color != None and not force_update:
-            return self.color
-
-        if not self.parent.CASCReader.is_file_fetchable(self.file_data[1],include_cdn=False):
-            # if it's NOT locally fetchable, then it needs to be fetched from cdn.
-            self.color = QBrush(QColor(200, 200, 200))
-        else:
-            self.color = QBrush(QColor(255, 255, 255))
-
-        return self.color
-
-    def __lt__(self, other):
-        if self.is_back_button:
-            return True 
-        elif other.is_back_button:
-            return False
-        elif self.is_folder and not other.is_folder:
-            return True
-        elif other.is_folder and not self.is_folder:
-            return False
-        else:
-            return self.text < other.text
+class RowStats(object):
+    """ Sizes and local fetchability of the files the table is showing, worked out in batches on a background thread,
+    since is_file_fetchable can hash, stat and open a cache file per file on cdn storages. """
+    BATCH_SIZE = 256
+    MAX_PENDING = 4096 # rows scrolled past before their turn came are dropped
+
+    def __init__(self, app):
+        self.app = app
+        self.sizes = {} # ckey -> size, or None if unknown
+        self.local = {} # ckey -> whether it's fetchable without the cdn
+        self.pending = []
+        self.queued = set()
+        self.cond = Condition()
+        Thread(target=self.run,daemon=True).start()
+
+    def reset(self):
+        with self.cond:
+            self.sizes,self.local = {},{}
+            self.pending,self.queued = [],set()
+
+    def request(self, ckey):
+        with self.cond:
+            if ckey in self.queued:
+                return
+            self.queued.add(ckey)
+            self.pending.append(ckey)
+            if len(self.pending) > self.MAX_PENDING:
+                self.queued.difference_update(self.pending[:-self.MAX_PENDING])
+                del self.pending[:-self.MAX_PENDING]
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while len(self.pending) == 0:
+                    self.cond.wait()
+                # newest first, those are the rows on screen
+                batch = self.pending[-self.BATCH_SIZE:]
+                del self.pending[-self.BATCH_SIZE:]
+            reader,is_cdn = self.app.CASCReader,self.app.isCDN
+            if reader is None:
+                continue
+            sizes,local = {},{}
+            for ckey in batch:
+                try:
+                    size = reader.get_content_size(ckey)
+                    if size is None and not is_cdn: # local storages can read it from the blte header, cdn ones would download it
+                        size = reader.get_file_size_by_ckey(ckey)
+                    sizes[ckey] = size
+                    local[ckey] = reader.is_file_fetchable(ckey,include_cdn=False)
+                except Exception as e:
+                    print(e)
+                    sizes[ckey],local[ckey] = None,False
+            self.app.RowStatsSignal.emit(reader,sizes,local)
+
+    def arrived(self, sizes, local):
+        with self.cond:
+            self.sizes.update(sizes)
+            self.local.update(local)
+            self.queued.difference_update(sizes)
 
 class FileTableModel(QtCore.QAbstractTableModel):
-    def __init__(self, data, parent=None):
-        super(FileTableModel, self).__init__(parent)
-        self._data = data
-
-    def appendRow(self,w:QTableWidget):
-        self._data.append(w)
-
-    def rowCount(self, parent=None):
-        return len(self._data)
+    """ The current folder of the window's PathIndex, or search results. Nothing is built per row, Qt only asks about the rows it draws,
+    so folders of 100k+ files (wow's FILE_BY_ID) scroll as fast as small ones. Size and Stored come from RowStats as they're asked for. """
+    COLUMNS = ["Name","Size","Stored"]
 
-    def columnCount(self, parent=None):
-        return 1
-
-    def sort(self, order, d):
-        self._data = sorted(self._data)
+    def __init__(self, app, parent=None):
+        super(FileTableModel, self).__init__(parent)
+        self.app = app
+        self.path = ""
+        self.folders = []
+        self.files = []
+        self.has_back = False
+        self.results = None
+
+    def setFolder(self, path):
+        """ Shows a folder as it is now. Files the loader adds to it later show up on the next setFolder. """
+        self.beginResetModel()
+        folder = self.app.pathIndex.folder(path)
+        self.path = "/".join(path)
+        self.folders = [] if folder is None else list(folder.folders)
+        self.files = [] if folder is None else list(folder.files)
+        self.has_back = len(path) > 0
+        self.results = None
+        self.endResetModel()
+
+    def setResults(self, results):
+        """ Shows search results, (path, ckey) pairs, in place of a folder """
+        self.beginResetModel()
+        self.results = results
+        self.endResetModel()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        if self.results is not None:
+            return len(self.results)
+        return len(self.folders)+len(self.files)+self.has_back
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.COLUMNS[section]
+
+    def entry(self, row):
+        """ ("back",None), ("folder",name), ("file",file id) or ("result",(path,ckey)) for a row """
+        if self.results is not None:
+            return "result",self.results[row]
+        if self.has_back:
+            if row == 0:
+                return "back",None
+            row -= 1
+        if row < len(self.folders):
+            return "folder",self.folders[row]
+        return "file",self.files[row-len(self.folders)]
+
+    def item(self, row):
+        kind,v = self.entry(row)
+        if kind == "back":
+            return TableFolderItem("..",self.app,is_folder=True,is_back_button=True)
+        elif kind == "folder":
+            return TableFolderItem("📁"+v,self.app,is_folder=True)
+        elif kind == "result":
+            return TableFolderItem(v[0].rpartition("/")[2],self.app,file_data=v)
+        index = self.app.pathIndex
+        return TableFolderItem(index.names[v],self.app,file_data=(index.path(v),index.ckeys[v]))
 
     def data(self, index, role=QtCore.Qt.DisplayRole):
+        row,col = index.row(),index.column()
+        if not 0 <= row < self.rowCount():
+            return None
+        kind,v = self.entry(row)
+        stats = self.app.rowStats
         if role == QtCore.Qt.DisplayRole:
-            row = index.row()
-            if 0 <= row < self.rowCount():
-                return self._data[row].text
-        elif role == QtCore.Qt.ForegroundRole:
-            row = index.row()
-            if 0 <= row < self.rowCount():
-                return self._data[row].get_color()
+            if kind == "back":
+                return ".." if col == 0 else ""
+            elif kind == "folder":
+                if col == 0:
+                    return "📁"+v
+                return f"{self.app.pathIndex.count(self.path+'/'+v if self.path else v)} items" if col == 1 else ""
+            name,ckey = v if kind == "result" else (self.app.pathIndex.names[v],self.app.pathIndex.ckeys[v])
+            if col == 0:
+                return name
+            if ckey not in stats.local:
+                stats.request(ckey)
+                return "…"
+            if col == 1:
+                size = stats.sizes[ckey]
+                return "" if size is None else beautify_filesize(size)
+            return "Local" if stats.local[ckey] else "CDN"
+        elif role == QtCore.Qt.ForegroundRole and kind in ("file","result"):
+            local = stats.local.get(v[1] if kind == "result" else self.app.pathIndex.ckeys[v])
+            if local is None:
+                return None
+            # if it's NOT locally fetchable, then it needs to be fetched from cdn.
+            return QBrush(QColor(255, 255, 255)) if local else QBrush(QColor(200, 200, 200))
+
+    def statsArrived(self):
+        if self.rowCount() > 0:
+            self.dataChanged.emit(self.index(0,0),self.index(self.rowCount()-1,self.columnCount()-1))
 
 class FileTableWidget(QTableView):
     def __init__(self,parent):
@@ -87,7 +198,27 @@ class FileTableWidget(QTableView):
         self.parent_obj.on_click(None)
         # print(selected,deselected)
 
+class LoadState(object):
+    """ One background load. Its signals are ignored once it's no longer the window's current load. """
+    def __init__(self, name):
+        self.name = name
+        self.cancelled = False
+        self.last_refresh = 0
+        self.named = 0
+        self.unnamed = 0
+
 class CascViewApp(QMainWindow):
+    LoadProgressSignal = pyqtSignal(object,str,float)
+    LoadReaderSignal = pyqtSignal(object,object)
+    LoadBatchSignal = pyqtSignal(object,object,object)
+    LoadFinishedSignal = pyqtSignal(object,object)
+    RowStatsSignal = pyqtSignal(object,object,object)
+    NameIndexSignal = pyqtSignal(object,object,object)
+    SearchResultsSignal = pyqtSignal(object,str,object,float)
+
+    REFRESH_INTERVAL = 0.5 # seconds between table refreshes while files are still coming in
+    SEARCH_DELAY = 250 # ms of no typing before the search box searches
+    SEARCH_LIMIT = 50000 # results shown at most
 
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -95,63 +226,177 @@ class CascViewApp(QMainWindow):
         self.width = 700
         self.height = 500
 
+        self.CASCReader=None
+        self.isCDN=False
+        self.rowStats = RowStats(self)
         self.load_empty_table()
         self.openWidgets=[]
-        self.isCDN=False
+        self.loading=None
+
+        self.LoadProgressSignal.connect(self.on_load_progress)
+        self.LoadReaderSignal.connect(self.on_load_reader)
+        self.LoadBatchSignal.connect(self.on_load_batch)
+        self.LoadFinishedSignal.connect(self.on_load_finished)
+        self.RowStatsSignal.connect(self.on_row_stats)
+        self.NameIndexSignal.connect(self.on_name_index)
+        self.SearchResultsSignal.connect(self.on_search_results)
 
         self.initUI()
 
     def load_empty_table(self):
         self.CASCReader=None
-        self.files=[]
-        self.unknown_files=[]
-        self.filetree=self.genFileTree()
+        self.pathIndex=PathIndex()
+        self.nameIndex=None
+        self.rowStats.reset()
         self.curPath=[]
 
     def load_casc_dir(self, d):
-        self.load_empty_table()
-        self.populateTable()
-
-        self.CASCReader = DirCASCReader(d)
-        self.files = self.CASCReader.list_files()
-        self.unknown_files = self.CASCReader.list_unnamed_files()
-        self.filetree = self.genFileTree()
-        self.curPath = []
-        self.populateTable()
+        self.start_load(d,lambda on_progress:DirCASCReader(d,on_progress=on_progress))
 
     def load_casc_cdn(self, product):
+        self.start_load(product,lambda on_progress:CDNCASCReader(product,read_install_file=True,on_progress=on_progress),is_cdn=True)
+
+    def start_load(self, name, make_reader, is_cdn=False):
+        """ Builds a reader with make_reader(on_progress) and lists its files on a background thread. 
+        The table fills in as batches of files come back, and the load can be cancelled from the File menu. """
+        self.cancel_load()
         self.load_empty_table()
+        self.isCDN=is_cdn
+        self.searchBox.clear()
+        self.searchBox.setEnabled(False)
+        self.searchBox.setPlaceholderText("Search: available once the files are loaded")
         self.populateTable()
 
-        self.CASCReader = CDNCASCReader(product,read_install_file=True)
-        self.files = self.CASCReader.list_files()
-        self.unknown_files = self.CASCReader.list_unnamed_files()
-        self.filetree = self.genFileTree()
-        self.curPath = []
-        self.populateTable()
-        self.isCDN=True
-
-    def genFileTree(self):
-        ftree = {'folders':{},'files':{}}
-        for f in self.files:
-            path = f[0].replace("\\","/").split("/")
-            toptree = ftree
-            for sp in path[:-1]:
-                if sp not in toptree['folders']:
-                    toptree['folders'][sp]={'folders':{},'files':{}}
-                toptree = toptree['folders'][sp]
-            toptree['files'][path[-1]]=f
-
-       
-        uktree = {'folders':{},'files':{}}
-        for f in self.unknown_files:
-            uktree['files'][f"{f[0]:x}"]=f
-
-        if len(uktree['files']) > 0:
-            ftree['folders']['!UNNAMED'] = uktree
-
-        return ftree
-        
+        load = LoadState(name)
+        self.loading = load
+        self.cancelAction.setEnabled(True)
+        self.progressBar.setValue(0)
+        self.progressBar.show()
+        self.statusBar().showMessage(f"Loading {name}")
+        Thread(target=self.run_load,args=(load,make_reader),daemon=True).start()
+
+    def run_load(self, load, make_reader):
+        """ The loader thread. Only talks to the window through signals. """
+        def on_progress(step,pct):
+            if load.cancelled:
+                raise LoadCancelled()
+            self.LoadProgressSignal.emit(load,step,pct)
+        try:
+            reader = make_reader(on_progress)
+            self.LoadReaderSignal.emit(load,reader)
+            for named,unnamed in reader.iter_files():
+                self.LoadBatchSignal.emit(load,named,unnamed)
+            self.LoadFinishedSignal.emit(load,None)
+        except LoadCancelled:
+            pass
+        except Exception as e:
+            print(e)
+            self.LoadFinishedSignal.emit(load,e)
+
+    def cancel_load(self):
+        if self.loading is None:
+            return
+        self.loading.cancelled = True # the loader thread stops at its next progress report
+        self.statusBar().showMessage(f"Cancelled loading {self.loading.name}")
+        self.loading = None
+        self.cancelAction.setEnabled(False)
+        self.progressBar.hide()
+        self.populateTable(keep_position=True)
+
+    def on_load_progress(self, load, step, pct):
+        if load is not self.loading:
+            return
+        self.statusBar().showMessage(f"Loading {load.name}: {step}")
+        self.progressBar.setValue(int(pct))
+
+    def on_load_reader(self, load, reader):
+        if load is not self.loading:
+            return
+        self.CASCReader = reader
+
+    def on_load_batch(self, load, named, unnamed):
+        if load is not self.loading:
+            return
+        before = self.pathIndex.count(self.curPath)
+        self.pathIndex.add(named,unnamed)
+        load.named += len(named)
+        load.unnamed += len(unnamed)
+        # only redraw when the folder being looked at changed, and not on every batch
+        if self.pathIndex.count(self.curPath) != before and time.monotonic()-load.last_refresh > self.REFRESH_INTERVAL:
+            load.last_refresh = time.monotonic()
+            self.populateTable(keep_position=True)
+
+    def on_load_finished(self, load, error):
+        if load is not self.loading:
+            return
+        self.loading = None
+        self.cancelAction.setEnabled(False)
+        self.progressBar.hide()
+        if error is not None:
+            self.statusBar().showMessage(f"Failed to load {load.name}: {error}")
+        else:
+            self.statusBar().showMessage(f"Loaded {load.name}: {load.named} named, {load.unnamed} unnamed files")
+            self.searchBox.setPlaceholderText("Search: indexing names...")
+            Thread(target=self.run_name_index,args=(self.CASCReader,),daemon=True).start()
+        self.populateTable(keep_position=True)
+
+    def run_name_index(self, reader):
+        """ Builds (or opens the cached) name index of a reader, off the ui thread """
+        try:
+            self.NameIndexSignal.emit(reader,reader.get_name_index(),None)
+        except Exception as e:
+            print(e)
+            self.NameIndexSignal.emit(reader,None,e)
+
+    def on_name_index(self, reader, index, error):
+        if reader is not self.CASCReader:
+            return
+        if error is not None:
+            self.searchBox.setPlaceholderText(f"Search unavailable: {error}")
+            return
+        self.nameIndex = index
+        self.searchBox.setPlaceholderText("Search names: text, ^start, end$, *.ext, ~fuzzy")
+        self.searchBox.setEnabled(True)
+
+    def run_search(self):
+        """ Shows the files matching the search box, or the current folder again once it's emptied """
+        query = self.searchBox.text().strip()
+        if self.nameIndex is None:
+            return
+        if query == "":
+            self.populateTable()
+            self.statusBar().clearMessage()
+            return
+        self.statusBar().showMessage(f"Searching for {query}...")
+        Thread(target=self.run_search_query,args=(self.nameIndex,query),daemon=True).start()
+
+    def run_search_query(self, index, query):
+        """ Runs a search off the ui thread, broad queries can take a while to list """
+        t = time.monotonic()
+        try:
+            results = index.search(query,self.SEARCH_LIMIT)
+        except Exception as e:
+            print(e)
+            results = e
+        self.SearchResultsSignal.emit(index,query,results,time.monotonic()-t)
+
+    def on_search_results(self, index, query, results, took):
+        if index is not self.nameIndex or query != self.searchBox.text().strip():
+            return # the storage or the query changed since, a newer search is coming
+        if isinstance(results,Exception):
+            self.statusBar().showMessage(f"Search failed: {results}")
+            return
+        self.tableModel.setResults(results)
+        self.fileTable.scrollToTop()
+        more = " (showing the first ones)" if len(results) == self.SEARCH_LIMIT else ""
+        self.statusBar().showMessage(f"{len(results)} results{more} in {1000*took:.0f} ms")
+
+    def on_row_stats(self, reader, sizes, local):
+        if reader is not self.CASCReader:
+            return
+        self.rowStats.arrived(sizes,local)
+        self.tableModel.statsArrived()
+
     def initUI(self):
         self.setWindowTitle(self.title)
         self.resize(self.width,self.height)
@@ -161,9 +406,21 @@ class CascViewApp(QMainWindow):
         self.main_widget = QWidget(self)
 
         # Add box layout, add table to box layout and add box layout to widget
+        self.searchBox = QLineEdit(self.main_widget)
+        self.searchBox.setPlaceholderText("Search: available once the files are loaded")
+        self.searchBox.setClearButtonEnabled(True)
+        self.searchBox.setEnabled(False)
+        # searching every keystroke would redo broad queries for nothing, wait for a pause in the typing
+        self.searchTimer = QTimer(self)
+        self.searchTimer.setSingleShot(True)
+        self.searchTimer.setInterval(self.SEARCH_DELAY)
+        self.searchTimer.timeout.connect(self.run_search)
+        self.searchBox.textChanged.connect(lambda t:self.searchTimer.start())
+
         self.layout = QGridLayout(self.main_widget)
-        self.layout.addWidget(self.fileTable,0,0) 
-        self.layout.addWidget(self.infoTable,0,1) 
+        self.layout.addWidget(self.searchBox,0,0,1,2)
+        self.layout.addWidget(self.fileTable,1,0) 
+        self.layout.addWidget(self.infoTable,1,1) 
 
         self.main_widget.setLayout(self.layout)
         self.setCentralWidget(self.main_widget)
@@ -172,10 +429,8 @@ class CascViewApp(QMainWindow):
         fileMenu = mainMenu.addMenu('&File')
         def choose_and_load_from_dir():
             dest = QFileDialog.getExistingDirectory(self, f"Select your game directory (WoW, WC3, D3, etc)", os.getcwd())
-            try:
-                self.load_casc_dir(dest)
-            except Exception as e:
-                print(e)
+            if dest:
+                self.load_casc_dir(dest) # errors show up in the status bar, the load runs on another thread
 
         fileMenu.addAction("&Open Local Folder", choose_and_load_from_dir)
 
@@ -186,40 +441,25 @@ class CascViewApp(QMainWindow):
             caction.triggered.connect(lambda: self.load_casc_cdn(self.sender().val))
             cdnMenu.addAction(caction)
 
-        # Show widget
-        self.show()
-    
-    def populateTable(self):
-        curDir = self.filetree
-        for x in self.curPath:
-            curDir = curDir['folders'][x]
-
-        self.fileTable.setSortingEnabled(False)
-
+        self.cancelAction = fileMenu.addAction("&Cancel Loading", self.cancel_load)
+        self.cancelAction.setEnabled(False)
 
-        model = self.fileTable.model()
-        if model is not None:
-            self.fileTable.setModel(None)
-            model.deleteLater()
+        self.progressBar = QProgressBar()
+        self.progressBar.setMaximumWidth(200)
+        self.progressBar.hide()
+        self.statusBar().addPermanentWidget(self.progressBar)
 
-        self.tableModel = FileTableModel([],self.fileTable)
+        # Show widget
+        self.show()
     
-        # for x in range(self.fileTable.rowCount()):
-        #     self.fileTable.removeRow(0)
-
-        if self.curPath != []:
-            self.tableModel.appendRow(TableFolderItem("..",self,is_folder=True,is_back_button=True))
-
-        for f in curDir['files']:
-            self.tableModel.appendRow(TableFolderItem(f,self,file_data=curDir['files'][f]))
-
-        for f in curDir['folders']:
-            self.tableModel.appendRow(TableFolderItem("📁"+f,self,is_folder=True))
-            
-        self.fileTable.setModel(self.tableModel)
-        self.fileTable.setSortingEnabled(True)
-        self.fileTable.sortByColumn(0,0)
-        self.fileTable.scrollToTop()
+    def populateTable(self, keep_position=False):
+        """ Shows the current folder. keep_position keeps the scroll position, for refreshing the folder as it fills in. """
+        scroll = self.fileTable.verticalScrollBar().value()
+        self.tableModel.setFolder(self.curPath)
+        if keep_position:
+            self.fileTable.verticalScrollBar().setValue(scroll)
+        else:
+            self.fileTable.scrollToTop()
 
     def createTables(self):
         # Create tables
@@ -235,9 +475,20 @@ class CascViewApp(QMainWindow):
         # self.fileTable.setDragEnabled(True)
         # self.fileTable.setDropIndicatorShown(True)
 
+        self.fileTable.setWordWrap(False)
+        self.fileTable.setSelectionBehavior(QAbstractItemView.SelectRows)
+        # fixed row heights and column widths, so qt never measures rows that aren't on screen
+        self.fileTable.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.fileTable.verticalHeader().setDefaultSectionSize(self.fileTable.fontMetrics().height()+6)
+
+        self.tableModel = FileTableModel(self,self.fileTable)
+        self.fileTable.setModel(self.tableModel)
         header = self.fileTable.horizontalHeader()       
-        header.setSectionResizeMode(QHeaderView.Stretch)
-        header.hide()
+        header.setSectionResizeMode(0, QHeaderView.Stretch)
+        header.setSectionResizeMode(1, QHeaderView.Fixed)
+        header.setSectionResizeMode(2, QHeaderView.Fixed)
+        header.resizeSection(1, 90)
+        header.resizeSection(2, 60)
 
         self.populateTable()        
 
@@ -269,6 +520,8 @@ class CascViewApp(QMainWindow):
     
     def keyReleaseEvent(self, e):
         QMainWindow.keyReleaseEvent(self, e)
+        if self.searchBox.hasFocus():
+            return
         if e.key()==Qt.Key_Enter or e.key()==Qt.Key_Return:
             self.on_dbl_click(None)
 
@@ -277,8 +530,10 @@ class CascViewApp(QMainWindow):
         pPos=parent.mapToGlobal(QtCore.QPoint(0, 0))
         mPos=pPos+QPos
         self.rcMenu=QMenu(self)
-        item_indexs=[x for x in self.fileTable.selectedIndexes()]
-        sitems=[self.fileTable.model()._data[x.row()] for x in item_indexs]
+        item_indexs=self.fileTable.selectionModel().selectedRows()
+        sitems=[self.tableModel.item(x.row()) for x in item_indexs]
+        if len(sitems)==0:
+            return
         if len(sitems)>1:
             self.rcMenu.addAction('Export files').triggered.connect(lambda:self.save_items(sitems))
         else:
@@ -295,26 +550,23 @@ class CascViewApp(QMainWindow):
         self.rcMenu.show()
 
     def save_items(self,items,dest=None):
-        curDir = self.filetree
-        for x in self.curPath:
-            curDir = curDir['folders'][x]
         folder={'folders':{},'files':{}}
         for x in items:
             n=x.text
             if x.is_folder:
                 if x.is_back_button: continue
-                folder['folders'][n[1:]]=curDir['folders'][n[1:]]
+                folder['folders'][n[1:]]=self.pathIndex.as_tree(self.curPath+[n[1:]])
             else:
-                folder['files'][n]=curDir['files'][n]
+                folder['files'][n]=x.file_data
         w = SaveFileWidget(folder,dest,self)
         self.openWidgets.append(w)
     
     def on_click(self, index):
         # row,column = index.row(),index.column()
-        item = self.fileTable.selectedIndexes()
+        item = self.fileTable.selectionModel().selectedRows()
         if len(item)<1:
             return
-        item=self.fileTable.model()._data[item[0].row()]
+        item=self.tableModel.item(item[0].row())
         if not item.is_folder:
             self.infoTable.item(0,0).setText("File: "+item.text)
             if self.CASCReader.is_file_fetchable(item.file_data[1],include_cdn=False): 
@@ -339,18 +591,15 @@ class CascViewApp(QMainWindow):
                 self.infoTable.item(0,0).setText("Parent Directory")
                 self.infoTable.item(1,0).setText("")
             else:
-                curDir = self.filetree
-                for x in self.curPath+[item.text[1:]]:
-                    curDir = curDir['folders'][x]
                 self.infoTable.item(0,0).setText("Folder: "+item.text[1:])
-                self.infoTable.item(1,0).setText(f"Items: {len(curDir['files'])+len(curDir['folders'])}")
+                self.infoTable.item(1,0).setText(f"Items: {self.pathIndex.count(self.curPath+[item.text[1:]])}")
 
     def on_dbl_click(self, index):
         #enter directory, preview if file
-        item = self.fileTable.selectedIndexes()
+        item = self.fileTable.selectionModel().selectedRows()
         if len(item)<1:
             return
-        item=self.fileTable.model()._data[item[0].row()]
+        item=self.tableModel.item(item[0].row())
         if item.is_folder:
             if item.is_back_button:
                 self.curPath.pop()
@@ -363,10 +612,9 @@ class CascViewApp(QMainWindow):
     def show_hexview_for_item(self,item,force_type=None):
         ckey = item.file_data[1]
         size = self.CASCReader.get_file_size_by_ckey(ckey)
-        data = self.CASCReader.get_file_by_ckey(ckey,8*1024) # load 8k
-        
+
         w = HexViewWidget(self)
-        w.viewFile(item.text,data,size,force_type)
+        w.viewFile(item.text,ckey,size,force_type) # reads only the pages it shows
         self.openWidgets.append(w)
 
     def sub_widget_closed(self,w):
@@ -375,8 +623,9 @@ class CascViewApp(QMainWindow):
         w.deleteLater()
 
     def closeEvent(self, e):
+        self.cancel_load()
         for h in self.openWidgets:
-            if isinstance(h, HexViewWidget) and h.tmp_file is not None:
+            if isinstance(h, HexViewWidget) and h.tmp_file is not None and os.path.exists(h.tmp_file):
                 os.unlink(h.tmp_file)
             h.closeEvent(None)
         self.openWidgets=None
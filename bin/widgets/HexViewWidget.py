@@ -1,15 +1,55 @@
 import sys, os
-from PyQt5.QtWidgets import QWidget, QTextEdit, QHBoxLayout
-from PyQt5.QtGui import QFont
+from collections import OrderedDict
+from threading import Thread
+from PyQt5.QtWidgets import QWidget, QTextEdit, QHBoxLayout, QScrollBar
+from PyQt5.QtGui import QFont, QFontMetrics
+from PyQt5.QtCore import Qt, QEvent, pyqtSignal
 import webbrowser
 
+class PageCache(object):
+    """ A window over a file's decoded contents: fixed size pages read on demand with read_range_by_ckey (which only decodes
+    the chunks a page falls in), keeping the most recently used ones in memory. """
+    PAGE_SIZE = 64*1024
+    MAX_PAGES = 32
+
+    def __init__(self, cr, ckey, file_size):
+        self.cr = cr
+        self.ckey = ckey
+        self.file_size = file_size
+        self.pages = OrderedDict()
+
+    def page(self, n):
+        if n in self.pages:
+            self.pages.move_to_end(n)
+            return self.pages[n]
+        data = self.cr.read_range_by_ckey(self.ckey,n*self.PAGE_SIZE,self.PAGE_SIZE) or b''
+        self.pages[n] = data
+        if len(self.pages) > self.MAX_PAGES:
+            self.pages.popitem(last=False)
+        return data
+
+    def read(self, offset, size):
+        end = min(offset+size,self.file_size)
+        out = []
+        while offset < end:
+            n,o = divmod(offset,self.PAGE_SIZE)
+            d = self.page(n)[o:o+end-offset]
+            if len(d) == 0:
+                break
+            out.append(d)
+            offset += len(d)
+        return b''.join(out)
+
 class HexViewWidget(QWidget):
+    MediaStreamedSignal = pyqtSignal(str)
+
     def __init__(self, cascviewapp):
         super().__init__()
         self.cascviewapp=cascviewapp
         self.initUI()
         self.rowlen = 0x10
-        self.max_hexdump_byte_len = 8192
+        self.max_text_len = 1024*1024
+        self.pages = None
 
     def showMedia(self,external_viewer=False):
         c=0
@@ -18,44 +58,77 @@ class HexViewWidget(QWidget):
         while os.path.exists(self.tmp_file):
             c+=1
             self.tmp_file=f"tmp/{c}.{self.ext}"
-        with open(self.tmp_file,"wb+") as f:
-            f.write(self.content)
+        self.text_edit.setText("Preparing your file for the external viewer... Please wait")
+        self.text_edit.show()
+        Thread(target=self.streamMedia,daemon=True).start()
+
+    def streamMedia(self):
+        """ Writes the file out a chunk at a time, never holding it in memory whole """
+        try:
+            with open(self.tmp_file,"wb+") as f:
+                for _,data in self.cascviewapp.CASCReader.iter_file_chunks_by_ckey(self.ckey):
+                    f.write(data)
+            self.MediaStreamedSignal.emit("")
+        except Exception as e:
+            self.MediaStreamedSignal.emit(str(e))
+
+    def mediaStreamed(self, error):
+        if self.text_edit is None: # closed meanwhile
+            return
+        if error:
+            self.text_edit.setText(f"Failed to read the file: {error}")
+            return
         webbrowser.open(os.path.join(os.getcwd(),self.tmp_file))
         self.close()
 
     def showText(self):
-        self.text_edit.setText(str(self.content,self.encoding))
+        content = self.pages.read(0,self.max_text_len)
+        t = str(content,self.encoding,errors="replace")
+        if len(content) < self.file_size:
+            t+=f"\n... ({self.file_size-len(content)} bytes truncated) ..."
+        self.text_edit.setText(t)
         self.text_edit.show()
 
+    def visibleRows(self):
+        return max(1,self.text_edit.viewport().height()//QFontMetrics(self.text_edit.font()).lineSpacing())
+
     def showHexdump(self):
-        t = ""
+        """ Sets the scrollbar up over every row of the file, only the rows in view are ever read and formatted """
+        rows = (self.file_size+self.rowlen-1)//self.rowlen
+        visible = self.visibleRows()
+        self.scrollbar.setRange(0,max(0,rows-visible))
+        self.scrollbar.setPageStep(visible)
+        self.text_edit.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.text_edit.setLineWrapMode(QTextEdit.NoWrap)
+        self.text_edit.show()
+        self.scrollbar.show()
+        self.renderRows()
 
+    def renderRows(self):
         hexstrlen = self.rowlen*3
         charstrlen = self.rowlen
 
-        numbytestoprint = min(self.max_hexdump_byte_len+1,len(self.content))
-
-        for x in range(0,numbytestoprint,self.rowlen):
-            section = self.content[x:x+self.rowlen]
+        first = self.scrollbar.value()*self.rowlen
+        data = self.pages.read(first,self.visibleRows()*self.rowlen)
+        lines = []
+        for x in range(0,len(data),self.rowlen):
+            section = data[x:x+self.rowlen]
             hexstr = " ".join([f"{y:02x}" for y in section])
             charstr = "".join([chr(y) if 0x20 <= y <= 0x7E else "." for y in section])
-            t+=f"{x:06x} {hexstr.ljust(hexstrlen)} {charstr.ljust(charstrlen)}\n"
-
-        if numbytestoprint < self.file_size:
-            t+=f"... ({self.file_size-numbytestoprint} bytes truncated) ..."
+            lines.append(f"{first+x:08x} {hexstr.ljust(hexstrlen)} {charstr.ljust(charstrlen)}")
+        self.text_edit.setPlainText("\n".join(lines))
 
-        self.text_edit.setText(t)
-        self.text_edit.show()
-
-    def viewFile(self,filename,content,file_size,file_type=None):
+    def viewFile(self,filename,ckey,file_size,file_type=None):
         self.text_edit.setText("Loading your file... Please wait")
-        self.content = content
-        self.file_size=file_size
+        self.ckey = ckey
+        self.file_size=file_size or 0
+        self.pages = PageCache(self.cascviewapp.CASCReader,ckey,self.file_size)
         self.encoding="utf-8"
 
         self.ext = os.path.splitext(filename)[1][1:]
         if file_type is None:
             excemptedChars = [0xd,0xa,0x9]
+            content = self.pages.read(0,8192) # enough to guess the type from
 
             import filetype
             g = filetype.guess(content[:4096])
@@ -78,14 +151,12 @@ class HexViewWidget(QWidget):
         if file_type=="txt": # show strings as normal text files
             self.setWindowTitle(f"TextView: Viewing {filename}")
             self.showText()
-        elif file_type in ["audio","video","media"]: # play the audio/video externally   
+        elif file_type in ["audio","video","media"]: # play the audio/video externally
             self.setWindowTitle(f"MediaView: Viewing {filename}")
             self.showMedia()
         else: # show binary data in hexview
             self.setWindowTitle(f"HexView: Viewing {filename}")
             self.showHexdump()
-
-        self.content=None # do not need anymore.
         # else:
         #     raise Exception("Unsupported datatype passed to viewFile")
 
@@ -100,15 +171,49 @@ class HexViewWidget(QWidget):
         self.text_edit.setFont(QFont("Courier New",10))
         self.text_edit.setReadOnly(True)
         self.text_edit.hide()
+        self.text_edit.viewport().installEventFilter(self)
+
+        # the hexdump's own scrollbar, in rows of the whole file rather than of the text on screen
+        self.scrollbar = QScrollBar(Qt.Vertical,self)
+        self.scrollbar.valueChanged.connect(lambda v:self.renderRows())
+        self.scrollbar.hide()
 
         self.tmp_file = None
+        self.type = None
+
+        self.MediaStreamedSignal.connect(self.mediaStreamed)
 
         self.layout = QHBoxLayout()
         self.layout.addWidget(self.text_edit)
+        self.layout.addWidget(self.scrollbar)
         self.setLayout(self.layout)
         self.show()
 
+    def eventFilter(self, obj, e):
+        if e.type() == QEvent.Wheel and self.scrollbar.isVisible():
+            self.scrollbar.setValue(self.scrollbar.value()-e.angleDelta().y()//40) # 3 rows a notch
+            return True
+        return super().eventFilter(obj, e)
+
+    def keyPressEvent(self, e):
+        if self.scrollbar.isVisible() and e.key() in (Qt.Key_PageUp,Qt.Key_PageDown,Qt.Key_Home,Qt.Key_End):
+            steps = {Qt.Key_PageUp:-self.scrollbar.pageStep(),Qt.Key_PageDown:self.scrollbar.pageStep()}
+            if e.key() == Qt.Key_Home:
+                self.scrollbar.setValue(0)
+            elif e.key() == Qt.Key_End:
+                self.scrollbar.setValue(self.scrollbar.maximum())
+            else:
+                self.scrollbar.setValue(self.scrollbar.value()+steps[e.key()])
+            return
+        super().keyPressEvent(e)
+
+    def resizeEvent(self, e):
+        super().resizeEvent(e)
+        if self.scrollbar.isVisible():
+            self.showHexdump() # more or fewer rows fit now
+
     def closeEvent(self, e):
         self.text_edit=None
         self.layout=None
-        self.cascviewapp.sub_widget_closed(self)
\ No newline at end of file
+        self.pages=None
+        self.cascviewapp.sub_widget_closed(self)
@@ -2,15 +2,15 @@ import sys, os
 from PyQt5.QtWidgets import QWidget, QProgressBar, QGridLayout, QFileDialog, QLabel
 from PyQt5.QtCore import pyqtSlot, pyqtSignal, Qt
 from PyCASC.utils.CASCUtils import beautify_filesize
-from time import time
+from PyCASC.export import Exporter
 
 class SaveFileWidget(QWidget):
-    TransferCompletedSignal = pyqtSignal(int)
+    TransferProgressSignal = pyqtSignal()
 
     def __init__(self, items, dest, cascviewapp): 
         """
         Asserttions
-        - items is the same format as created in genFileTree, 
+        - items is the same format as created by PathIndex.as_tree, 
            folder:{'folders':{},'files':{}} file: {name:(path,ckey)}
         - dest is None (user decides the path later), or is pointing to... 
             a folder if items contains more than 1 file
@@ -32,10 +32,12 @@ class SaveFileWidget(QWidget):
         self.prepare_transfer()
         self.show()
 
-        from threading import Thread
-        self.stopped=False
-        self.transferThread = Thread(target=self.begin_transfer)
-        self.transferThread.start()
+        # the export engine works out sizes, ordering and the writing on its own threads
+        if self.is_single_file:
+            self.exporter = Exporter(self.cascviewapp.CASCReader,[(os.path.basename(self.dest),self.items_to_save[0][1])],os.path.dirname(self.dest),resume=False,on_progress=lambda e:self.TransferProgressSignal.emit())
+        else:
+            self.exporter = Exporter(self.cascviewapp.CASCReader,self.items_to_save,self.dest,resume=False,on_progress=lambda e:self.TransferProgressSignal.emit())
+        self.exporter.start()
 
     def initUI(self):
         self.setWindowTitle("File Exporter")
@@ -54,20 +56,16 @@ class SaveFileWidget(QWidget):
         self.layout.addWidget(self.rightlabel, 1, 1)
         self.setLayout(self.layout)
 
-        self.TransferCompletedSignal.connect(self.update_progbar)
+        self.TransferProgressSignal.connect(self.update_progbar)
 
     def prepare_transfer(self):
         #Verify / Get destination
         self.items_to_save = self.get_items_in_folder(self.items)
-        self.completion_count=0
-        self.finishedBytes=0
+        self.exporter = None
         self.to_complete=len(self.items_to_save)
         self.progressbar.setMinimum(0)
         self.progressbar.setMaximum(self.to_complete)
-        self.start_time = time()
-        self.total_size = 0
-
-        self.update_progbar(0)
+        self.update_labels()
 
         if self.dest is None:
             if self.is_single_file:
@@ -79,20 +77,17 @@ class SaveFileWidget(QWidget):
 
         # if it's not none, we've already made our assertions in the init function, either way we're ready to go.
 
-    def update_progbar(self, filesize:int):
-        new_val = self.progressbar.value()+1
-        if new_val >= self.progressbar.maximum():
-            self.progressbar.setValue(self.progressbar.maximum())
-        else:
-            self.progressbar.setValue(new_val)
-        self.completion_count = new_val
-        self.finishedBytes += filesize
-        self.transferspeed = round(self.finishedBytes/(time()-self.start_time+0.01),2)
+    def update_progbar(self):
+        self.progressbar.setValue(min(self.exporter.files_done,self.progressbar.maximum()))
         self.update_labels()
     
     def update_labels(self):
-        self.leftlabel.setText(f"{os.path.basename(self.items_to_save[self.completion_count-1][0])}\nFile {self.completion_count} of {self.to_complete}\n\n")
-        self.rightlabel.setText(f"\n{beautify_filesize(self.finishedBytes)}/{beautify_filesize(self.total_size)}\n{beautify_filesize(self.transferspeed)}/s\n")
+        e = self.exporter
+        if e is None:
+            self.leftlabel.setText(f"Preparing {self.to_complete} files\n\n\n")
+            return
+        self.leftlabel.setText(f"File {e.files_done} of {e.files_total}\n{len(e.errors)} failed\n\n")
+        self.rightlabel.setText(f"\n{beautify_filesize(e.bytes_done)}/{beautify_filesize(e.bytes_total)}\n{beautify_filesize(e.throughput())}/s\n")
 
     def clean_path(self,path):
         validchars = '-_.()\\/ abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
@@ -104,23 +99,10 @@ class SaveFileWidget(QWidget):
             f=folder['folders'][fk]
             items.extend(self.get_items_in_folder(f,os.path.join(curdir,self.clean_path(fk))))
         for f in folder['files']:
-            file_size = self.cascviewapp.CASCReader.get_file_size_by_ckey(folder['files'][f][1])
-            items.append((os.path.join(curdir,self.clean_path(f)),folder['files'][f][1],file_size))
+            items.append((os.path.join(curdir,self.clean_path(f)),folder['files'][f][1]))
         return items
 
-    def begin_transfer(self):
-        self.total_size = sum(x[2] for x in self.items_to_save)
-        for x in self.items_to_save:
-            if self.stopped: break
-            self.save_by_ckey(self.dest if self.is_single_file else os.path.join(self.dest,x[0]),x[1])
-
-    def save_by_ckey(self, path, ckey):
-        os.makedirs(os.path.dirname(path),exist_ok=True)
-        data=self.cascviewapp.CASCReader.get_file_by_ckey(ckey)
-        with open(path,'wb+') as f:
-            f.write(data)
-        self.TransferCompletedSignal.emit(len(data))
-
     def closeEvent(self, e):
-        self.stopped=True
+        if self.exporter is not None:
+            self.exporter.cancel()
         self.cascviewapp.sub_widget_closed(self)
\ No newline at end of file